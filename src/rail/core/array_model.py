@@ -0,0 +1,354 @@
+"""Array-native, memory-mappable file format for models
+
+Pickling a model that holds large numpy arrays, e.g., the `KDTree` of a KNN
+model or the training data of an NZDir model, means that every process that
+reads it deserialises its own copy of the arrays.  This format instead stores
+the arrays as raw, uncompressed and aligned blocks after a small JSON header
+that describes the structure of the model.  Reading a model maps the file
+in memory and returns arrays that are views of the mapped pages, so reading is
+near-instant, and the pages are shared by all the processes that read the same
+file.
+
+Layout of a file::
+
+    MAGIC (8 bytes) | header length (uint64, little endian) | JSON header | padding | array blocks
+
+Objects are described in the header by what they return from `__reduce_ex__`,
+as pickle would, but with their numpy arrays replaced by references to the
+array blocks.  This rebuilds scikit-learn trees, minisom and somoclu objects
+directly from the mapped arrays, without re-computing anything.  An object
+that is referenced again from its own state, e.g., by one of its bound methods,
+is described by a reference to its first occurrence.  Objects that can not be
+described this way are pickled into a block of bytes.
+
+Files written with the `ARRAY_MODEL_SUFFIX` suffix by `ModelHandle` use this
+format, and `ModelHandle` recognizes them by their first bytes when reading.
+"""
+
+import importlib
+import json
+import pickle
+
+import numpy as np
+
+MAGIC = b'RAILARRM'
+ARRAY_MODEL_SUFFIX = 'npmodel'
+FORMAT_VERSION = 2
+ALIGNMENT = 64
+
+_PREFIX_SIZE = len(MAGIC) + 8
+
+
+def _align(offset):
+    """Round up an offset to the next multiple of ALIGNMENT"""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _dtype_from_descr(descr):
+    """Rebuild a dtype from the description written by `np.lib.format.dtype_to_descr`, after a trip through JSON"""
+    if isinstance(descr, str):
+        return np.dtype(descr)
+    fields = []
+    for field in descr:
+        name, field_type = field[0], field[1]
+        if not isinstance(field_type, str):
+            field_type = _dtype_from_descr(field_type)
+        fields.append((name, field_type) + tuple(tuple(shape) for shape in field[2:]))
+    return np.dtype(fields)
+
+
+def _qualified_name(obj):
+    """Return 'module:qualname' for a class or function, or None if it can not be imported back"""
+    module = getattr(obj, '__module__', None)
+    qualname = getattr(obj, '__qualname__', None)
+    if module is None or qualname is None or '<' in qualname:
+        return None
+    try:
+        if _import_name(f'{module}:{qualname}') is not obj:
+            return None
+    except (ImportError, AttributeError):
+        return None
+    return f'{module}:{qualname}'
+
+
+def _import_name(name):
+    """Import the object named 'module:qualname'"""
+    module_name, qualname = name.split(':')
+    obj = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class _Encoder:
+    """Convert a model to a JSON-able description, collecting its arrays"""
+
+    def __init__(self):
+        self.arrays = []
+        self.offsets = []
+        self.offset = 0
+        # index of the objects described by their reduction, and whether they can already be referenced
+        self.memo = {}
+        self.ready = {}
+        self._keep_alive = []
+
+    def add_array(self, array):
+        """Add an array block, and return its description"""
+        array = np.ascontiguousarray(array)
+        self.offset = _align(self.offset)
+        desc = dict(offset=self.offset, dtype=np.lib.format.dtype_to_descr(array.dtype), shape=list(array.shape))
+        self.arrays.append(array)
+        self.offsets.append(self.offset)
+        self.offset += array.nbytes
+        return desc
+
+    def encode(self, obj):  # pylint: disable=too-many-return-statements
+        """Return the description of an object"""
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return obj
+        if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+            return {'__array__': self.add_array(obj)}
+        if isinstance(obj, np.generic) and not isinstance(obj, np.object_):
+            return {'__scalar__': self.add_array(np.asarray(obj))}
+        if isinstance(obj, list):
+            return [self.encode(val) for val in obj]
+        if isinstance(obj, tuple):
+            return {'__tuple__': [self.encode(val) for val in obj]}
+        if isinstance(obj, dict) and type(obj) is dict:
+            return {'__dict__': [[self.encode(key), self.encode(val)] for key, val in obj.items()]}
+        if isinstance(obj, type):
+            name = _qualified_name(obj)
+            if name is not None:
+                return {'__type__': name}
+        return self._encode_object(obj)
+
+    def _encode_object(self, obj):
+        """Describe an object by its reduction, falling back to pickle"""
+        if id(obj) in self.memo:
+            if not self.ready[id(obj)]:
+                # the object is referenced from the arguments needed to build it
+                raise _CircularReference()
+            return {'__ref__': self.memo[id(obj)]}
+        try:
+            reduced = obj.__reduce_ex__(4)
+        except Exception:  # pylint: disable=broad-except
+            reduced = None
+        # the list and dict items of the reduction, used by sub-classes of list and dict, are not supported
+        if isinstance(reduced, tuple) and 2 <= len(reduced) <= 5 and all(val is None for val in reduced[3:]):
+            func = _qualified_name(reduced[0])
+            if func is not None:
+                description = self._encode_reduction(obj, func, reduced)
+                if description is not None:
+                    return description
+        return {'__pickle__': self.add_array(np.frombuffer(pickle.dumps(obj, protocol=4), dtype=np.uint8))}
+
+    def _encode_reduction(self, obj, func, reduced):
+        """Describe an object by its reduction, or return None if it references itself from its arguments"""
+        memo_id = len(self.memo)
+        self.memo[id(obj)] = memo_id
+        self.ready[id(obj)] = False
+        # keep the object alive, so its id is not re-used by another object while encoding
+        self._keep_alive.append(obj)
+        nblocks, offset = len(self.arrays), self.offset
+        try:
+            args = self.encode(reduced[1])
+        except _CircularReference:
+            # forget this object, and everything encoded since
+            for key in [key for key, val in self.memo.items() if val >= memo_id]:
+                del self.memo[key], self.ready[key]
+            del self.arrays[nblocks:], self.offsets[nblocks:]
+            self.offset = offset
+            return None
+        self.ready[id(obj)] = True
+        state = reduced[2] if len(reduced) >= 3 else None
+        return {'__reduce__': dict(id=memo_id, func=func, args=args, state=self.encode(state))}
+
+
+class _CircularReference(Exception):
+    """Raised when an object is referenced from the arguments needed to build it"""
+
+
+class _Decoder:
+    """Rebuild a model from its description, using views of the mapped file"""
+
+    def __init__(self, buffer, data_start):
+        self.buffer = buffer
+        self.data_start = data_start
+        self.memo = {}
+
+    def get_array(self, desc):
+        """Return a view of an array block"""
+        dtype = _dtype_from_descr(desc['dtype'])
+        count = int(np.prod(desc['shape'], dtype=np.int64))
+        start = self.data_start + desc['offset']
+        return self.buffer[start:start + count * dtype.itemsize].view(dtype).reshape(desc['shape'])
+
+    def decode(self, desc):  # pylint: disable=too-many-return-statements
+        """Return the object for a description"""
+        if isinstance(desc, list):
+            return [self.decode(val) for val in desc]
+        if not isinstance(desc, dict):
+            return desc
+        if '__array__' in desc:
+            return self.get_array(desc['__array__'])
+        if '__scalar__' in desc:
+            return self.get_array(desc['__scalar__'])[()]
+        if '__tuple__' in desc:
+            return tuple(self.decode(val) for val in desc['__tuple__'])
+        if '__dict__' in desc:
+            return {self.decode(key): self.decode(val) for key, val in desc['__dict__']}
+        if '__type__' in desc:
+            return _import_name(desc['__type__'])
+        if '__pickle__' in desc:
+            return pickle.loads(self.get_array(desc['__pickle__']).tobytes())
+        if '__ref__' in desc:
+            return self.memo[desc['__ref__']]
+        reduced = desc['__reduce__']
+        obj = _import_name(reduced['func'])(*self.decode(reduced['args']))
+        if 'id' in reduced:
+            self.memo[reduced['id']] = obj
+        state = self.decode(reduced['state'])
+        if state is not None:
+            _set_state(obj, state)
+        return obj
+
+
+def _set_state(obj, state):
+    """Set the state of a rebuilt object, as pickle does"""
+    if hasattr(obj, '__setstate__'):
+        obj.__setstate__(state)
+        return
+    slot_state = None
+    if isinstance(state, tuple) and len(state) == 2:
+        state, slot_state = state
+    if state:
+        obj.__dict__.update(state)
+    if slot_state:
+        for key, val in slot_state.items():
+            setattr(obj, key, val)
+
+
+def is_array_model(path):
+    """Return True if the file at path is in the array model format"""
+    try:
+        with open(path, 'rb') as fin:
+            return fin.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def write_array_model(model, path):
+    """Write a model in the array model format
+
+    Parameters
+    ----------
+    model : any
+        The model, typically a dict holding numpy arrays and other objects
+    path : str
+        The path of the file to write
+    """
+    description, _, blocks = pack_model(model)
+    header = json.dumps(dict(version=FORMAT_VERSION, model=description)).encode()
+    data_start = _align(_PREFIX_SIZE + len(header))
+    with open(path, 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(np.array(len(header), dtype='<u8').tobytes())
+        fout.write(header)
+        for offset, array in blocks:
+            fout.write(b'\0' * (data_start + offset - fout.tell()))
+            array.tofile(fout)
+
+
+def read_array_model(path, mode='r'):
+    """Read a model in the array model format
+
+    Parameters
+    ----------
+    path : str
+        The path of the file to read
+    mode : str
+        The mode used to map the file, 'r' for read-only arrays, or 'c' for copy-on-write
+        arrays that can be modified in memory without changing the file
+
+    Returns
+    -------
+    model : any
+        The model, its arrays are views of the mapped file
+    """
+    with open(path, 'rb') as fin:
+        prefix = fin.read(_PREFIX_SIZE)
+        if prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not an array model file")
+        header_length = int(np.frombuffer(prefix[len(MAGIC):], dtype='<u8')[0])
+        header = json.loads(fin.read(header_length))
+    if header['version'] > FORMAT_VERSION:  #pragma: no cover
+        raise ValueError(f"{path} was written with a newer version ({header['version']}) of the array model format")
+    buffer = np.memmap(path, dtype=np.uint8, mode=mode)
+    decoder = _Decoder(buffer, _align(_PREFIX_SIZE + header_length))
+    return decoder.decode(header['model'])
+
+
+def pack_model(model):
+    """Split a model into a JSON-able description and the blocks of its numpy arrays
+
+    Returns
+    -------
+    description : any
+        The description of the model, with references to the array blocks
+    nbytes : int
+        The size of the buffer needed to hold all the array blocks
+    blocks : list[tuple[int, np.ndarray]]
+        The offset in the buffer of each array, and the array
+    """
+    encoder = _Encoder()
+    description = encoder.encode(model)
+    return description, encoder.offset, list(zip(encoder.offsets, encoder.arrays))
+
+
+def copy_blocks(blocks, buffer):
+    """Copy the array blocks returned by `pack_model()` into a uint8 buffer"""
+    for offset, array in blocks:
+        buffer[offset:offset + array.nbytes] = array.reshape(-1).view(np.uint8)
+
+
+def unpack_model(description, buffer):
+    """Rebuild a model packed by `pack_model()`, its arrays are views of the buffer"""
+    return _Decoder(buffer, 0).decode(description)
+
+
+def share_model(comm, load):  #pragma: no cover
+    """Load a model on one rank per node, and share its arrays with the other ranks of the node
+
+    The rank 0 of each node calls `load()`, and copies the arrays of the model into an
+    MPI shared memory window.  All the ranks of the node then rebuild the model from
+    read-only views of the window, so that the node holds a single copy of the arrays.
+
+    Parameters
+    ----------
+    comm : mpi4py.MPI.Comm
+        The communicator of the ranks that use the model
+    load : callable
+        Function returning the model, it is only called on one rank per node
+
+    Returns
+    -------
+    model : any
+        The model, its arrays are views of the shared memory
+    window : mpi4py.MPI.Win
+        The shared memory window, it must be kept alive as long as the model is used
+    """
+    from mpi4py import MPI  # pylint: disable=import-outside-toplevel
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    is_leader = node_comm.rank == 0
+    description, nbytes, blocks = pack_model(load()) if is_leader else (None, None, None)
+    description, nbytes = node_comm.bcast((description, nbytes), root=0)
+    window = MPI.Win.Allocate_shared(max(nbytes, 1) if is_leader else 0, 1, comm=node_comm)
+    shared_buffer, _ = window.Shared_query(0)
+    buffer = np.frombuffer(shared_buffer, dtype=np.uint8, count=nbytes)
+    if is_leader:
+        copy_blocks(blocks, buffer)
+    del blocks
+    node_comm.Barrier()
+    buffer = buffer.view()
+    buffer.flags.writeable = False
+    return unpack_model(description, buffer), window
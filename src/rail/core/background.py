@@ -0,0 +1,176 @@
+""" Utilities to overlap I/O and computation using background threads """
+
+import queue
+import threading
+
+
+def close_iterator(iterator):
+    """Close an iterator, if it has a `close()` method, e.g. to stop a `PrefetchIterator` early"""
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+
+
+class _Failure:
+    """Wrapper used to pass an exception from the background thread to the consumer"""
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class PrefetchIterator:
+    """Iterator that reads upcoming chunks on a background thread
+
+    This wraps any iterator yielding `(start, end, data)` tuples, such as
+    the ones returned by `DataHandle.iterator()`, and fills a bounded queue
+    with the next chunks while the caller is still processing the current one.
+
+    Parameters
+    ----------
+    iterator : iterator
+        The underlying iterator, yielding `(start, end, data)` tuples
+    depth : int
+        Maximum number of chunks to read ahead of the consumer
+
+    Notes
+    -----
+    Some readers (e.g., `tables_io.iteratorNative` for hdf5 files) re-use the same
+    dict for every chunk they yield, so dict-like chunks are shallow-copied before
+    being put on the queue.
+    """
+
+    _done = object()
+
+    def __init__(self, iterator, depth=1):
+        self._iterator = iterator
+        self._queue = queue.Queue(maxsize=max(int(depth), 1))
+        self._stop = threading.Event()
+        self._finished = False
+        # the thread does not hold a reference to self, so that an iterator
+        # dropped by the consumer can be garbage collected, which stops the thread
+        self._thread = threading.Thread(target=self._fill, args=(iterator, self._queue, self._stop),
+                                        daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _put(queue_, stop, item):
+        """Put an item on the queue, giving up if the iterator has been closed"""
+        while not stop.is_set():
+            try:
+                queue_.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @classmethod
+    def _fill(cls, iterator, queue_, stop):
+        """Read chunks from the underlying iterator, this runs in the background thread"""
+        try:
+            for start, end, data in iterator:
+                if isinstance(data, dict):
+                    data = data.copy()
+                if not cls._put(queue_, stop, (start, end, data)):
+                    break
+            else:
+                cls._put(queue_, stop, cls._done)
+        except Exception as msg:  # pylint: disable=broad-except
+            cls._put(queue_, stop, _Failure(msg))
+        finally:
+            close_iterator(iterator)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        item = self._queue.get()
+        if item is self._done:
+            self._finished = True
+            self._thread.join()
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self.close()
+            raise item.exc
+        return item
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # do not wait for the thread here, it stops after reading the current chunk
+        self._stop.set()
+
+    def close(self):
+        """Stop the background thread and release the underlying iterator"""
+        self._finished = True
+        self._stop.set()
+        self._thread.join()
+
+
+class ChunkWriter:
+    """Write chunks of output data on a dedicated background thread
+
+    Tasks are executed in the order in which they are submitted.  The queue
+    of pending tasks is bounded, so `submit()` blocks once `depth` tasks are
+    waiting, which keeps the memory held by unwritten chunks under control.
+
+    Parameters
+    ----------
+    depth : int
+        Maximum number of chunks waiting to be written
+
+    Notes
+    -----
+    If a write fails, the exception is re-raised in the calling thread
+    by the next call to `submit()`, `flush()` or `close()`, and the
+    remaining queued tasks are discarded.
+    """
+
+    def __init__(self, depth=1):
+        self._queue = queue.Queue(maxsize=max(int(depth), 1))
+        self._error = None
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        """Execute the queued tasks, this runs in the background thread"""
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                if self._error is None:
+                    func, args, kwargs = task
+                    func(*args, **kwargs)
+            except Exception as msg:  # pylint: disable=broad-except
+                self._error = msg
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        """Re-raise an exception from the background thread, if any"""
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a call to `func(*args, **kwargs)`, blocking if the queue is full"""
+        self._check()
+        if not self._thread.is_alive():  #pragma: no cover
+            raise RuntimeError("ChunkWriter.submit() called after close()")
+        self._queue.put((func, args, kwargs))
+
+    def flush(self):
+        """Block until all the queued tasks have been executed"""
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        """Execute the remaining tasks and stop the background thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check()
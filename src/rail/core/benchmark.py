@@ -0,0 +1,582 @@
+"""Performance benchmarks for the RAIL estimators, summarizers, degraders and evaluator
+
+This runs every algorithm in `rail.estimation.algos`, `rail.creation.degradation` and
+`rail.evaluation` on synthetic catalogs of configurable size, and records the time
+spent informing the model, the time spent running the stage, the resulting throughput,
+the size of the output files, and the peak memory used.  Each algorithm is run in a fresh
+process, so that the memory measurements of one algorithm are not polluted by the previous ones.
+
+Usage::
+
+    python -m rail.core.benchmark run --sizes 1e4 1e5 --output bench.json
+    python -m rail.core.benchmark run --sizes 1e6 --only KNearNeighPDF TrainZ --output bench.json
+    python -m rail.core.benchmark compare baseline.json bench.json --threshold 0.2
+
+`compare` exits with status 1 if any algorithm got slower, or used more memory,
+than in the baseline by more than the threshold.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+import pandas as pd
+import qp
+import tables_io
+
+from rail.core.data import DATA_STORE, Hdf5Handle, PqHandle, QPHandle, TableHandle
+from rail.core.instrumentation import peak_rss
+from rail.core.utils import RAILDIR
+
+BANDS = 'ugrizy'
+
+# Rough LSST 10 year 5-sigma depths, used to make the synthetic magnitude errors
+_M5 = dict(u=26.1, g=27.4, r=27.5, i=26.8, z=26.1, y=24.9)
+
+# Slope and intercept of the colors with respect to the i band, as a function of log(1+z)
+_COLOR_SLOPE = dict(u=2.5, g=1.8, r=0.8, i=0., z=-0.4, y=-0.6)
+_COLOR_OFFSET = dict(u=0.6, g=0.3, r=0.1, i=0., z=-0.1, y=-0.2)
+
+
+def make_synthetic_catalog(nrows, seed=0, nondetect_val=99.):
+    """Make a synthetic photometric catalog, with the column names used by the RAIL defaults
+
+    Parameters
+    ----------
+    nrows : int
+        Number of objects
+    seed : int
+        Random number seed
+    nondetect_val : float
+        Value given to the magnitudes fainter than the 1-sigma depth
+
+    Returns
+    -------
+    catalog : OrderedDict[str, np.ndarray]
+        `id`, `redshift`, and `mag_{band}_lsst`, `mag_err_{band}_lsst` for each band
+    """
+    rng = np.random.default_rng(seed)
+    redshift = np.clip(rng.gamma(2.0, 0.3, nrows), 0.01, 2.99)
+    mag_i = np.clip(rng.normal(24.0, 1.2, nrows), 18., 27.5)
+    catalog = OrderedDict(id=np.arange(nrows), redshift=redshift)
+    for band in BANDS:
+        mag = mag_i + _COLOR_SLOPE[band] * np.log1p(redshift) + _COLOR_OFFSET[band]
+        mag_err = 0.005 + 0.2 * 10**(0.4 * (mag - _M5[band]))
+        mag = mag + rng.normal(0., 1., nrows) * mag_err
+        # fainter than 1-sigma detection
+        nondetect = mag > _M5[band] + 1.75
+        catalog[f'mag_{band}_lsst'] = np.where(nondetect, nondetect_val, mag)
+        catalog[f'mag_err_{band}_lsst'] = np.where(nondetect, nondetect_val, mag_err)
+    return catalog
+
+
+def make_synthetic_ensemble(redshift, seed=0):
+    """Make a synthetic `qp.Ensemble` of gaussian p(z), with a `zmode` ancil, scattered around `redshift`"""
+    rng = np.random.default_rng(seed)
+    scale = 0.03 * (1. + redshift)
+    loc = np.clip(redshift + rng.normal(0., 1., redshift.size) * scale, 0., 3.)
+    ens = qp.Ensemble(qp.stats.norm, data=dict(loc=np.expand_dims(loc, -1),  # pylint: disable=no-member
+                                               scale=np.expand_dims(scale, -1)))
+    ens.set_ancil(dict(zmode=loc))
+    return ens
+
+
+def write_benchmark_inputs(workdir, nrows, ntrain=10_000, seed=0):
+    """Write the input files used by the benchmarks for one catalog size
+
+    Parameters
+    ----------
+    workdir : str
+        Directory to write the files to
+    nrows : int
+        Number of objects in the catalogs the stages are run on
+    ntrain : int
+        Maximum number of objects in the training catalog
+    seed : int
+        Random number seed
+
+    Returns
+    -------
+    paths : dict[str, str]
+        The paths to the files:
+        'train' and 'test', hdf5 catalogs with a 'photometry' group,
+        'degrade', a parquet table with the magnitudes in columns named after the bands,
+        'degrade_lsst', the same with the columns named as in the test catalog,
+        'pdfs', a qp file with p(z) for the test catalog, and 'truth', its true redshifts.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    paths = dict(train=os.path.join(workdir, 'train.hdf5'),
+                 test=os.path.join(workdir, 'test.hdf5'),
+                 degrade=os.path.join(workdir, 'degrade.pq'),
+                 degrade_lsst=os.path.join(workdir, 'degrade_lsst.pq'),
+                 pdfs=os.path.join(workdir, 'pdfs.hdf5'),
+                 truth=os.path.join(workdir, 'truth.hdf5'))
+    train = make_synthetic_catalog(min(nrows, ntrain), seed=seed + 1)
+    tables_io.write(dict(photometry=train), paths['train'])
+    test = make_synthetic_catalog(nrows, seed=seed)
+    tables_io.write(dict(photometry=test), paths['test'])
+    degrade = pd.DataFrame({band: test[f'mag_{band}_lsst'] for band in BANDS})
+    degrade.insert(0, 'redshift', test['redshift'])
+    degrade.to_parquet(paths['degrade'])
+    degrade.rename(columns={band: f'mag_{band}_lsst' for band in BANDS}).to_parquet(paths['degrade_lsst'])
+    make_synthetic_ensemble(test['redshift'], seed=seed).write_to(paths['pdfs'])
+    with h5py.File(paths['truth'], 'w') as fout:
+        fout['redshift'] = test['redshift']
+    return paths
+
+
+def _timed(func, *args):
+    """Call func(*args) and return the time it took"""
+    t_start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t_start
+
+
+def _bench_estimator(paths, estimator_class, informer_class=None, inform_kwargs=None, estimate_kwargs=None):
+    """Inform a model on the training catalog, then run a CatEstimator on the test catalog"""
+    DS = DATA_STORE()
+    inform_seconds = None
+    estimate_kwargs = dict(estimate_kwargs or {})
+    if informer_class is not None:
+        training_data = DS.read_file('bench_training', TableHandle, paths['train'])
+        informer = informer_class.make_stage(name='bench_inform', model='bench_model.pkl',
+                                             hdf5_groupname='photometry', **(inform_kwargs or {}))
+        inform_seconds = _timed(informer.inform, training_data)
+        estimate_kwargs['model'] = informer.get_handle('model')
+    test_data = DS.read_file('bench_test', TableHandle, paths['test'])
+    estimator = estimator_class.make_stage(name='bench_estimate', hdf5_groupname='photometry', **estimate_kwargs)
+    return inform_seconds, _timed(estimator.estimate, test_data)
+
+
+def _bench_knn_index(paths, nneigh=7, sigma=0.03, **index_kwargs):
+    """Compare an approximate `IVFIndex` to the exact KDTree, on the colors of the training and test catalogs
+
+    The build and query times are those of the approximate index, the recall@k and
+    the CDE loss of the KNN PDFs are reported for both.
+    """
+    from sklearn.neighbors import KDTree  # pylint: disable=import-outside-toplevel
+    from rail.estimation.algos.knnpz import IVFIndex, _cde_loss  # pylint: disable=import-outside-toplevel
+
+    def colors(catalog):
+        mags = np.array([np.where(catalog[f'mag_{band}_lsst'] == 99., _M5[band] + 1.75, catalog[f'mag_{band}_lsst'])
+                         for band in BANDS]).T
+        return np.hstack([mags[:, 3:4], mags[:, :-1] - mags[:, 1:]])
+
+    train = tables_io.read(paths['train'])['photometry']
+    test = tables_io.read(paths['test'])['photometry']
+    train_colors, test_colors = colors(train), colors(test)
+    t_start = time.perf_counter()
+    index = IVFIndex(train_colors, **index_kwargs)
+    build_seconds = time.perf_counter() - t_start
+    t_start = time.perf_counter()
+    dists, ids = index.query(test_colors, k=nneigh)
+    query_seconds = time.perf_counter() - t_start
+    exact_dists, exact_ids = KDTree(train_colors).query(test_colors, k=nneigh)
+    recall = np.mean([np.intersect1d(row, exact_row).size / nneigh for row, exact_row in zip(ids, exact_ids)])
+    zgrid = np.linspace(0., 3., 301)
+    # avoid infinite weights for test objects that are also in the training catalog
+    cde_loss = _cde_loss(np.maximum(dists, 1e-6), ids, train['redshift'], sigma, zgrid, test['redshift'])
+    exact_cde_loss = _cde_loss(np.maximum(exact_dists, 1e-6), exact_ids, train['redshift'], sigma, zgrid,
+                               test['redshift'])
+    return build_seconds, query_seconds, dict(recall_at_k=recall, cde_loss=cde_loss, exact_cde_loss=exact_cde_loss)
+
+
+def _bench_szpz_summarizer(paths, informer_class, summarizer_class, inform_kwargs=None, summarize_kwargs=None):
+    """Inform a model on the training catalog, then summarize the test catalog with it"""
+    DS = DATA_STORE()
+    spec_data = DS.read_file('bench_spec', TableHandle, paths['train'])
+    informer = informer_class.make_stage(name='bench_inform', model='bench_model.pkl',
+                                         hdf5_groupname='photometry', **(inform_kwargs or {}))
+    inform_seconds = _timed(informer.inform, spec_data)
+    test_data = DS.read_file('bench_test', TableHandle, paths['test'])
+    summarizer = summarizer_class.make_stage(name='bench_summarize', model=informer.get_handle('model'),
+                                             hdf5_groupname='photometry', spec_groupname='photometry',
+                                             **(summarize_kwargs or {}))
+    return inform_seconds, _timed(summarizer.summarize, test_data, spec_data)
+
+
+def _bench_pz_summarizer(paths, summarizer_class, summarize_kwargs=None):
+    """Summarize the p(z) of the test catalog"""
+    pdfs = DATA_STORE().read_file('bench_pdfs', QPHandle, paths['pdfs'])
+    summarizer = summarizer_class.make_stage(name='bench_summarize', **(summarize_kwargs or {}))
+    return None, _timed(summarizer.summarize, pdfs)
+
+
+def _bench_pdf_converter(paths, converter_class, convert_kwargs=None):
+    """Convert the p(z) of the test catalog to another representation"""
+    pdfs = DATA_STORE().read_file('bench_pdfs', QPHandle, paths['pdfs'])
+    converter = converter_class.make_stage(name='bench_convert', **(convert_kwargs or {}))
+    return None, _timed(converter.convert, pdfs)
+
+
+def _bench_degrader(paths, degrader_class, degrade_kwargs=None, input_key='degrade'):
+    """Degrade the test catalog"""
+    sample = DATA_STORE().read_file('bench_degrade', PqHandle, paths[input_key])
+    degrader = degrader_class.make_stage(name='bench_degrade', **(degrade_kwargs or {}))
+    return None, _timed(degrader, sample)
+
+
+def _bench_evaluator(paths, evaluator_class, evaluate_kwargs=None):
+    """Evaluate the p(z) of the test catalog against the true redshifts"""
+    DS = DATA_STORE()
+    pdfs = DS.read_file('bench_pdfs', QPHandle, paths['pdfs'])
+    truth = DS.read_file('bench_truth', Hdf5Handle, paths['truth'])
+    evaluator = evaluator_class.make_stage(name='bench_evaluate', **(evaluate_kwargs or {}))
+    return None, _timed(evaluator.evaluate, pdfs, truth)
+
+
+class BenchmarkCase:
+    """One algorithm to benchmark
+
+    Parameters
+    ----------
+    name : str
+        The name of the case, by default the name of the stage being run
+    kind : str
+        'estimator', 'summarizer', 'converter', 'degrader', 'evaluator' or 'index'
+    func : callable
+        Module-level function called as `func(paths, **kwargs)`, returning
+        the time spent informing the model, or None, and the time spent running the stage,
+        optionally followed by a dict of other metrics to record
+    kwargs : dict
+        Passed to func
+    """
+
+    def __init__(self, name, kind, func, **kwargs):
+        self.name = name
+        self.kind = kind
+        self.func = func
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return f"BenchmarkCase({self.name}, {self.kind})"
+
+
+def default_cases():
+    """Return the benchmarks for all the algorithms that can be imported
+
+    Returns
+    -------
+    cases : list[BenchmarkCase]
+        The benchmarks
+    skipped : dict[str, str]
+        The algorithms that could not be imported, and why
+    """
+    cases = []
+    skipped = {}
+
+    def add(module_name, builder):
+        try:
+            cases.extend(builder(__import__(module_name, fromlist=['_'])))
+        except ImportError as msg:
+            skipped[module_name] = str(msg)
+
+    add('rail.estimation.algos.knnpz', lambda mod: [
+        BenchmarkCase('KNearNeighPDF', 'estimator', _bench_estimator, estimator_class=mod.KNearNeighPDF,
+                      informer_class=mod.Inform_KNearNeighPDF)])
+    add('rail.estimation.algos.pzflow', lambda mod: [
+        BenchmarkCase('PZFlowPDF', 'estimator', _bench_estimator, estimator_class=mod.PZFlowPDF,
+                      informer_class=mod.Inform_PZFlowPDF)])
+    add('rail.estimation.algos.randomPZ', lambda mod: [
+        BenchmarkCase('RandomPZ', 'estimator', _bench_estimator, estimator_class=mod.RandomPZ)])
+    add('rail.estimation.algos.sklearn_nn', lambda mod: [
+        BenchmarkCase('SimpleNN', 'estimator', _bench_estimator, estimator_class=mod.SimpleNN,
+                      informer_class=mod.Inform_SimpleNN)])
+    add('rail.estimation.algos.trainZ', lambda mod: [
+        BenchmarkCase('TrainZ', 'estimator', _bench_estimator, estimator_class=mod.TrainZ,
+                      informer_class=mod.Inform_trainZ)])
+    # size and speed of the reduced precision outputs, to compare with the float64 cases above
+    add('rail.estimation.algos.pzflow', lambda mod: [
+        BenchmarkCase('PZFlowPDF_float32_gzip', 'estimator', _bench_estimator, estimator_class=mod.PZFlowPDF,
+                      informer_class=mod.Inform_PZFlowPDF,
+                      estimate_kwargs=dict(output_precision='float32', output_compression='gzip'))])
+    add('rail.estimation.algos.trainZ', lambda mod: [
+        BenchmarkCase('TrainZ_float32', 'estimator', _bench_estimator, estimator_class=mod.TrainZ,
+                      informer_class=mod.Inform_trainZ, estimate_kwargs=dict(output_precision='float32')),
+        BenchmarkCase('TrainZ_float32_gzip', 'estimator', _bench_estimator, estimator_class=mod.TrainZ,
+                      informer_class=mod.Inform_trainZ,
+                      estimate_kwargs=dict(output_precision='float32', output_compression='gzip'))])
+    # approximate neighbour index, to compare with KNearNeighPDF and the exact KDTree
+    add('rail.estimation.algos.knnpz', lambda mod: [
+        BenchmarkCase('KNearNeighPDF_ivf', 'estimator', _bench_estimator, estimator_class=mod.KNearNeighPDF,
+                      informer_class=mod.Inform_KNearNeighPDF, inform_kwargs=dict(index_type='ivf')),
+        BenchmarkCase('IVFIndex_nprobe2', 'index', _bench_knn_index, n_probe=2),
+        BenchmarkCase('IVFIndex_nprobe8', 'index', _bench_knn_index, n_probe=8)])
+    add('rail.estimation.algos.pdfConverter', lambda mod: [
+        BenchmarkCase('PDFConverter', 'converter', _bench_pdf_converter, converter_class=mod.PDFConverter),
+        BenchmarkCase('PDFConverter_sparse', 'converter', _bench_pdf_converter, converter_class=mod.PDFConverter,
+                      convert_kwargs=dict(representation='sparse'))])
+    add('rail.estimation.algos.NZDir', lambda mod: [
+        BenchmarkCase('NZDir', 'summarizer', _bench_estimator, estimator_class=mod.NZDir,
+                      informer_class=mod.Inform_NZDir)])
+    add('rail.estimation.algos.simpleSOM', lambda mod: [
+        BenchmarkCase('SimpleSOMSummarizer', 'summarizer', _bench_szpz_summarizer,
+                      informer_class=mod.Inform_SimpleSOMSummarizer, summarizer_class=mod.SimpleSOMSummarizer)])
+    add('rail.estimation.algos.somocluSOM', lambda mod: [
+        BenchmarkCase('somocluSOMSummarizer', 'summarizer', _bench_szpz_summarizer,
+                      informer_class=mod.Inform_somocluSOMSummarizer, summarizer_class=mod.somocluSOMSummarizer)])
+    add('rail.estimation.algos.naiveStack', lambda mod: [
+        BenchmarkCase('NaiveStack', 'summarizer', _bench_pz_summarizer, summarizer_class=mod.NaiveStack)])
+    add('rail.estimation.algos.pointEstimateHist', lambda mod: [
+        BenchmarkCase('PointEstimateHist', 'summarizer', _bench_pz_summarizer,
+                      summarizer_class=mod.PointEstimateHist)])
+    add('rail.estimation.algos.varInference', lambda mod: [
+        BenchmarkCase('VarInferenceStack', 'summarizer', _bench_pz_summarizer,
+                      summarizer_class=mod.VarInferenceStack)])
+
+    def degraders(mod):
+        return [
+            BenchmarkCase('GridSelection', 'degrader', _bench_degrader, degrader_class=mod.GridSelection),
+            BenchmarkCase('LSSTErrorModel', 'degrader', _bench_degrader, degrader_class=mod.LSSTErrorModel),
+            BenchmarkCase('ObsCondition', 'degrader', _bench_degrader, degrader_class=mod.ObsCondition),
+            BenchmarkCase('QuantityCut', 'degrader', _bench_degrader, degrader_class=mod.QuantityCut,
+                          degrade_kwargs=dict(cuts=dict(i=25.))),
+            BenchmarkCase('LineConfusion', 'degrader', _bench_degrader, degrader_class=mod.LineConfusion,
+                          degrade_kwargs=dict(true_wavelen=5007., wrong_wavelen=3727., frac_wrong=0.05)),
+            BenchmarkCase('InvRedshiftIncompleteness', 'degrader', _bench_degrader,
+                          degrader_class=mod.InvRedshiftIncompleteness, degrade_kwargs=dict(pivot_redshift=1.)),
+        ] + [
+            BenchmarkCase(selection, 'degrader', _bench_degrader, degrader_class=getattr(mod, selection),
+                          input_key='degrade_lsst')
+            for selection in ['SpecSelection_GAMA', 'SpecSelection_BOSS', 'SpecSelection_DEEP2',
+                              'SpecSelection_VVDSf02', 'SpecSelection_zCOSMOS', 'SpecSelection_HSC']
+        ]
+
+    add('rail.creation.degradation', degraders)
+    add('rail.evaluation.evaluator', lambda mod: [
+        BenchmarkCase('Evaluator', 'evaluator', _bench_evaluator, evaluator_class=mod.Evaluator)])
+    return cases, skipped
+
+
+def run_case(case, paths, nrows, workdir):
+    """Run one benchmark case, in the current process, and return its result
+
+    The outputs of the stage are written to `workdir`.  Failures are reported in the
+    result, with `status='error'`, rather than raised, so that one broken algorithm
+    does not stop the whole suite.
+    """
+    DS = DATA_STORE()
+    # the cases reuse the same keys, only allow overwriting them while this case runs
+    allow_overwrite = DS.__class__.allow_overwrite
+    DS.__class__.allow_overwrite = True
+    DS.clear()
+    cwd = os.getcwd()
+    result = dict(case=case.name, kind=case.kind, nrows=nrows, status='ok', error=None,
+                  inform_seconds=None, run_seconds=None, rows_per_sec=None, output_bytes=None)
+    rss_before = peak_rss()
+    t_start = time.time()
+    try:
+        os.chdir(workdir)
+        inform_seconds, run_seconds, *metrics = case.func(paths, **case.kwargs)
+        if metrics:
+            result.update(metrics[0])
+        result.update(inform_seconds=inform_seconds, run_seconds=run_seconds,
+                      rows_per_sec=nrows / run_seconds if run_seconds > 0 else None,
+                      output_bytes=_output_bytes(workdir, paths, t_start))
+    except Exception:  # pylint: disable=broad-except
+        result.update(status='error', error=traceback.format_exc(limit=3))
+    finally:
+        os.chdir(cwd)
+        DS.clear()
+        DS.__class__.allow_overwrite = allow_overwrite
+    rss_after = peak_rss()
+    result.update(peak_rss=rss_after,
+                  peak_rss_increase=None if rss_after is None else rss_after - rss_before)
+    return result
+
+
+def _output_bytes(workdir, paths, t_start):
+    """Return the total size of the files written in workdir since t_start, excluding the inputs and models"""
+    inputs = {os.path.abspath(path) for path in paths.values()}
+    total = 0
+    for filename in os.listdir(workdir):
+        path = os.path.abspath(os.path.join(workdir, filename))
+        if path in inputs or not os.path.isfile(path) or filename.startswith('bench_model'):
+            continue
+        if os.path.getmtime(path) >= t_start:
+            total += os.path.getsize(path)
+    return total
+
+
+def _environment():
+    """Describe the code and machine the benchmarks are run on"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=RAILDIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):  #pragma: no cover
+        commit = None
+    return dict(commit=commit, python=platform.python_version(), numpy=np.__version__,
+                machine=platform.node(), cpu_count=os.cpu_count(),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def run_benchmarks(sizes, workdir, cases=None, only=None, ntrain=10_000, isolate=True, seed=0):
+    """Run the benchmarks for all the catalog sizes
+
+    Parameters
+    ----------
+    sizes : list[int]
+        Numbers of objects in the catalogs
+    workdir : str
+        Directory for the input and output files
+    cases : list[BenchmarkCase] or None
+        The cases to run, None for `default_cases()`
+    only : list[str] or None
+        If not None, only run the cases with these names
+    ntrain : int
+        Maximum number of objects in the training catalogs
+    isolate : bool
+        If True, run each case in a fresh process, so that the peak memory is measured independently
+    seed : int
+        Random number seed for the synthetic catalogs
+
+    Returns
+    -------
+    results : dict
+        'environment', 'skipped', the algorithms that could not be imported,
+        and 'results', one entry per case and size
+    """
+    skipped = {}
+    if cases is None:
+        cases, skipped = default_cases()
+    if only is not None:
+        cases = [case for case in cases if case.name in only]
+    results = []
+    for nrows in sizes:
+        size_dir = os.path.abspath(os.path.join(workdir, f'n{nrows}'))
+        paths = write_benchmark_inputs(size_dir, nrows, ntrain=ntrain, seed=seed)
+        for case in cases:
+            print(f"Benchmarking {case.name} on {nrows} rows")
+            if isolate:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    result = pool.submit(run_case, case, paths, nrows, size_dir).result()
+            else:
+                result = run_case(case, paths, nrows, size_dir)
+            if result['status'] != 'ok':
+                print(f"  failed: {result['error'].splitlines()[-1]}")
+            results.append(result)
+    return dict(environment=_environment(), skipped=skipped, results=results)
+
+
+def compare_results(baseline, current, threshold=0.2, min_seconds=0.05, min_bytes=16 * 1024**2):
+    """Find the cases that got slower, or used more memory or disk space, than in a baseline
+
+    Parameters
+    ----------
+    baseline : dict
+        Results of `run_benchmarks()` for the reference commit
+    current : dict
+        Results of `run_benchmarks()` for the commit being tested
+    threshold : float
+        Relative increase above which a change is flagged as a regression
+    min_seconds : float
+        Changes in time smaller than this are ignored, as they are dominated by noise
+    min_bytes : int
+        Changes in memory smaller than this are ignored
+
+    Returns
+    -------
+    regressions : list[dict]
+        One entry per regression, with the case, nrows, metric, baseline and current values, and their ratio
+    """
+    reference = {(result['case'], result['nrows']): result for result in baseline['results']
+                 if result['status'] == 'ok'}
+    regressions = []
+    for result in current['results']:
+        ref = reference.get((result['case'], result['nrows']))
+        if ref is None:
+            continue
+        if result['status'] != 'ok':
+            regressions.append(dict(case=result['case'], nrows=result['nrows'], metric='status',
+                                    baseline='ok', current=result['status'], ratio=None))
+            continue
+        for metric, floor in [('inform_seconds', min_seconds), ('run_seconds', min_seconds),
+                              ('peak_rss_increase', min_bytes), ('output_bytes', min_bytes)]:
+            old, new = ref.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            if new - old > max(threshold * old, floor):
+                regressions.append(dict(case=result['case'], nrows=result['nrows'], metric=metric,
+                                        baseline=old, current=new, ratio=new / old if old > 0 else None))
+    return regressions
+
+
+def _print_results(results):
+    """Print a table of benchmark results"""
+    print(f"{'case':<28} {'nrows':>10} {'inform [s]':>11} {'run [s]':>10} {'rows/s':>12} {'output [MB]':>12} "
+          f"{'peak RSS [MB]':>14}")
+    for result in results['results']:
+        if result['status'] != 'ok':
+            print(f"{result['case']:<28} {result['nrows']:>10} {'error':>11}")
+            continue
+        inform = f"{result['inform_seconds']:.3f}" if result['inform_seconds'] is not None else '-'
+        rows_per_sec = f"{result['rows_per_sec']:.4g}" if result['rows_per_sec'] is not None else '-'
+        rss = f"{result['peak_rss'] / 1024**2:.1f}" if result['peak_rss'] is not None else '-'
+        output = f"{result['output_bytes'] / 1024**2:.2f}" if result.get('output_bytes') is not None else '-'
+        print(f"{result['case']:<28} {result['nrows']:>10} {inform:>11} {result['run_seconds']:>10.3f} "
+              f"{rows_per_sec:>12} {output:>12} {rss:>14}")
+        if result.get('recall_at_k') is not None:
+            print(f"{'':<28} recall@k {result['recall_at_k']:.4f}, CDE loss {result['cde_loss']:.4f} "
+                  f"(exact {result['exact_cde_loss']:.4f})")
+    for module_name, reason in results.get('skipped', {}).items():
+        print(f"skipped {module_name}: {reason}")
+
+
+def main(argv=None):
+    """Command line interface, see the module docstring"""
+    parser = argparse.ArgumentParser(description="RAIL performance benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Run the benchmarks")
+    run_parser.add_argument('--sizes', nargs='+', type=float, default=[1e4],
+                            help="Numbers of objects in the synthetic catalogs")
+    run_parser.add_argument('--ntrain', type=int, default=10_000,
+                            help="Maximum number of objects in the training catalogs")
+    run_parser.add_argument('--only', nargs='+', default=None, help="Only run these algorithms")
+    run_parser.add_argument('--workdir', default='rail_benchmark', help="Directory for the input and output files")
+    run_parser.add_argument('--output', default=None, help="JSON file to write the results to")
+    run_parser.add_argument('--no-isolate', action='store_true',
+                            help="Run all the algorithms in this process, the memory measurements are then cumulative")
+
+    compare_parser = subparsers.add_parser('compare', help="Compare results to a baseline")
+    compare_parser.add_argument('baseline', help="JSON results for the reference commit")
+    compare_parser.add_argument('current', help="JSON results for the commit being tested")
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help="Relative increase flagged as a regression")
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        results = run_benchmarks([int(size) for size in args.sizes], args.workdir, only=args.only,
+                                 ntrain=args.ntrain, isolate=not args.no_isolate)
+        _print_results(results)
+        if args.output:
+            with open(args.output, 'w') as fout:
+                json.dump(results, fout, indent=1)
+        return 0
+
+    with open(args.baseline) as fin:
+        baseline = json.load(fin)
+    with open(args.current) as fin:
+        current = json.load(fin)
+    regressions = compare_results(baseline, current, threshold=args.threshold)
+    print(f"Comparing {current['environment'].get('commit')} to {baseline['environment'].get('commit')}")
+    for reg in regressions:
+        ratio = f" ({reg['ratio']:.2f}x)" if reg['ratio'] is not None else ''
+        print(f"REGRESSION {reg['case']} n={reg['nrows']} {reg['metric']}: {reg['baseline']} -> {reg['current']}{ratio}")
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':  #pragma: no cover
+    sys.exit(main())
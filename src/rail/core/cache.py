@@ -0,0 +1,307 @@
+"""Content-addressed cache of RailStage results
+
+A cache entry holds the output files of one run of a stage.  It is keyed on
+the class of the stage, its resolved configuration, the version of the code
+and the content of its inputs, so re-running a stage with the same
+configuration on the same data reuses the stored outputs instead of
+re-computing them.  See `RailStage` and its `cache_dir` configuration option.
+
+Each entry is a sub-directory of the cache directory, named after its key,
+with the output files and an `entry.json` file describing them.  The
+modification time of `entry.json` is the last time the entry was used, and
+the least recently used entries are evicted once the cache grows past its
+size limit.
+
+Usage::
+
+    python -m rail.core.cache list CACHE_DIR
+    python -m rail.core.cache prune CACHE_DIR --max-size 1024
+    python -m rail.core.cache remove CACHE_DIR KEY [KEY ...]
+    python -m rail.core.cache clear CACHE_DIR
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+
+ENTRY_FILE = 'entry.json'
+
+# Configuration parameters that change how a stage runs, but not its results
+CACHE_IGNORED_CONFIG = ['name', 'config', 'aliases', 'output_mode', 'prefetch_depth', 'memmap_inputs',
+                        'memory_budget', 'metrics_file', 'metrics_prom_file', 'trace_memory',
+                        'write_behind_depth', 'parallel_backend', 'num_workers', 'num_threads', 'leafsize',
+                        'shared_model', 'cache_dir', 'cache_size_limit']
+
+# Digests of the files already hashed, keyed by (path, size, modification time)
+_FILE_DIGESTS = {}
+
+
+def file_digest(path, block_size=1024**2):
+    """Return the sha256 digest of the content of a file
+
+    The digests are remembered, so a file is only read again if its size or
+    modification time changed.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    file_key = (path, stat.st_size, stat.st_mtime_ns)
+    digest = _FILE_DIGESTS.get(file_key)
+    if digest is None:
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(block_size), b''):
+                hasher.update(block)
+        digest = hasher.hexdigest()
+        _FILE_DIGESTS[file_key] = digest
+    return digest
+
+
+def data_digest(data):
+    """Return the sha256 digest of in-memory data, or None if they can not be pickled"""
+    try:
+        return hashlib.sha256(pickle.dumps(data, protocol=4)).hexdigest()
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def code_version(stage_class):
+    """Return a digest of the version of the code used by a stage
+
+    This combines `rail.core.__version__` with the content of the source files
+    of all the rail classes the stage inherits from, so that editing the
+    algorithm, or any of its base classes, invalidates the cached results.
+    """
+    from rail.core import __version__  # pylint: disable=import-outside-toplevel
+    hasher = hashlib.sha256(__version__.encode())
+    for cls in stage_class.__mro__:
+        if not cls.__module__.startswith('rail.'):
+            continue
+        try:
+            source_file = inspect.getsourcefile(cls)
+        except TypeError:  #pragma: no cover
+            source_file = None
+        if source_file is not None and os.path.exists(source_file):
+            hasher.update(file_digest(source_file).encode())
+    return hasher.hexdigest()
+
+
+def stage_cache_key(stage):
+    """Return the cache key for the current configuration and inputs of a stage
+
+    Parameters
+    ----------
+    stage : RailStage
+        The stage
+
+    Returns
+    -------
+    key : str or None
+        The key, or None if the stage can not be cached, e.g., because one of its
+        inputs is neither in a file nor in memory, or can not be pickled
+    """
+    tags = set(stage.input_tags()) | set(stage.output_tags())
+    config = {key: val for key, val in stage.config.to_dict().items()
+              if key not in CACHE_IGNORED_CONFIG and key not in tags}
+    inputs = {}
+    for tag in stage.input_tags():
+        handle = stage.data_store.get(stage.get_aliased_tag(tag))
+        if handle is not None and handle.is_written:
+            inputs[tag] = file_digest(handle.path)
+        elif handle is not None and handle.has_data:
+            inputs[tag] = data_digest(handle.data)
+        else:
+            path = stage.get_input(stage.get_aliased_tag(tag))
+            inputs[tag] = file_digest(path) if path and os.path.exists(path) else None
+        if inputs[tag] is None:
+            return None
+    stage_class = type(stage)
+    description = dict(stage=f'{stage_class.__module__}.{stage_class.__qualname__}',
+                       config=config, code=code_version(stage_class), inputs=inputs)
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+class StageCache:
+    """A directory of cached stage outputs, with a size limit
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory holding the cache entries, it is created if needed
+    max_bytes : int or None
+        Size limit of the cache, the least recently used entries are evicted
+        when it is exceeded.  None means no limit.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def entry_dir(self, key):
+        """Return the directory of the entry for a key"""
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key):
+        """Return the description of the entry for a key, or None if it is not in the cache
+
+        This marks the entry as used, so it is the last one to be evicted.
+        """
+        entry_file = os.path.join(self.entry_dir(key), ENTRY_FILE)
+        try:
+            with open(entry_file) as fin:
+                entry = json.load(fin)
+            os.utime(entry_file)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def restore(self, key, tag, path):
+        """Copy the output file for one tag of a cache entry to `path`"""
+        entry = self.lookup(key)
+        if entry is None:  #pragma: no cover
+            raise KeyError(f"No entry {key} in cache {self.cache_dir}")
+        outdir = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(outdir):  #pragma: no cover
+            os.makedirs(outdir, exist_ok=True)
+        shutil.copyfile(os.path.join(self.entry_dir(key), entry['outputs'][tag]), path)
+
+    def store(self, key, outputs, **metadata):
+        """Add an entry to the cache, and evict old entries if the cache is too large
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry
+        outputs : dict[str, str]
+            The paths to the output files, keyed by tag
+        metadata : dict
+            Added to the description of the entry
+
+        Notes
+        -----
+        The entry is written to a temporary directory that is renamed once complete,
+        so other processes never see a partially written entry.
+        """
+        if self.lookup(key) is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = os.path.join(self.cache_dir, f'.tmp-{key}-{os.getpid()}')
+        os.makedirs(tmp_dir, exist_ok=True)
+        entry = dict(key=key, created=time.time(), outputs={}, nbytes=0, **metadata)
+        for i, (tag, path) in enumerate(outputs.items()):
+            filename = f'{i}_{os.path.basename(path)}'
+            shutil.copyfile(path, os.path.join(tmp_dir, filename))
+            entry['outputs'][tag] = filename
+            entry['nbytes'] += os.path.getsize(path)
+        with open(os.path.join(tmp_dir, ENTRY_FILE), 'w') as fout:
+            json.dump(entry, fout, indent=1)
+        try:
+            os.rename(tmp_dir, self.entry_dir(key))
+        except OSError:  #pragma: no cover
+            # another process stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes)
+
+    def entries(self):
+        """Return the descriptions of all the entries, least recently used first
+
+        Each description has a 'last_used' field, with the time the entry was last used.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_file = os.path.join(self.entry_dir(key), ENTRY_FILE)
+            try:
+                with open(entry_file) as fin:
+                    entry = json.load(fin)
+                entry['last_used'] = os.path.getmtime(entry_file)
+            except (OSError, ValueError):
+                continue
+            entries.append(entry)
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    def total_bytes(self):
+        """Return the size of all the entries, in bytes"""
+        return sum(entry['nbytes'] for entry in self.entries())
+
+    def remove(self, key):
+        """Remove the entry for a key"""
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+
+    def prune(self, max_bytes):
+        """Evict the least recently used entries until the cache is no larger than `max_bytes`
+
+        Returns
+        -------
+        removed : list[str]
+            The keys of the evicted entries
+        """
+        entries = self.entries()
+        total = sum(entry['nbytes'] for entry in entries)
+        removed = []
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            self.remove(entry['key'])
+            total -= entry['nbytes']
+            removed.append(entry['key'])
+        if removed:
+            print(f"Evicted {len(removed)} entries from stage cache {self.cache_dir}, "
+                  f"{total / 1024**2:.1f} MB left")
+        return removed
+
+    def clear(self):
+        """Remove all the entries"""
+        for entry in self.entries():
+            self.remove(entry['key'])
+
+
+def main(argv=None):
+    """Command line interface, see the module docstring"""
+    parser = argparse.ArgumentParser(description="Inspect and prune a RAIL stage result cache")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list', help="List the entries, least recently used first")
+    list_parser.add_argument('cache_dir', help="The cache directory")
+    prune_parser = subparsers.add_parser('prune', help="Evict the least recently used entries")
+    prune_parser.add_argument('cache_dir', help="The cache directory")
+    prune_parser.add_argument('--max-size', type=float, required=True, help="Size, in MB, to prune the cache to")
+    remove_parser = subparsers.add_parser('remove', help="Remove some entries")
+    remove_parser.add_argument('cache_dir', help="The cache directory")
+    remove_parser.add_argument('keys', nargs='+', help="The keys of the entries, or unique prefixes of them")
+    clear_parser = subparsers.add_parser('clear', help="Remove all the entries")
+    clear_parser.add_argument('cache_dir', help="The cache directory")
+
+    args = parser.parse_args(argv)
+    cache = StageCache(args.cache_dir)
+    if args.command == 'list':
+        entries = cache.entries()
+        print(f"{'key':<16} {'stage':<28} {'size [MB]':>10} {'last used':>20}")
+        for entry in entries:
+            last_used = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_used']))
+            print(f"{entry['key'][:16]:<16} {entry.get('stage', '-'):<28} "
+                  f"{entry['nbytes'] / 1024**2:>10.2f} {last_used:>20}")
+        print(f"{len(entries)} entries, {sum(entry['nbytes'] for entry in entries) / 1024**2:.2f} MB")
+    elif args.command == 'prune':
+        cache.prune(args.max_size * 1024**2)
+    elif args.command == 'remove':
+        keys = [entry['key'] for entry in cache.entries()]
+        for prefix in args.keys:
+            matches = [key for key in keys if key.startswith(prefix)]
+            if len(matches) != 1:
+                print(f"{prefix} matches {len(matches)} entries, not removing anything")
+                continue
+            cache.remove(matches[0])
+    else:
+        cache.clear()
+    return 0
+
+
+if __name__ == '__main__':  #pragma: no cover
+    sys.exit(main())
@@ -1,10 +1,23 @@
 """Rail-specific data management"""
 
 import os
+import tempfile
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+import pandas as pd
 import tables_io
 import pickle
 import qp
 
+from rail.core.array_model import ARRAY_MODEL_SUFFIX, is_array_model, read_array_model, write_array_model
+from rail.core.instrumentation import data_nbytes
+
+fits = tables_io.lazy_modules.lazyImport('astropy.io.fits')
+pa = tables_io.lazy_modules.lazyImport('pyarrow')
+pq = tables_io.lazy_modules.lazyImport('pyarrow.parquet')
+
 
 
 class DataHandle:
@@ -33,6 +46,7 @@ class DataHandle:
         self.fileObj = None
         self.groups = None
         self.partial = False
+        self.dirty = data is not None
 
     def open(self, **kwargs):
         """Open and return the associated file
@@ -56,10 +70,19 @@ class DataHandle:
         self.fileObj = None
 
     def read(self, force=False, **kwargs):
-        """Read and return the data from the associated file """
+        """Read and return the data from the associated file
+
+        Notes
+        -----
+        If only some of the columns or rows are read, by passing `columns`, `start`
+        or `end`, the data are flagged as partial, so that calling the handle will
+        re-read the full data.
+        """
         if self.data is not None and not force:
             return self.data
-        self.set_data(self._read(self.path, **kwargs))
+        partial = any(kwargs.get(key) is not None for key in ['columns', 'start', 'end'])
+        self.set_data(self._read(self.path, **kwargs), partial=partial)
+        self.dirty = False
         return self.data
 
     def __call__(self, **kwargs):
@@ -81,7 +104,9 @@ class DataHandle:
         outdir = os.path.dirname(os.path.abspath(self.path))
         if not os.path.exists(outdir):  #pragma: no cover
             os.makedirs(outdir, exist_ok=True)
-        return self._write(self.data, self.path, **kwargs)
+        ret = self._write(self.data, self.path, **kwargs)
+        self.dirty = False
+        return ret
 
     @classmethod
     def _write(cls, data, path, **kwargs):
@@ -97,13 +122,19 @@ class DataHandle:
     def _initialize_write(cls, data, path, data_lenght, **kwargs):
         raise NotImplementedError("DataHandle._initialize_write") #pragma: no cover
 
-    def write_chunk(self, start, end, **kwargs):
-        """Write the data to the associatied file """
-        if self.data is None:
+    def write_chunk(self, start, end, data=None, **kwargs):
+        """Write the data to the associatied file
+
+        If `data` is given it is written instead of `self.data`, this allows
+        a chunk to be written after the handle has moved on to the next one.
+        """
+        if data is None:
+            data = self.data
+        if data is None:
             raise ValueError(f"TableHandle.write_chunk() called for path {self.path} with no data")
         if self.fileObj is None:
             raise ValueError(f"TableHandle.write_chunk() called before open for {self.tag} : {self.path}")
-        return self._write_chunk(self.data, self.fileObj, self.groups, start, end, **kwargs)
+        return self._write_chunk(data, self.fileObj, self.groups, start, end, **kwargs)
 
 
     @classmethod
@@ -115,6 +146,7 @@ class DataHandle:
         if self.fileObj is None:  #pragma: no cover
             raise ValueError(f"TableHandle.finalize_wite() called before open for {self.tag} : {self.path}")
         self._finalize_write(self.data, self.fileObj, **kwargs)
+        self.dirty = False
 
     @classmethod
     def _finalize_write(cls, data, fileObj, **kwargs):
@@ -128,9 +160,14 @@ class DataHandle:
         return self._iterator(self.path, **kwargs)
 
     def set_data(self, data, partial=False):
-        """Set the data for a chunk, and set the partial flag to true"""
+        """Set the data for a chunk, and set the partial flag to true
+
+        The data are flagged as dirty, i.e., not saved to the associated file,
+        until `write()` or `finalize_write()` is called.
+        """
         self.data = data
         self.partial = partial
+        self.dirty = data is not None
 
     def size(self, **kwargs):
         """Return the size of the data associated to this handle"""
@@ -200,8 +237,24 @@ class TableHandle(DataHandle):
         return tables_io.io.io_open(path, **kwargs)  #pylint: disable=no-member
 
     @classmethod
-    def _read(cls, path, **kwargs):
-        """Read and return the data from the associated file """
+    def _read(cls, path, columns=None, memmap=False, **kwargs):
+        """Read and return the data from the associated file
+
+        Notes
+        -----
+        If `columns` is not None, only those columns are read from hdf5 and parquet
+        files.  Requested columns that are not in the file are silently skipped.
+
+        If `memmap` is True, contiguous, uncompressed datasets in hdf5 files are returned as
+        read-only `numpy.memmap` views of the file rather than being copied into memory.
+        Chunked or compressed datasets are read normally.
+        """
+        if columns is not None or memmap:
+            file_type = tables_io.types.fileType(path)
+            if file_type == tables_io.types.NUMPY_HDF5:
+                return _read_hdf5_columns(path, columns, memmap=memmap)
+            if file_type == tables_io.types.PANDAS_PARQUET and columns is not None:
+                return _read_pq_columns(path, columns)
         return tables_io.read(path, **kwargs)
 
     @classmethod
@@ -211,15 +264,220 @@ class TableHandle(DataHandle):
 
     @classmethod
     def _size(cls, path, **kwargs):
+        if is_parquet_file(path):
+            return pq.ParquetFile(path).metadata.num_rows
         return tables_io.io.getInputDataLengthHdf5(path, **kwargs)
 
     @classmethod
-    def _iterator(cls, path, **kwargs):
-        """Iterate over the data"""
+    def _iterator(cls, path, columns=None, **kwargs):
+        """Iterate over the data
+
+        Notes
+        -----
+        If `columns` is not None, only those columns are read from the file.
+        """
+        if is_parquet_file(path):
+            return _iter_pq(path, columns=columns, **kwargs)
+        if columns is not None and tables_io.types.fileType(path) == tables_io.types.NUMPY_HDF5:
+            return _iter_hdf5_columns(path, columns, **kwargs)
         return tables_io.iteratorNative(path, **kwargs)
 
+    def row_bytes(self, columns=None, groupname=None):
+        """Return the size, in bytes, of one row of the table in the associated file
+
+        Parameters
+        ----------
+        columns : list[str] or None
+            If not None, only count these columns
+        groupname : str or None
+            The group holding the table, for hdf5 files
+        """
+        return self._row_bytes(self.path, columns=columns, groupname=groupname)
+
+    @classmethod
+    def _row_bytes(cls, path, columns=None, groupname=None):
+        if is_parquet_file(path):
+            return _pq_row_bytes(path, columns)
+        if tables_io.types.fileType(path) == tables_io.types.NUMPY_HDF5:
+            return _hdf5_row_bytes(path, columns, groupname)
+        raise NotImplementedError(f"TableHandle.row_bytes() is not implemented for {path}")
+
+
+def _hdf5_row_bytes(path, columns=None, groupname=None):
+    """Return the size, in bytes, of one row of the datasets in a group of an hdf5 file"""
+    nbytes = 0
+    with h5py.File(path, 'r') as fin:
+        group = fin[groupname] if groupname else fin
+        for key, val in group.items():
+            if isinstance(val, h5py.Dataset) and (columns is None or key in columns):
+                nbytes += val.dtype.itemsize * int(np.prod(val.shape[1:]))
+    return nbytes
+
+
+def _pq_row_bytes(path, columns=None):
+    """Return the size, in bytes, of one row of a parquet file once read into memory
+
+    Variable width columns are counted using their average uncompressed size in the file.
+    """
+    pq_file = pq.ParquetFile(path)
+    metadata = pq_file.metadata
+    nbytes = 0.
+    for icol, field in enumerate(pq_file.schema_arrow):
+        if columns is not None and field.name not in columns:
+            continue
+        try:
+            nbytes += field.type.bit_width // 8
+        except ValueError:
+            total = sum(metadata.row_group(irg).column(icol).total_uncompressed_size
+                        for irg in range(metadata.num_row_groups))
+            nbytes += total / max(metadata.num_rows, 1)
+    return nbytes
+
+
+def _read_hdf5_dataset(path, dataset, memmap=False):
+    """Read an hdf5 dataset, possibly as a read-only memory map
+
+    Only datasets that are stored contiguously and without filters can be mapped,
+    for all the others this falls back to copying the data into memory.
+    """
+    if memmap and dataset.chunks is None and dataset.size and not dataset.dtype.hasobject:
+        offset = dataset.id.get_offset()
+        if offset is not None:
+            return np.memmap(path, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+    return tables_io.io.readHdf5DatasetToArray(dataset)
+
+
+def _read_hdf5_columns(path, columns=None, memmap=False):
+    """Read some or all of the columns from an hdf5 file
+
+    This follows the same structure as `tables_io.read`, i.e., it returns a
+    dict of dicts of arrays, one per group, unless there is a single default group.
+    """
+    odict = OrderedDict()
+    with h5py.File(path, 'r') as fin:
+        for key, val in fin.items():
+            if isinstance(val, h5py.Dataset):
+                if columns is None or key in columns:
+                    odict[key] = _read_hdf5_dataset(path, val, memmap)
+                continue
+            keys = list(val.keys()) if columns is None else [col for col in columns if col in val]
+            odict[key] = OrderedDict([(col, _read_hdf5_dataset(path, val[col], memmap)) for col in keys])
+    if len(odict) == 1:
+        for def_name in ['', None, '__astropy_table__', 'data']:
+            if def_name in odict:
+                return odict[def_name]
+    return odict
+
+
+def _read_pq_columns(path, columns):
+    """Read only some of the columns from a parquet file into a `pandas.DataFrame`"""
+    schema_names = pq.read_schema(path).names
+    return pd.read_parquet(path, engine='pyarrow', columns=[col for col in columns if col in schema_names])
+
+
+def _iter_hdf5_columns(path, columns, chunk_size=100_000, groupname=None, rank=0, parallel_size=1):
+    """Iterate over only some of the columns of a group in an hdf5 file
+
+    This has the same signature and yields the same `(start, end, data)` tuples
+    as `tables_io.io.iterHdf5ToDict`.
+    """
+    group, infp = tables_io.io.readHdf5Group(path, groupname)
+    num_rows = tables_io.arrayUtils.getGroupInputDataLength(group)
+    keys = [col for col in columns if col in group]
+    for start, end in tables_io.io.data_ranges_by_rank(num_rows, chunk_size, parallel_size, rank):
+        data = OrderedDict([(key, tables_io.io.readHdf5DatasetToArray(group[key], start, end)) for key in keys])
+        yield start, end, data
+    infp.close()
+
+
+def data_length(data):
+    """Return the number of rows of in-memory data
+
+    This handles `qp.Ensemble`, `pandas.DataFrame`, numpy arrays and dicts of arrays.
+    """
+    if isinstance(data, qp.Ensemble):
+        return data.npdf
+    if isinstance(data, dict):
+        return len(next(iter(data.values()))) if data else 0
+    return len(data)
+
+
+def slice_data(data, start, end):
+    """Return the rows start:end of in-memory data
+
+    The slices of numpy arrays, dicts of arrays and `pandas.DataFrame` are views of
+    the original data.  A new `qp.Ensemble` is built for the rows of an ensemble.
+    """
+    if isinstance(data, qp.Ensemble):
+        return data[start:end]
+    if isinstance(data, pd.DataFrame):
+        return data.iloc[start:end]
+    if isinstance(data, dict):
+        return {key: val[start:end] for key, val in data.items()}
+    return data[start:end]
+
+
+def iterate_data(data, chunk_size=100_000, rank=0, parallel_size=1):
+    """Iterate over in-memory data by chunks, in the same way as the file iterators
+
+    Yields
+    ------
+    start : int
+        The first row of the chunk
+    end : int
+        One past the last row of the chunk
+    data : any
+        The rows of the chunk, see `slice_data()`
+    """
+    for start, end in tables_io.io.data_ranges_by_rank(data_length(data), chunk_size, parallel_size, rank):
+        yield start, end, slice_data(data, start, end)
+
+
+def is_parquet_file(path):
+    """Return True if `path` has one of the suffixes tables_io uses for parquet files"""
+    suffix = os.path.splitext(path)[1][1:]
+    return tables_io.types.FILE_FORMAT_SUFFIXS.get(suffix) == tables_io.types.PANDAS_PARQUET
+
+
+def _iter_pq(path, chunk_size=100_000, groupname=None, rank=0, parallel_size=1, columns=None):  #pylint: disable=unused-argument
+    """Iterate over a parquet file, reading only the row groups needed for each chunk
+
+    This yields the same `(start, end, data)` tuples, and splits the rows between
+    processes the same way, as `tables_io.io.iterHdf5ToDict`, with the data
+    given as a `pandas.DataFrame`.  `groupname` is accepted for compatibility with
+    the hdf5 iterator, but ignored.
+    """
+    pq_file = pq.ParquetFile(path)
+    metadata = pq_file.metadata
+    if columns is not None:
+        columns = [col for col in columns if col in pq_file.schema_arrow.names]
+    group_sizes = np.array([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)], dtype=int)
+    group_ends = np.cumsum(group_sizes)
+    group_starts = group_ends - group_sizes
+    # cache of the row groups read so far, chunks often start in the group the previous one ended in
+    cache = {}
+    for start, end in tables_io.io.data_ranges_by_rank(metadata.num_rows, chunk_size, parallel_size, rank):
+        first_group = int(np.searchsorted(group_ends, start, side='right'))
+        last_group = int(np.searchsorted(group_starts, end, side='left'))
+        groups = list(range(first_group, last_group))
+        cache = {igroup: cache[igroup] for igroup in groups if igroup in cache}
+        for igroup in groups:
+            if igroup not in cache:
+                cache[igroup] = pq_file.read_row_group(igroup, columns=columns)
+        table = pa.concat_tables([cache[igroup] for igroup in groups])
+        offset = start - group_starts[first_group]
+        yield start, end, table.slice(offset, end - start).to_pandas()
+
 class Hdf5Handle(TableHandle):
-    """DataHandle for a table written to HDF5"""
+    """DataHandle for a table written to HDF5
+
+    Notes
+    -----
+    `read(memmap=True)` returns lazy, read-only memory-mapped views of the columns
+    that are stored contiguously and uncompressed, so that tables larger than
+    the available memory can be used, and several stages in the same process
+    share the page cache rather than holding separate copies.
+    """
     suffix = 'hdf5'
 
     @classmethod
@@ -246,15 +504,172 @@ class Hdf5Handle(TableHandle):
     def _finalize_write(cls, data, fileObj, **kwargs):
         return tables_io.io.finalizeHdf5Write(fileObj, **kwargs)
 
+class _SequentialChunkWriter:
+    """Base class for the writers used by file formats that can only be written in order
+
+    Parameters
+    ----------
+    path : str
+        The path to the file being written
+    data_lenght : int
+        The total number of rows that will be written
+    """
+
+    def __init__(self, path, data_lenght):
+        self.path = path
+        self.data_lenght = data_lenght
+        self.nrow = 0
+
+    def write(self, data, start, end):
+        """Write the rows `start:end`, which must follow the ones already written"""
+        if start != self.nrow:
+            raise ValueError(f"Chunks of {self.path} must be written in order, "
+                             f"expected a chunk starting at row {self.nrow}, got {start}")
+        if end > self.data_lenght:
+            raise ValueError(f"Chunk {start}:{end} is past the end of {self.path}, "
+                             f"which was allocated {self.data_lenght} rows")
+        self._write(data, end - start)
+        self.nrow = end
+
+    def _write(self, data, nrow):
+        raise NotImplementedError("_SequentialChunkWriter._write")  #pragma: no cover
+
+    def close(self):
+        """Check that all the rows were written and close the file"""
+        if self.nrow != self.data_lenght:
+            raise ValueError(f"{self.path} was closed after writing {self.nrow} "
+                             f"of {self.data_lenght} rows")
+
+
+class _PqChunkWriter(_SequentialChunkWriter):
+    """Write a parquet file row group by row group"""
+
+    def __init__(self, path, data_lenght, schema, row_group_size=None):
+        super().__init__(path, data_lenght)
+        self.row_group_size = row_group_size
+        self.writer = pq.ParquetWriter(path, schema)
+        self.pending = []
+        self.npending = 0
+
+    def _write(self, data, nrow):
+        table = _to_arrow_table(data).select(self.writer.schema.names).cast(self.writer.schema)
+        if len(table) != nrow:
+            raise ValueError(f"Chunk of {len(table)} rows does not match the {nrow} rows requested")
+        if self.row_group_size is None:
+            self.writer.write_table(table)
+            return
+        self.pending.append(table)
+        self.npending += nrow
+        if self.npending >= self.row_group_size:
+            self._flush(final=False)
+
+    def _flush(self, final):
+        """Write the buffered rows as row groups of `row_group_size` rows"""
+        table = pa.concat_tables(self.pending)
+        nfull = len(table) if final else (len(table) // self.row_group_size) * self.row_group_size
+        if nfull:
+            self.writer.write_table(table.slice(0, nfull), row_group_size=self.row_group_size)
+        rest = table.slice(nfull)
+        self.pending = [rest] if len(rest) else []
+        self.npending = len(rest)
+
+    def close(self):
+        if self.pending:
+            self._flush(final=True)
+        self.writer.close()
+        super().close()
+
+
+class _FitsChunkWriter(_SequentialChunkWriter):
+    """Write a fits binary table by streaming the rows after a pre-sized header"""
+
+    def __init__(self, path, data_lenght, data):
+        super().__init__(path, data_lenght)
+        hdu = fits.table_to_hdu(tables_io.convert(data, tables_io.types.AP_TABLE))
+        header = hdu.header.copy()
+        header['NAXIS2'] = data_lenght
+        self.row_dtype = hdu.data.dtype.newbyteorder('>')
+        if os.path.exists(path):
+            os.unlink(path)
+        self.stream = fits.StreamingHDU(path, header)
+
+    def _write(self, data, nrow):
+        rows = np.asarray(fits.table_to_hdu(tables_io.convert(data, tables_io.types.AP_TABLE)).data)
+        if len(rows) != nrow:
+            raise ValueError(f"Chunk of {len(rows)} rows does not match the {nrow} rows requested")
+        # the fits binary table is declared as a byte stream, with big-endian rows
+        self.stream.write(rows.astype(self.row_dtype).view(np.uint8).ravel())
+
+    def close(self):
+        self.stream.close()
+        super().close()
+
+
+def _to_arrow_table(data):
+    """Convert a `pandas.DataFrame` or a dict of arrays to a `pyarrow.Table`"""
+    if isinstance(data, pd.DataFrame):
+        return pa.Table.from_pandas(data, preserve_index=False)
+    return pa.table(dict(data))
+
+
+def _check_serial_write(path, comm):
+    """Raise if several processes try to write the same file in a format that does not support it"""
+    if comm is not None and comm.Get_size() > 1:  #pragma: no cover
+        raise NotImplementedError(f"{path} can not be written by chunks from several processes, "
+                                  "use an hdf5 output instead")
+
+
 class FitsHandle(TableHandle):
-    """DataHandle for a table written to fits"""
+    """DataHandle for a table written to fits
+
+    Notes
+    -----
+    Writing by chunks streams the rows into a binary table whose size is fixed
+    by `initialize_write`, the chunks must be written in order.
+    """
     suffix = 'fits'
 
+    @classmethod
+    def _initialize_write(cls, data, path, data_lenght, **kwargs):
+        _check_serial_write(path, kwargs.get('communicator', None))
+        return None, _FitsChunkWriter(path, data_lenght, data)
+
+    @classmethod
+    def _write_chunk(cls, data, fileObj, groups, start, end, **kwargs):
+        fileObj.write(data, start, end)
+
+    @classmethod
+    def _finalize_write(cls, data, fileObj, **kwargs):
+        fileObj.close()
+
 
 class PqHandle(TableHandle):
-    """DataHandle for a parquet table"""
+    """DataHandle for a parquet table
+
+    Notes
+    -----
+    Writing by chunks appends row groups to the file, the chunks must be written
+    in order.  By default each chunk is written as one row group, so that the row
+    groups are aligned with the `chunk_size` of the stage writing the file and can
+    be read back one chunk at a time.  Passing `row_group_size` to `initialize_write`
+    buffers the chunks and writes row groups of that many rows instead.
+    """
     suffix = 'pq'
 
+    @classmethod
+    def _initialize_write(cls, data, path, data_lenght, row_group_size=None, **kwargs):
+        _check_serial_write(path, kwargs.get('communicator', None))
+        schema = _to_arrow_table(data).schema.remove_metadata()
+        return None, _PqChunkWriter(path, data_lenght, schema, row_group_size=row_group_size)
+
+    @classmethod
+    def _write_chunk(cls, data, fileObj, groups, start, end, **kwargs):
+        fileObj.write(data, start, end)
+
+    @classmethod
+    def _finalize_write(cls, data, fileObj, **kwargs):
+        fileObj.close()
+
 
 class QPHandle(DataHandle):
     """DataHandle for qp ensembles
@@ -273,9 +688,97 @@ class QPHandle(DataHandle):
         return tables_io.io.io_open(path, **kwargs)  #pylint: disable=no-member
 
     @classmethod
-    def _read(cls, path, **kwargs):
-        """Read and return the data from the associated file """
-        return qp.read(path)
+    def _read(cls, path, start=None, end=None, **kwargs):
+        """Read and return the data from the associated file
+
+        If `start` or `end` are given, only those rows are read, for hdf5
+        files they are the only rows read from disk.  PDF data stored in
+        float32 are returned as float64.
+        """
+        if not h5py.is_hdf5(path):  #pragma: no cover
+            return qp.read(path)[start:end]
+        with h5py.File(path, 'r') as hdf5_file:
+            return _read_qp_rows(hdf5_file, _read_qp_meta(hdf5_file), start, end)
+
+    def read_ancil(self, columns=None):
+        """Read and return the ancillary data of the ensemble, without the PDFs
+
+        Parameters
+        ----------
+        columns : list[str] or None
+            The ancil columns to return, None for all of them
+
+        Returns
+        -------
+        ancil : dict[str, np.ndarray]
+            The ancil columns
+
+        Notes
+        -----
+        If the ensemble is in memory its ancil columns are returned, otherwise
+        only the ancil group, or only the requested columns, are read from
+        hdf5 files, and the data of the handle are left untouched.
+        """
+        if self.has_data and not self.partial:
+            ancil = self.data.ancil if self.data.ancil is not None else {}
+            return _select_ancil(ancil, columns, self.tag)
+        if self.path is None:
+            raise ValueError(f"QPHandle.read_ancil() called for {self.tag} with no data and no path")
+        return self._read_ancil(self.path, columns)
+
+    @classmethod
+    def _read_ancil(cls, path, columns=None):
+        """Read the ancil columns of the associated file"""
+        if not h5py.is_hdf5(path):  #pragma: no cover
+            ancil = qp.read(path).ancil
+            return _select_ancil(ancil if ancil is not None else {}, columns, path)
+        with h5py.File(path, 'r') as hdf5_file:
+            group = hdf5_file['ancil'] if 'ancil' in hdf5_file else {}
+            return {key: group[key][()] for key in _select_ancil(group, columns, path)}
+
+    def row_bytes(self):
+        """Return the size, in bytes, of one PDF and its ancil data once read from the associated file"""
+        return self._row_bytes(self.path)
+
+    @classmethod
+    def _row_bytes(cls, path):
+        if not h5py.is_hdf5(path):  #pragma: no cover
+            ensemble = qp.read(path)
+            return data_nbytes(ensemble) / max(ensemble.npdf, 1)
+        nbytes = 0
+        with h5py.File(path, 'r') as hdf5_file:
+            for group_name in ['data', 'ancil']:
+                for val in hdf5_file[group_name].values() if group_name in hdf5_file else []:
+                    itemsize = val.dtype.itemsize
+                    if group_name == 'data' and np.issubdtype(val.dtype, np.floating):
+                        # PDF data stored in float32 are read as float64
+                        itemsize = max(itemsize, 8)
+                    nbytes += itemsize * int(np.prod(val.shape[1:]))
+        return nbytes
+
+    @classmethod
+    def _size(cls, path, **kwargs):
+        """Return the number of PDFs in the associated file"""
+        if not h5py.is_hdf5(path):  #pragma: no cover
+            return qp.read(path).npdf
+        with h5py.File(path, 'r') as hdf5_file:
+            return len(next(iter(hdf5_file['data'].values())))
+
+    @classmethod
+    def _iterator(cls, path, chunk_size=100_000, rank=0, parallel_size=1, **kwargs):  #pylint: disable=unused-argument
+        """Iterate over the PDFs in the associated file, by chunks of `chunk_size` rows
+
+        The chunks are distributed over the MPI ranks in the same way as for tables,
+        and only the rows of each chunk are read from hdf5 files.
+        """
+        if not h5py.is_hdf5(path):  #pragma: no cover
+            yield from iterate_data(qp.read(path), chunk_size, rank, parallel_size)
+            return
+        with h5py.File(path, 'r') as hdf5_file:
+            meta = _read_qp_meta(hdf5_file)
+            num_rows = len(next(iter(hdf5_file['data'].values())))
+            for start, end in tables_io.io.data_ranges_by_rank(num_rows, chunk_size, parallel_size, rank):
+                yield start, end, _read_qp_rows(hdf5_file, meta, start, end)
 
     @classmethod
     def _write(cls, data, path, **kwargs):
@@ -283,9 +786,35 @@ class QPHandle(DataHandle):
         return data.write_to(path)
 
     @classmethod
-    def _initialize_write(cls, data, path, data_lenght, **kwargs):
+    def _initialize_write(cls, data, path, data_lenght, precision=None, compression=None, **kwargs):
+        """Initialize the file to be written by chunks
+
+        Parameters
+        ----------
+        precision : str or None
+            If given, e.g., 'float32', the floating point PDF data are stored with
+            this dtype, the chunks are converted when they are written
+        compression : str or None
+            If given, e.g., 'gzip' or 'lzf', the HDF5 compression filter applied
+            to the PDF data
+        """
         comm = kwargs.get('communicator', None)
-        return data.initializeHdf5Write(path, data_lenght, comm)
+        if not precision and not compression:
+            return data.initializeHdf5Write(path, data_lenght, comm)
+        allocation = data._get_allocation_kwds(data_lenght)  # pylint: disable=protected-access
+        groups, fout = tables_io.io.initializeHdf5Write(path, comm=comm)
+        for group_name, columns in allocation.items():
+            group = fout.create_group(group_name)
+            groups[group_name] = group
+            for key, (shape, dtype) in columns.items():
+                dataset_kwargs = {}
+                if group_name == 'data' and np.issubdtype(dtype, np.floating):
+                    if precision:
+                        dtype = np.dtype(precision)
+                    if compression:
+                        dataset_kwargs.update(compression=compression, shuffle=True)
+                group.create_dataset(key, shape, dtype, **dataset_kwargs)
+        return groups, fout
 
     @classmethod
     def _write_chunk(cls, data, fileObj, groups, start, end, **kwargs):
@@ -293,27 +822,188 @@ class QPHandle(DataHandle):
 
     @classmethod
     def _finalize_write(cls, data, fileObj, **kwargs):
-        return data.finalizeHdf5Write(fileObj)
+        # hdf5 can not store numpy unicode strings, which some representations use in their metadata
+        meta = {key: np.char.encode(val) if isinstance(val, np.ndarray) and val.dtype.kind == 'U' else val
+                for key, val in data.metadata().items()}
+        return tables_io.io.finalizeHdf5Write(fileObj, 'meta', **meta)
+
+
+def _select_ancil(ancil, columns, source):
+    """Return the requested columns of ancil data, raising a KeyError if some are missing"""
+    if columns is None:
+        return dict(ancil)
+    missing = [column for column in columns if column not in ancil]
+    if missing:
+        raise KeyError(f"Ancil columns {missing} not found in {source}")
+    return {column: ancil[column] for column in columns}
+
+
+def _read_qp_meta(hdf5_file):
+    """Read the metadata group of a qp file"""
+    return {key: val[()] for key, val in hdf5_file['meta'].items()}
+
+
+def _read_qp_rows(hdf5_file, meta, start=None, end=None):
+    """Read the rows start:end of the data and ancil groups of a qp file, and build the ensemble
+
+    PDF data stored with a reduced floating point precision are converted back to float64.
+    """
+    data = {}
+    for key, val in hdf5_file['data'].items():
+        if np.issubdtype(val.dtype, np.floating) and val.dtype.itemsize < 8:
+            data[key] = val.astype(np.float64)[start:end]
+        else:
+            data[key] = val[start:end]
+    tables = dict(meta=meta, data=data)
+    if 'ancil' in hdf5_file:
+        tables['ancil'] = {key: val[start:end] for key, val in hdf5_file['ancil'].items()}
+    return qp.from_tables(tables)
 
 
 def default_model_read(modelfile):
-    """Default function to read model files, simply used pickle.load"""
+    """Default function to read model files, simply used pickle.load
+
+    Files in the array model format are memory mapped instead, see `rail.core.array_model`
+    """
+    if is_array_model(modelfile):
+        return read_array_model(modelfile)
     return pickle.load(open(modelfile, 'rb'))
 
 
 def default_model_write(model, path):
-    """Write the model, this default implementation uses pickle"""
+    """Write the model, this default implementation uses pickle
+
+    If the path ends with `.npmodel`, the model is written in the array model format
+    instead, see `rail.core.array_model`
+    """
+    if str(path).endswith(f'.{ARRAY_MODEL_SUFFIX}'):
+        write_array_model(model, path)
+        return
     with open(path, 'wb') as fout:
         pickle.dump(obj=model, file=fout, protocol=pickle.HIGHEST_PROTOCOL)
 
 
-class ModelDict(dict):
+class ModelCache(OrderedDict):
+    """
+    A dict of objects read from files, keyed by path, that is bounded and checks that its entries are up to date
+
+    1. The least recently used entries are evicted once there are more than `max_entries`
+    of them, or the files they were read from add up to more than `max_size` MB.
+    2. The size and modification time of the file are recorded when an entry is added,
+    and `lookup()` discards the entry if the file has changed since.
+    3. The hits, misses, evictions and stale entries are counted, see `stats()`.
+
+    Parameters
+    ----------
+    max_entries : int or None
+        Maximum number of entries, None for no limit
+    max_size : float or None
+        Maximum total size, in MB, of the files of the entries, None for no limit
+    """
+
+    def __init__(self, max_entries=None, max_size=None):
+        OrderedDict.__init__(self)
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._signatures = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    @staticmethod
+    def _signature(path):
+        """Return the size and modification time of a file, or None if it does not exist"""
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def __setitem__(self, key, value):
+        """Add an entry, record the state of its file, and evict old entries if needed"""
+        OrderedDict.__setitem__(self, key, value)
+        self.move_to_end(key)
+        self._signatures[key] = self._signature(key)
+        self.evict(protect=key)
+
+    def set_limits(self, max_entries=None, max_size=None):
+        """Change the limits, and evict entries if needed"""
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.evict()
+
+    def nbytes(self):
+        """Return the total size, in bytes, of the files of the entries"""
+        return sum(signature[0] for key, signature in self._signatures.items()
+                   if signature is not None and key in self)
+
+    def evict(self, protect=None):
+        """Remove the least recently used entries until the cache is within its limits
+
+        Parameters
+        ----------
+        protect : str or None
+            Key of an entry that should not be removed, e.g., the one that was just added
+        """
+        max_bytes = None if self.max_size is None else self.max_size * 1024**2
+        for key in list(self.keys()):
+            too_many = self.max_entries is not None and len(self) > self.max_entries
+            too_large = max_bytes is not None and self.nbytes() > max_bytes
+            if not (too_many or too_large):
+                break
+            if key == protect:
+                continue
+            self.discard(key)
+            self.evictions += 1
+
+    def discard(self, key):
+        """Remove an entry, if it is there"""
+        if key in self:
+            OrderedDict.__delitem__(self, key)
+        self._signatures.pop(key, None)
+
+    def is_fresh(self, path):
+        """Return True if there is an entry for path, and its file still exists and did not change since it was added"""
+        if path not in self:
+            return False
+        signature = self._signature(path)
+        return signature is not None and signature == self._signatures.get(path)
+
+    def lookup(self, path):
+        """Return the entry for path, or None if there is none, or if it is stale
+
+        Stale entries are removed, and the entry returned is marked as the most recently used.
+        """
+        if self.is_fresh(path):
+            self.hits += 1
+            self.move_to_end(path)
+            return self[path]
+        if path in self:
+            self.stale += 1
+            self.discard(path)
+        self.misses += 1
+        return None
+
+    def stats(self):
+        """Return the number of entries, their size in bytes, and the hit, miss, eviction and stale counters"""
+        return dict(entries=len(self), nbytes=self.nbytes(), hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, stale=self.stale)
+
+    def clear(self):
+        """Remove all the entries, the counters are not reset"""
+        OrderedDict.clear(self)
+        self._signatures.clear()
+
+
+class ModelDict(ModelCache):
     """
     A specialized dict to keep track of individual estimation models objects: this is just a dict these additional features
 
     1. Keys are paths
     2. There is a read(path, force=False) method that reads a model object and inserts it into the dictionary
     3. There is a single static instance of this class
+    4. It is bounded, and re-reads models whose file changed, see `ModelCache`
     """
     def open(self, path, mode, **kwargs):  #pylint: disable=no-self-use
         """Open the file and return the file handle"""
@@ -323,19 +1013,19 @@ class ModelDict(dict):
         """Read a model into this dict"""
         if reader is None:
             reader = default_model_read
-        if force or path not in self:
+        model = None if force else self.lookup(path)
+        if model is None:
             model = reader(path)
             self.__setitem__(path, model)
-            return model
-        return self[path]
+        return model
 
     def write(self, model, path, force=False, writer=None, **kwargs):  #pylint: disable=unused-argument
         """Write the model, this default implementation uses pickle"""
         if writer is None:
             writer = default_model_write
-        if force or path not in self:
-            self.__setitem__(path, model)
+        if force or dict.get(self, path) is not model or not self.is_fresh(path):
             writer(model, path)
+            self.__setitem__(path, model)
 
 
 
@@ -344,7 +1034,7 @@ class ModelHandle(DataHandle):
     """
     suffix = 'pkl'
 
-    model_factory = ModelDict()
+    model_factory = ModelDict(max_entries=32)
 
     @classmethod
     def _open(cls, path, **kwargs):
@@ -367,7 +1057,7 @@ class ModelHandle(DataHandle):
 
 
 
-class FlowDict(dict):
+class FlowDict(ModelCache):
     """
     A specialized dict to keep track of individual flow objects: this is just a dict these additional features
 
@@ -375,6 +1065,7 @@ class FlowDict(dict):
     2. Values are flow objects, this is checked at runtime.
     3. There is a read(path, force=False) method that reads a flow object and inserts it into the dictionary
     4. There is a single static instance of this class
+    5. It is bounded, and re-reads flows whose file changed, see `ModelCache`
     """
 
     def __setitem__(self, key, value):
@@ -382,23 +1073,23 @@ class FlowDict(dict):
         from pzflow import Flow
         if not isinstance(value, Flow):  #pragma: no cover
             raise TypeError(f"Only values of type Flow can be added to a FlowFactory, not {type(value)}")
-        return dict.__setitem__(self, key, value)
+        return ModelCache.__setitem__(self, key, value)
 
     def read(self, path, force=False):
         """ Read a `Flow` object from disk and add it to this dictionary """
         from pzflow import Flow
-        if force or path not in self:
+        flow = None if force else self.lookup(path)
+        if flow is None:
             flow = Flow(file=path)
             self.__setitem__(path, flow)
-            return flow
-        return self[path]  #pragma: no cover
+        return flow
 
 
 class FlowHandle(ModelHandle):
     """
     A wrapper around a file that describes a PZFlow object
     """
-    flow_factory = FlowDict()
+    flow_factory = FlowDict(max_entries=32)
 
     suffix = 'pkl'
 
@@ -424,6 +1115,7 @@ class DataStore(dict):
     This class:
     1) associates data products with keys
     2) provides functions to read and write the various data produces to associated files
+    3) optionally keeps the memory used by the data under a budget, see `set_memory_budget()`
     """
     allow_overwrite = False
 
@@ -435,9 +1127,131 @@ class DataStore(dict):
         All of the values must be data handles of this will raise a TypeError
         """
         dict.__init__(self)
+        # __setattr__ is overridden to insert handles, so set the attributes directly
+        object.__setattr__(self, '_last_used', OrderedDict())
+        object.__setattr__(self, 'memory_budget', None)
+        object.__setattr__(self, 'spill_dir', None)
+        object.__setattr__(self, 'n_evicted', 0)
         for key, val in kwargs.items():
             self[key] = val
 
+    def set_memory_budget(self, budget, spill_dir=None):
+        """ Limit the memory used by the data held by the handles in this DataStore
+
+        Parameters
+        ----------
+        budget : float or None
+            The budget, in MB, None to disable it
+        spill_dir : str or None
+            Directory where the data that were never written are written before being
+            evicted, None for a temporary directory
+
+        Notes
+        -----
+        The size of the data is estimated with `rail.core.instrumentation.data_nbytes`,
+        so only numpy arrays, tables and `qp.Ensemble` objects are counted.  Models and
+        flows are neither counted nor evicted, as the model cache and the stages using
+        them keep references to them, so dropping them from the handle would not free
+        any memory.
+
+        Each time a handle is inserted or accessed by key, it is marked as the most
+        recently used, and if the total size of the data is over budget, the data of the
+        least recently used handles are dropped, after being written to their file if
+        they have not been.  `DataHandle.read()`, and so `RailStage.get_data()`, will
+        transparently re-read them, but code that holds on to a handle and uses its
+        `data` attribute directly may find it set to None.
+        """
+        object.__setattr__(self, 'memory_budget', budget)
+        object.__setattr__(self, 'spill_dir', spill_dir)
+        self.enforce_budget()
+
+    def touch(self, key):
+        """ Mark the handle associated to a key as the most recently used, and enforce the memory budget """
+        if key not in self:
+            return
+        self._last_used[key] = None
+        self._last_used.move_to_end(key)
+        self.enforce_budget(protect=key)
+
+    def memory_usage(self):
+        """ Return the approximate size, in bytes, of the data held by each handle, models excepted """
+        return {key: data_nbytes(handle.data) for key, handle in self.items()
+                if handle.has_data and not isinstance(handle, ModelHandle)}
+
+    def enforce_budget(self, protect=None):
+        """ Evict the data of the least recently used handles until the memory budget is met
+
+        Parameters
+        ----------
+        protect : str or None
+            The key of a handle that is in use, and should not be evicted
+
+        Returns
+        -------
+        evicted : list[str]
+            The keys of the handles whose data were evicted
+        """
+        if self.memory_budget is None:
+            return []
+        usage = self.memory_usage()
+        total = sum(usage.values())
+        budget = self.memory_budget * 1024**2
+        evicted = []
+        order = [key for key in self._last_used if key in usage] + \
+            [key for key in usage if key not in self._last_used]
+        for key in order:
+            if total <= budget:
+                break
+            if key == protect or usage[key] == 0:
+                continue
+            if self._evict(dict.__getitem__(self, key)):
+                total -= usage[key]
+                evicted.append(key)
+        if evicted:
+            object.__setattr__(self, 'n_evicted', self.n_evicted + len(evicted))
+            print(f"DataStore evicted the data for {evicted}, using {total / 1024**2:.1f} MB "
+                  f"of a {self.memory_budget} MB budget")
+        return evicted
+
+    def _evict(self, handle):
+        """ Drop the data of a handle, writing them first if needed, return False if that is not possible """
+        if handle.fileObj is not None:
+            # the handle is being written chunk by chunk
+            return False
+        # a file at the path may be from an earlier run, or predate the data
+        if handle.dirty or not handle.is_written:
+            if handle.partial:
+                return False
+            if handle.path is None or handle.path == 'None':
+                if self.spill_dir is None:
+                    object.__setattr__(self, 'spill_dir', tempfile.mkdtemp(prefix='rail_spill_'))
+                os.makedirs(self.spill_dir, exist_ok=True)
+                handle.path = os.path.join(self.spill_dir, handle.make_name(handle.tag))
+            try:
+                handle.write()
+            except Exception as msg:  # pylint: disable=broad-except
+                print(f"DataStore could not write {handle.tag} to {handle.path} before evicting it: {msg}")
+                return False
+        handle.set_data(None)
+        return True
+
+    def __getitem__(self, key):
+        """ Override the __getitem__ to keep track of the handles in use """
+        handle = dict.__getitem__(self, key)
+        self.touch(key)
+        return handle
+
+    def get(self, key, default=None):
+        """ Override get to keep track of the handles in use """
+        if key not in self:
+            return default
+        return self[key]
+
+    def clear(self):
+        """ Remove all the handles """
+        dict.clear(self)
+        self._last_used.clear()
+
     def __str__(self):
         """ Override __str__ casting to deal with `TableHandle` objects in the map """
         s = "{"
@@ -456,10 +1270,11 @@ class DataStore(dict):
         """ Override the __setitem__ to work with `TableHandle` """
         if not isinstance(value, DataHandle):
             raise TypeError(f"Can only add objects of type DataHandle to DataStore, not {type(value)}")
-        check = self.get(key)
+        check = dict.get(self, key)
         if check is not None and not self.allow_overwrite:
             raise ValueError(f"DataStore already has an item with key {key}, of type {type(check)}, created by {check.creator}")
         dict.__setitem__(self, key, value)
+        self.touch(key)
         return value
 
     def __getattr__(self, key):
@@ -495,7 +1310,9 @@ class DataStore(dict):
             handle = self[key]
         except KeyError as msg:
             raise KeyError(f"Failed to read data {key} because {msg}") from msg
-        return handle.read(force, **kwargs)
+        data = handle.read(force, **kwargs)
+        self.touch(key)
+        return data
 
     def open(self, key, mode='r', **kwargs):
         """ Open and return the file associated to a particular key """
@@ -0,0 +1,244 @@
+""" Performance instrumentation for RailStages """
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import qp
+
+from rail.core.background import close_iterator
+
+try:
+    import resource
+except ImportError:  #pragma: no cover
+    resource = None
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in bytes, or None if it is not available"""
+    if resource is None:  #pragma: no cover
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS, and in kilobytes everywhere else
+    if sys.platform == 'darwin':  #pragma: no cover
+        return maxrss
+    return maxrss * 1024
+
+
+def data_nbytes(data):
+    """Return the size, in bytes, of the arrays held by a chunk of data
+
+    This handles numpy arrays, `pandas.DataFrame`, `qp.Ensemble` and (nested)
+    dicts of those, anything else counts as 0 bytes.
+    """
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=False).sum())
+    if isinstance(data, qp.Ensemble):
+        ancil_bytes = data_nbytes(data.ancil) if data.ancil is not None else 0
+        return data_nbytes(data.objdata()) + ancil_bytes
+    if isinstance(data, dict):
+        return sum(data_nbytes(val) for val in data.values())
+    return 0
+
+
+class StageMetrics:
+    """Collect timing, throughput and memory events for one stage
+
+    Each event covers one phase ('read', 'compute', 'write' or 'finalize') of
+    the processing of one chunk, or of the whole stage ('stage').  Events that
+    are measured inside another event, e.g., a write done while computing a
+    chunk, are not counted in the time of the enclosing event, so that the
+    times of the different phases add up to the total.
+
+    Parameters
+    ----------
+    stage_name : str
+        The name of the stage, used to label the events
+    rank : int
+        The MPI rank of this process
+    enabled : bool
+        If False, `measure()` does not record anything
+    trace_memory : bool
+        If True, use `tracemalloc` to record the peak memory allocated by Python during each event.
+        If this starts the tracing, `close()` stops it.
+
+    Notes
+    -----
+    Each event is a dict with the keys:
+    stage, rank, phase, start, end, rows, nbytes, seconds, rows_per_sec, peak_rss, peak_traced, timestamp.
+    `start` and `end` are the rows of the chunk, if any, and `peak_rss` is the peak resident
+    set size of the process since it started, so it can only grow from one event to the next.
+    """
+
+    def __init__(self, stage_name, rank=0, enabled=True, trace_memory=False):
+        self.stage_name = stage_name
+        self.rank = rank
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.events = []
+        self._child_seconds = []
+        self._t0 = None
+        self._started_tracing = False
+
+    @contextmanager
+    def measure(self, phase, start=None, end=None, data=None):
+        """Measure the code run inside a with block
+
+        Parameters
+        ----------
+        phase : str
+            The phase being measured
+        start : int or None
+            The first row of the chunk being processed
+        end : int or None
+            One past the last row of the chunk being processed
+        data : any
+            If given, the data for this event, used to count the bytes
+
+        Returns
+        -------
+        event : dict
+            The event, the caller can set `event['nbytes']` if the data are only
+            available inside the with block
+        """
+        event = dict(stage=self.stage_name, rank=self.rank, phase=phase, start=start, end=end,
+                     rows=None if start is None or end is None else end - start, nbytes=0)
+        if not self.enabled:
+            yield event
+            return
+        if data is not None:
+            event['nbytes'] = data_nbytes(data)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+        event['timestamp'] = time.time()
+        if self._t0 is None:
+            self._t0 = time.perf_counter()
+        self._child_seconds.append(0.)
+        t_start = time.perf_counter()
+        try:
+            yield event
+        finally:
+            elapsed = time.perf_counter() - t_start
+            child_seconds = self._child_seconds.pop()
+            if self._child_seconds:
+                self._child_seconds[-1] += elapsed
+            self._record(event, elapsed - child_seconds)
+
+    def _record(self, event, seconds):
+        """Fill in the timing and memory fields of an event, and add it to the list"""
+        event['seconds'] = seconds
+        event['rows_per_sec'] = event['rows'] / seconds if event['rows'] and seconds > 0 else None
+        event['peak_rss'] = peak_rss()
+        event['peak_traced'] = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        self.events.append(event)
+
+    def close(self):
+        """Stop the memory tracing, if it was started by this object
+
+        The events already recorded are kept, and tracing starts again if another event is measured.
+        """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def iterate(self, iterator, phase='read'):
+        """Wrap an iterator yielding `(start, end, data)` tuples, and measure the time spent in each step
+
+        The wrapped iterator is closed, if it has a `close()` method, when this one is.
+        """
+        iterator = iter(iterator)
+        try:
+            while True:
+                with self.measure(phase) as event:
+                    chunk = next(iterator, None)
+                if chunk is None:
+                    # the last call to next() did not return a chunk
+                    if self.enabled:
+                        self.events.pop()
+                    return
+                start, end, data = chunk
+                event.update(start=start, end=end, rows=end - start, nbytes=data_nbytes(data))
+                if self.enabled and event['seconds'] > 0:
+                    event['rows_per_sec'] = event['rows'] / event['seconds']
+                yield start, end, data
+        finally:
+            # also runs when this generator is closed, or garbage collected, before the end
+            close_iterator(iterator)
+
+    def totals(self):
+        """Return the totals for each phase, and for the whole stage
+
+        Returns
+        -------
+        totals : dict[str, dict]
+            The total seconds, rows, bytes and rows per second for each phase.
+            The 'stage' entry covers the time since the first event, its rows
+            are the rows read, and it also has the peak memory use.
+        """
+        totals = {}
+        for event in self.events:
+            phase_totals = totals.setdefault(event['phase'], dict(seconds=0., rows=0, nbytes=0))
+            phase_totals['seconds'] += event['seconds']
+            phase_totals['rows'] += event['rows'] or 0
+            phase_totals['nbytes'] += event['nbytes']
+        for phase_totals in totals.values():
+            phase_totals['rows_per_sec'] = phase_totals['rows'] / phase_totals['seconds'] \
+                if phase_totals['seconds'] > 0 else None
+        seconds = time.perf_counter() - self._t0 if self._t0 is not None else 0.
+        rows = totals.get('read', {}).get('rows', 0)
+        totals['stage'] = dict(seconds=seconds, rows=rows,
+                               nbytes=sum(val['nbytes'] for val in totals.values()),
+                               rows_per_sec=rows / seconds if seconds > 0 else None,
+                               peak_rss=peak_rss(),
+                               peak_traced=max((event['peak_traced'] for event in self.events
+                                                if event['peak_traced'] is not None), default=None))
+        return totals
+
+    def write_jsonl(self, path):
+        """Append the events, and a 'stage' event with the totals, to a JSON lines file"""
+        stage_event = dict(stage=self.stage_name, rank=self.rank, phase='stage', start=None, end=None,
+                           timestamp=time.time())
+        stage_event.update(self.totals()['stage'])
+        with open(path, 'a') as fout:
+            for event in self.events + [stage_event]:
+                fout.write(json.dumps(event) + '\n')
+
+    def write_prometheus(self, path):
+        """Write the totals for each phase to a Prometheus textfile
+
+        The file is written to a temporary file and then renamed, so that a
+        collector never reads a partial file.
+        """
+        totals = self.totals()
+        labels = f'stage="{self.stage_name}",rank="{self.rank}"'
+        metrics = [
+            ('rail_stage_seconds', 'gauge', 'Time spent in each phase of a stage', 'seconds'),
+            ('rail_stage_rows', 'gauge', 'Rows processed in each phase of a stage', 'rows'),
+            ('rail_stage_bytes', 'gauge', 'Bytes of data handled in each phase of a stage', 'nbytes'),
+            ('rail_stage_rows_per_second', 'gauge', 'Throughput of each phase of a stage', 'rows_per_sec'),
+        ]
+        lines = []
+        for metric, metric_type, help_text, key in metrics:
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {metric_type}']
+            for phase, phase_totals in totals.items():
+                if phase_totals[key] is not None:
+                    lines.append(f'{metric}{{{labels},phase="{phase}"}} {phase_totals[key]}')
+        for metric, help_text, key in [('rail_stage_peak_rss_bytes', 'Peak resident set size of the process', 'peak_rss'),
+                                       ('rail_stage_peak_traced_bytes', 'Peak memory allocated by Python', 'peak_traced')]:
+            if totals['stage'][key] is not None:
+                lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge',
+                          f'{metric}{{{labels}}} {totals["stage"][key]}']
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as fout:
+            fout.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
@@ -1,10 +1,15 @@
 """ Base class for PipelineStages in Rail """
 
+import functools
 import os
 
 from ceci import PipelineStage, MiniPipeline
 from ceci.config import StageParameter as Param
-from rail.core.data import DATA_STORE, DataHandle
+from rail.core.data import DATA_STORE, DataHandle, QPHandle, TableHandle, data_length, is_parquet_file, iterate_data
+from rail.core.array_model import share_model
+from rail.core.background import PrefetchIterator
+from rail.core.instrumentation import StageMetrics, data_nbytes
+from rail.core.cache import StageCache, stage_cache_key
 
 from math import ceil
 
@@ -64,6 +69,24 @@ class RailStageBuild:
         return stage
 
 
+def _cached_run(run):
+    """Wrap the run() method of a RailStage sub-class so that it uses the stage result cache"""
+    @functools.wraps(run)
+    def wrapper(self):
+        # only the outermost run() of a stage consults the cache,
+        # not the base class methods it calls
+        if not self.config.cache_dir or self._cache_running:
+            return run(self)
+        self._cache_running = True
+        try:
+            if self._load_from_cache():
+                return None
+            return run(self)
+        finally:
+            self._cache_running = False
+    return wrapper
+
+
 class RailPipeline(MiniPipeline):
     """A pipeline intended for interactive use
 
@@ -125,10 +148,41 @@ class RailStage(PipelineStage):
     And `connect_input()` will do the alias lookup both on the input and output.
     I.e., it is the same as calling
     `self.set_data(inputTag, other.get_handle(outputTag, allow_missing=True), do_read=False)`
+
+    If `config.cache_dir` is set, the outputs of the stage are cached there, keyed on the
+    class of the stage, its configuration, the version of the code and the content of its
+    inputs.  When `run()` is called with a configuration and inputs that are already in the
+    cache, the cached output files are copied to the output paths and attached to the
+    output handles, and the stage is not actually run.  See `rail.core.cache`.
     """
 
     config_options = dict(output_mode=Param(str, 'default',
-                                            msg="What to do with the outputs"))
+                                            msg="What to do with the outputs"),
+                          prefetch_depth=Param(int, 0,
+                                               msg="Number of chunks input_iterator reads ahead "
+                                                   "on a background thread, 0 to disable"),
+                          memmap_inputs=Param(bool, False,
+                                              msg="Use read-only memory maps for the hdf5 "
+                                                  "tables read by get_data, where possible"),
+                          memory_budget=Param(float, 0.,
+                                              msg="Memory, in MB, that processing one chunk may use; "
+                                                  "if larger than 0, input_iterator derives the "
+                                                  "chunk_size from it"),
+                          metrics_file=Param(str, '',
+                                             msg="JSON lines file the performance events of this stage "
+                                                 "are appended to, '' to disable"),
+                          metrics_prom_file=Param(str, '',
+                                                  msg="Prometheus textfile the performance totals of this "
+                                                      "stage are written to, '' to disable; "
+                                                      "{name} and {rank} are replaced by the stage name and rank"),
+                          trace_memory=Param(bool, False,
+                                             msg="Record the peak memory allocated by Python in the "
+                                                 "performance events, using tracemalloc"),
+                          cache_dir=Param(str, '',
+                                          msg="Directory of the stage result cache, '' to disable"),
+                          cache_size_limit=Param(float, 10240.,
+                                                 msg="Size, in MB, above which the least recently used "
+                                                     "entries of the stage result cache are evicted"))
 
     data_store = DATA_STORE()
 
@@ -137,8 +191,134 @@ class RailStage(PipelineStage):
         Do RailStage specific initialization """
         PipelineStage.__init__(self, args, comm=comm)
         self._input_length = None
+        self._metrics = None
+        self._cache_key = None
+        self._cache_running = False
         self.io = StageIO(self)
 
+    def __init_subclass__(cls, **kwargs):
+        """Wrap the run() method of each sub-class so that it uses the stage result cache"""
+        super().__init_subclass__(**kwargs)
+        if 'run' in cls.__dict__ and not getattr(cls.run, '__isabstractmethod__', False):
+            cls.run = _cached_run(cls.__dict__['run'])
+
+    @property
+    def metrics(self):
+        """The `StageMetrics` collecting the performance events of this stage
+
+        Events are only recorded if `config.metrics_file` or `config.metrics_prom_file` is set.
+        """
+        if self._metrics is None:
+            enabled = bool(self.config.metrics_file or self.config.metrics_prom_file)
+            self._metrics = StageMetrics(self.instance_name, rank=self.rank, enabled=enabled,
+                                         trace_memory=self.config.trace_memory)
+        return self._metrics
+
+    def open_shared_model(self, model):
+        """Load a model, sharing its arrays with the other MPI ranks of the same node
+
+        The model is loaded on one rank per node, and the other ranks of the node
+        use read-only views of its arrays, see `rail.core.array_model.share_model`.
+        Without MPI, the model is simply read.
+
+        Parameters
+        ----------
+        model : `object`, `str` or `ModelHandle`
+            The model, the path to its file, or a handle providing access to it
+
+        Returns
+        -------
+        model : `object`
+            The model
+        window : `mpi4py.MPI.Win` or None
+            The shared memory window, it must be kept alive as long as the model is used
+        """
+        if isinstance(model, str):
+            self.config['model'] = model
+            self.set_data('model', data=None, path=model, do_read=False)
+        elif isinstance(model, DataHandle):
+            if model.has_path:
+                self.config['model'] = model.path
+            self.set_data('model', model, do_read=False)
+        else:
+            self.set_data('model', model)
+        handle = self.get_handle('model')
+        if self.comm is not None:  #pragma: no cover
+            model, window = share_model(self.comm, handle.read)
+            # only keep the shared copy of the arrays
+            if handle.has_path:
+                handle.model_factory.discard(handle.path)
+            handle.set_data(model)
+            return model, window
+        return handle.read(), None
+
+    def write_metrics(self):
+        """Write the performance events of this stage to the files given in the config"""
+        if self.config.metrics_file:
+            self.metrics.write_jsonl(self.config.metrics_file.format(name=self.instance_name, rank=self.rank))
+        if self.config.metrics_prom_file:
+            self.metrics.write_prometheus(self.config.metrics_prom_file.format(name=self.instance_name,
+                                                                               rank=self.rank))
+
+    def finalize(self):
+        """Finalize the stage, moving its outputs to their final locations, and write the performance metrics
+
+        If the stage was run with the result cache enabled, and its result was not
+        in the cache, the outputs are added to the cache.
+        """
+        with self.metrics.measure('finalize'):
+            PipelineStage.finalize(self)
+        self.write_metrics()
+        self.metrics.close()
+        if self._cache_key is not None and self.rank == 0:
+            self._store_in_cache()
+        self._cache_key = None
+
+    @property
+    def cache(self):
+        """The `StageCache` holding the results of this stage, or None if the cache is disabled"""
+        if not self.config.cache_dir:
+            return None
+        return StageCache(self.config.cache_dir, max_bytes=self.config.cache_size_limit * 1024**2)
+
+    def _load_from_cache(self):
+        """Attach the cached outputs of this stage to its output handles, if they are in the cache
+
+        Returns
+        -------
+        hit : bool
+            True if the outputs were found in the cache, in which case the stage does not need to run
+        """
+        self._cache_key = stage_cache_key(self)
+        if self._cache_key is None:
+            print(f"Stage cache disabled for {self.instance_name}: its inputs can not be hashed")
+            return False
+        entry = self.cache.lookup(self._cache_key)
+        if entry is None or set(entry['outputs']) != set(self.output_tags()):
+            print(f"Stage cache miss for {self.instance_name}: {self._cache_key[:16]}")
+            return False
+        print(f"Stage cache hit for {self.instance_name}: {self._cache_key[:16]}")
+        key, self._cache_key = self._cache_key, None
+        for tag in self.output_tags():
+            path = self.get_output(self.get_aliased_tag(tag))
+            if self.rank == 0:
+                self.cache.restore(key, tag, path)
+            handle = self.add_handle(tag, path=path)
+            if self.rank == 0:
+                handle.read()
+        return True
+
+    def _store_in_cache(self):
+        """Add the final outputs of this stage to the cache"""
+        outputs = {tag: self.get_output(self.get_aliased_tag(tag), final_name=True) for tag in self.output_tags()}
+        missing = [path for path in outputs.values() if not os.path.exists(path)]
+        if missing:
+            print(f"Not caching the outputs of {self.instance_name}, missing files: {missing}")
+            return
+        stage_class = type(self)
+        self.cache.store(self._cache_key, outputs, stage=stage_class.__name__,
+                         instance_name=self.instance_name)
+
     @classmethod
     def make_and_connect(cls, **kwargs):
         """Make a stage and connects it to other stages
@@ -231,6 +411,16 @@ class RailStage(PipelineStage):
         1. This gets the data via the DataHandle, and can and will read the data
         from disk if needed.
 
+        2. If `self.input_columns(tag)` is not None, only those columns
+        are read from disk.
+
+        3. If `config.memmap_inputs` is True, hdf5 tables are returned as
+        read-only memory maps where possible, so the returned arrays should
+        not be modified in place.
+
+        4. If the `DataStore` has a memory budget, data that were evicted
+        from it are transparently re-read.
+
         Parameters
         ----------
         tag : str
@@ -244,10 +434,52 @@ class RailStage(PipelineStage):
             The data accesed by the handle assocated to the tag
         """
         handle = self.get_handle(tag, allow_missing=allow_missing)
+        read_kwargs = {}
+        if isinstance(handle, TableHandle) and handle.is_written:
+            columns = self.input_columns(tag)
+            if columns is not None:
+                read_kwargs['columns'] = columns
+            if self.config.memmap_inputs:
+                read_kwargs['memmap'] = True
+        if read_kwargs and (not handle.has_data or handle.partial):
+            with self.metrics.measure('read') as event:
+                data = handle.read(force=True, **read_kwargs)
+                event['nbytes'] = data_nbytes(data)
+            self.data_store.touch(handle.tag)
+            return data
         if not handle.has_data:
-            handle.read()
+            with self.metrics.measure('read') as event:
+                event['nbytes'] = data_nbytes(handle.read())
+            # count the data that were just read against the DataStore memory budget
+            self.data_store.touch(handle.tag)
         return handle()
 
+    def get_ancil(self, tag, columns=None):
+        """Gets the ancillary data of the `qp.Ensemble` associated to a particular tag
+
+        Notes
+        -----
+        If the ensemble is not already in memory, only its ancil data, or only the
+        requested columns, are read from disk, and not the PDFs.
+
+        Parameters
+        ----------
+        tag : str
+            The tag (from cls.inputs or cls.outputs) for this data
+        columns : list[str] or None
+            The ancil columns to return, None for all of them
+
+        Returns
+        -------
+        ancil : dict[str, np.ndarray]
+            The ancil columns
+        """
+        handle = self.get_handle(tag, allow_missing=True)
+        with self.metrics.measure('read') as event:
+            ancil = handle.read_ancil(columns)
+            event['nbytes'] = data_nbytes(ancil)
+        return ancil
+
     def set_data(self, tag, data, path=None, do_read=True):
         """Sets the data associated to a particular tag
 
@@ -294,6 +526,7 @@ class RailStage(PipelineStage):
                 handle.read()
             if arg_data is not None:
                 handle.data = arg_data
+            self.data_store.touch(handle.tag)
         return handle.data
 
     def add_data(self, tag, data=None):
@@ -314,6 +547,54 @@ class RailStage(PipelineStage):
         handle = self.add_handle(tag, data=data)
         return handle.data
 
+    def input_columns(self, tag):  #pylint: disable=unused-argument
+        """Return the columns this stage needs from the table associated to a tag
+
+        Sub-classes that only use some of the columns of their tabular inputs
+        can override this, so that `get_data()` and `input_iterator()` only
+        read those columns from disk.
+
+        Parameters
+        ----------
+        tag : str
+            The tag (from cls.inputs) for this data
+
+        Returns
+        -------
+        columns : list[str] or None
+            The names of the columns to read, None means all the columns
+        """
+        return None
+
+    def output_row_bytes(self):
+        """Return an estimate of the size, in bytes, of the output for one input row
+
+        This is used, together with `working_set_factor()`, to derive the
+        chunk size from `config.memory_budget`.  Sub-classes whose outputs
+        scale with the number of input rows should override this.
+        """
+        return 0
+
+    def working_set_factor(self):
+        """Return the ratio between the memory used to process one row and the size of its input and output
+
+        This is used to derive the chunk size from `config.memory_budget`.  Sub-classes
+        that build large intermediate arrays for each row should override this.
+        """
+        return 1.
+
+    def _chunk_size_from_budget(self, input_bytes):
+        """Derive the chunk size from `config.memory_budget`, and log how it was chosen"""
+        output_bytes = self.output_row_bytes()
+        factor = self.working_set_factor()
+        row_bytes = max(factor * (input_bytes + output_bytes), 1.)
+        chunk_size = max(int(self.config.memory_budget * 1024**2 // row_bytes), 1)
+        print(f"Process {self.rank} using chunk_size={chunk_size} for {self.name}: "
+              f"memory_budget of {self.config.memory_budget} MB / "
+              f"({input_bytes:.0f} input + {output_bytes:.0f} output bytes per row "
+              f"x working set factor {factor:g})")
+        return chunk_size
+
     def input_iterator(self, tag, **kwargs):
         """Iterate the input assocated to a particular tag
 
@@ -324,36 +605,78 @@ class RailStage(PipelineStage):
 
         kwargs : dict[str, Any]
             These will be passed to the Handle's iterator method
+
+        Notes
+        -----
+        If the data are in memory, or in a file that can not be read by chunks,
+        they are split into slices of `config.chunk_size` rows, which are views of
+        the data where possible (a `qp.Ensemble` is rebuilt for each slice).
+        In both cases, the chunks are distributed over the MPI ranks in the same way.
+
+        If `config.prefetch_depth` is larger than 0, the chunks are read on a
+        background thread, up to `prefetch_depth` chunks ahead of the caller,
+        so that reading the next chunk overlaps with processing the current one.
+
+        If `config.memory_budget` is larger than 0, `config.chunk_size` is replaced
+        by the number of rows that fit in the budget, given the width of the input
+        rows, `output_row_bytes()` and `working_set_factor()`.
+
+        If the performance metrics are enabled, the time spent reading each chunk
+        is recorded as a 'read' event.
         """
         handle = self.get_handle(tag, allow_missing=True)
-        if self.config.hdf5_groupname and handle.path: 
-            self._input_length = handle.size(groupname=self.config.hdf5_groupname)
-            total_chunks_needed = ceil(self._input_length/self.config.chunk_size)
-            if total_chunks_needed<self.size:  #pragma: no cover
-                color = self.rank+1 <= total_chunks_needed
-                newcomm = self.comm.Split(color=color,key=self.rank)
-                if color:
-                    self.setup_mpi(newcomm)
-                else:
-                    quit()
-            kwcopy = dict(groupname=self.config.hdf5_groupname,
+        groupname = self.config['hdf5_groupname'] if 'hdf5_groupname' in self.config else None
+        # parquet files are iterated by row group, and qp files by rows of PDFs,
+        # neither needs a groupname
+        is_parquet = handle.path is not None and handle.is_written and is_parquet_file(handle.path)
+        is_qp = isinstance(handle, QPHandle) and handle.is_written
+        from_file = bool(handle.path and (groupname or is_parquet or is_qp))
+        columns = self.input_columns(tag)
+        if from_file:
+            self._input_length = handle.size(groupname=groupname)
+            if self.config.memory_budget > 0:
+                if isinstance(handle, TableHandle):
+                    row_bytes = handle.row_bytes(columns=columns, groupname=groupname)
+                elif isinstance(handle, QPHandle):
+                    row_bytes = handle.row_bytes()
+                else:  #pragma: no cover
+                    row_bytes = None
+                    print(f"Process {self.rank} can not estimate the size of the rows of {tag} for {self.name}, "
+                          f"ignoring memory_budget and using chunk_size={self.config.chunk_size}")
+                if row_bytes is not None:
+                    # stored in the config, as some stages use it to count the chunks
+                    self.config['chunk_size'] = self._chunk_size_from_budget(row_bytes)
+        else:
+            data = self.get_data(tag)
+            if groupname:
+                data = data[groupname]
+            self._input_length = data_length(data)
+            if self.config.memory_budget > 0 and self._input_length:
+                self.config['chunk_size'] = self._chunk_size_from_budget(data_nbytes(data) / self._input_length)
+        total_chunks_needed = ceil(self._input_length/self.config.chunk_size)
+        if 0 < total_chunks_needed < self.size:  #pragma: no cover
+            color = self.rank+1 <= total_chunks_needed
+            newcomm = self.comm.Split(color=color,key=self.rank)
+            if color:
+                self.setup_mpi(newcomm)
+            else:
+                quit()
+        if from_file:
+            kwcopy = dict(groupname=groupname,
                           chunk_size=self.config.chunk_size,
                           rank=self.rank,
                           parallel_size=self.size)
+            if columns is not None and isinstance(handle, TableHandle):
+                kwcopy.update(columns=columns)
             kwcopy.update(**kwargs)
-            return handle.iterator(**kwcopy)
-                # If data is in memory and not in a file, it means is small enough to process it
-                # in a single chunk.
-        else:  #pragma: no cover
-            if self.config.hdf5_groupname:
-                test_data = self.get_data('input')[self.config.hdf5_groupname]
-            else:
-                test_data = self.get_data('input')
-            s = 0
-            e = len(list(test_data.items())[0][1])
-            self._input_length=e
-            iterator=[[s, e, test_data]]
-            return iterator
+            iterator = handle.iterator(**kwcopy)
+            if self.config.prefetch_depth > 0:
+                iterator = PrefetchIterator(iterator, depth=self.config.prefetch_depth)
+        else:
+            iterator = iterate_data(data, self.config.chunk_size, rank=self.rank, parallel_size=self.size)
+        if self.metrics.enabled:
+            iterator = self.metrics.iterate(iterator)
+        return iterator
 
     def connect_input(self, other, inputTag=None, outputTag=None):
         """Connect another stage to this stage as an input
@@ -2,15 +2,97 @@
 Implement simple version of TxPipe NZDir summarizer
 """
 
+import itertools
+
 import numpy as np
 from ceci.config import StageParameter as Param
 from rail.estimation.estimator import CatEstimator, CatInformer
 from rail.core.data import QPHandle
+from rail.core.background import close_iterator
 import qp
 import scipy.spatial
 import pandas as pd
 
 
+class _BallIndex:
+    """Index of balls of varying radii, returning the summed weights of the points inside each ball
+
+    The balls are split in groups of similar radii.  In each group, a ball of
+    centre c and radius r is lifted to the point (c, sqrt(R**2 - r**2)), with R
+    the largest radius of the group, so that a point (p, 0) is inside the ball
+    if and only if it is within R of the lifted centre.  The balls containing
+    each point are then found by a single fixed-radius query of a tree of the
+    lifted centres, and the weights are accumulated with `np.bincount`.  The
+    balls of the groups too small to be worth a tree are checked by brute force.
+
+    Parameters
+    ----------
+    centres : np.ndarray
+        The centres of the balls, one per row
+    radii : np.ndarray
+        The radius of each ball
+    leafsize : int
+        The leaf size of the trees
+    radius_ratio : float
+        The maximum ratio between the radii of the balls of a group
+    min_tree_size : int
+        The balls of groups smaller than this are checked by brute force
+    """
+
+    def __init__(self, centres, radii, leafsize=40, radius_ratio=2., min_tree_size=64):
+        centres = np.asarray(centres, dtype=float)
+        self.radii = np.asarray(radii, dtype=float)
+        log_radii = np.log(np.maximum(self.radii, np.finfo(float).tiny))
+        group_ids = np.floor((log_radii - log_radii.min()) / np.log(radius_ratio)).astype(int)
+        self.groups = []
+        brute_force = []
+        for group_id in np.unique(group_ids):
+            members = np.flatnonzero(group_ids == group_id)
+            if members.size < min_tree_size:
+                brute_force.append(members)
+                continue
+            max_radius = self.radii[members].max()
+            lift = np.sqrt(np.maximum(max_radius**2 - self.radii[members]**2, 0.))
+            tree = scipy.spatial.KDTree(np.column_stack([centres[members], lift]), leafsize=leafsize)
+            self.groups.append((members, max_radius, tree))
+        self.brute_force = np.concatenate(brute_force) if brute_force else np.zeros(0, dtype=int)
+        self.brute_force_centres = centres[self.brute_force]
+
+    def weights(self, points, point_weights, num_threads=1):
+        """Return the summed weights of the points inside each ball
+
+        Parameters
+        ----------
+        points : np.ndarray
+            The points, one per row
+        point_weights : np.ndarray
+            The weight of each point
+        num_threads : int
+            Number of threads used by the queries, 0 to use all the available cores
+
+        Returns
+        -------
+        weights : np.ndarray
+            The summed weights, one per ball
+        """
+        workers = num_threads if num_threads > 0 else -1
+        weights = np.zeros(len(self.radii))
+        lifted_points = np.column_stack([points, np.zeros(len(points))])
+        for members, max_radius, tree in self.groups:
+            balls = tree.query_ball_point(lifted_points, max_radius, workers=workers, return_sorted=False)
+            counts = np.fromiter(map(len, balls), dtype=np.intp, count=len(balls))
+            ids = np.fromiter(itertools.chain.from_iterable(balls), dtype=np.intp, count=counts.sum())
+            weights[members] += np.bincount(ids, weights=np.repeat(point_weights, counts), minlength=tree.n)
+        if self.brute_force.size:
+            radii2 = self.radii[self.brute_force]**2
+            step = max(1, 2**20 // self.brute_force.size)
+            for start in range(0, len(points), step):
+                diff = points[start:start + step, np.newaxis, :] - self.brute_force_centres[np.newaxis, :, :]
+                inside = (diff**2).sum(axis=2) <= radii2
+                weights[self.brute_force] += point_weights[start:start + step] @ inside
+        return weights
+
+
 class Inform_NZDir(CatInformer):
     """Quick implementation of an NZ Estimator that
     creates weights for each input
@@ -46,6 +128,14 @@ class Inform_NZDir(CatInformer):
         Do Informer specific initialization """
         CatInformer.__init__(self, args, comm=comm)
 
+    def input_columns(self, tag):
+        if tag != 'input':  #pragma: no cover
+            return None
+        columns = self.config.usecols + [self.config.szname]
+        if self.config.szweightcol:  #pragma: no cover
+            columns.append(self.config.szweightcol)
+        return columns
+
     def run(self):
         from sklearn.neighbors import NearestNeighbors
 
@@ -111,10 +201,12 @@ class NZDir(CatEstimator):
                           nzbins=Param(int, 301, msg="The number of gridpoints in the z grid"),
                           seed=Param(int, 87, msg="random seed"),
                           usecols=Param(list, default_usecols, msg="columns from sz_date for Neighor calculation"),
-                          leafsize=Param(int, 40, msg="leaf size for testdata KDTree"),
+                          leafsize=Param(int, 40, msg="leaf size for the spec-z KDTrees"),
                           hdf5_groupname=Param(str, "photometry", msg="name of hdf5 group for data, if None, then set to ''"),
                           phot_weightcol=Param(str, "", msg="name of photometry weight, if present"),
-                          nsamples=Param(int, 20, msg="number of bootstrap samples to generate"))
+                          nsamples=Param(int, 20, msg="number of bootstrap samples to generate"),
+                          num_threads=Param(int, 1, msg="Number of threads used for the neighbour queries, "
+                                            "0 to use all the available cores"))
     outputs = [('output', QPHandle),
                ('single_NZ', QPHandle)]
 
@@ -125,8 +217,22 @@ class NZDir(CatEstimator):
         self.szusecols = None
         self.szweights = None
         self.sz_mag_data = None
+        self.sz_index = None
         self.bincents = None
         CatEstimator.__init__(self, args, comm=comm)
+        # run() has its own loop over the chunks, which does not implement these options
+        for key, default in dict(parallel_backend='serial', write_behind_depth=0,
+                                 output_precision='float64', output_compression='').items():
+            if self.config[key] != default:
+                raise ValueError(f"NZDir does not support {key}={self.config[key]!r}, expected {default!r}")
+
+    def input_columns(self, tag):
+        if tag != 'input':  #pragma: no cover
+            return None
+        columns = self.config.usecols.copy()
+        if self.config.phot_weightcol:
+            columns.append(self.config.phot_weightcol)
+        return columns
 
     def open_model(self, **kwargs):
         CatEstimator.open_model(self, **kwargs)
@@ -135,6 +241,8 @@ class NZDir(CatEstimator):
         self.szweights = self.model['szweights']
         self.szvec = self.model['szvec']
         self.sz_mag_data = self.model['sz_mag_data']
+        # the trees of the spec-z data are built once, and used for all the chunks
+        self.sz_index = _BallIndex(self.sz_mag_data, self.distances, leafsize=self.config.leafsize)
 
     def run(self):
         rng = np.random.default_rng(seed=self.config.seed)
@@ -158,13 +266,16 @@ class NZDir(CatEstimator):
         self._initialize_run()
         self._output_handle = None
         total_chunks = int(np.ceil(self._input_length/self.config.chunk_size))
-        for s, e, test_data in iterator:
-            print(f"Process {self.rank} running estimator on chunk {s} - {e}")
-
-            total_chunks = int(np.ceil(self._input_length/self.config.chunk_size))
-            chunk_number = s//self.config.chunk_size
-            self._process_chunk(first, total_chunks, chunk_number, test_data, bootstrap_matrix)
-            first = False
+        try:
+            for s, e, test_data in iterator:
+                print(f"Process {self.rank} running estimator on chunk {s} - {e}")
+
+                total_chunks = int(np.ceil(self._input_length/self.config.chunk_size))
+                chunk_number = s//self.config.chunk_size
+                self._process_chunk(first, total_chunks, chunk_number, test_data, bootstrap_matrix)
+                first = False
+        finally:
+            close_iterator(iterator)
         self._single_handle.finalize_write()
         self._sample_handle.finalize_write()
         if self.comm is not None:  # pragma: no cover
@@ -186,20 +297,13 @@ class NZDir(CatEstimator):
         else:
             raise KeyError(f"photometric weight column {self.config.phot_weightcol} not present in data!")
         # calculate weights for the test data
-        weights = np.zeros(len(self.szvec))
         tmpdf = pd.DataFrame(test_data)
 
         phot_mag_data = np.array([tmpdf[band] for band in self.config.usecols]).T
         phot_mag_data[~np.isfinite(phot_mag_data)] = 40.
-        # create a tree for the photometric data, for each specz object find all the
-        # tomo objects within the distance to Kth speczNN from before
-        tree = scipy.spatial.KDTree(phot_mag_data, leafsize=self.config.leafsize)
-        indices = tree.query_ball_point(self.sz_mag_data, self.distances)
-
-        # for each of the indexed galaxies within the distance, add the weights to the
-        # appropriate tomographic bin
-        for j, index in enumerate(indices):
-            weights[j] += pweight[index].sum()
+        # for each specz object, sum the weights of the tomo objects within the
+        # distance to its Kth speczNN from before
+        weights = self.sz_index.weights(phot_mag_data, pweight, self.config.num_threads)
         # make weighted histograms
         hist_data = np.histogram(
             self.szvec,
@@ -5,13 +5,17 @@ things in terms of magnitudes, we will expand in a
 future update
 """
 
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 import copy
+import scipy.cluster.vq
 
 from ceci.config import StageParameter as Param
 from rail.estimation.estimator import CatEstimator, CatInformer
 
-from rail.evaluation.metrics.cdeloss import CDELoss
 from rail.core.common_params import SHARED_PARAMS
 
 import pandas as pd
@@ -39,6 +43,230 @@ def _makepdf(dists, ids, szs, sigma):
     return pdfs
 
 
+def _mixture_mode(means, stds, weights, tol=1e-4, max_iter=100):
+    """Return the mode of gaussian mixtures, one per row of the arrays
+
+    Each mixture is maximised by fixed-point (mean-shift) iterations started from
+    each of its component means, and the best of the local maxima found is kept.
+    This only evaluates the components near the means, instead of on a full grid,
+    and is vectorized over the rows.
+
+    Parameters
+    ----------
+    means, stds, weights : np.ndarray
+        The parameters of the components, with shape (nrows, ncomponents)
+    tol : float
+        The iterations stop once the steps are smaller than `tol`
+    max_iter : int
+        The maximum number of iterations
+
+    Returns
+    -------
+    modes : np.ndarray
+        The mode of each mixture
+    """
+    means = np.asarray(means, dtype=float)
+    prec = 1. / np.asarray(stds, dtype=float)**2
+    amps = np.asarray(weights, dtype=float) * np.sqrt(prec)
+
+    def component_density(points, rows):
+        # density of each component at each point, with shape (len(rows), nstarts, ncomponents)
+        return amps[rows, np.newaxis, :] * np.exp(
+            -0.5 * (points[:, :, np.newaxis] - means[rows, np.newaxis, :])**2 * prec[rows, np.newaxis, :])
+
+    points = means.copy()
+    active = np.arange(len(points))
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        resp = component_density(points[active], active) * prec[active, np.newaxis, :]
+        norm = resp.sum(axis=2)
+        new_points = (resp * means[active, np.newaxis, :]).sum(axis=2) / np.where(norm > 0., norm, 1.)
+        new_points = np.where(norm > 0., new_points, points[active])
+        converged = np.abs(new_points - points[active]).max(axis=1) <= tol
+        points[active] = new_points
+        active = active[~converged]
+    rows = np.arange(len(points))
+    best = np.argmax(component_density(points, rows).sum(axis=2), axis=1)
+    return points[rows, best]
+
+
+def _threaded_query(tree, data, k, num_threads=1, **kwargs):
+    """Query the k nearest neighbours of the rows of data, splitting them in blocks over a pool of threads
+
+    sklearn's trees release the GIL while querying, so the blocks are searched in parallel.
+    The blocks are joined in order, so the result is the same as with a single query.
+    `kwargs` are passed to `tree.query`.
+    """
+    num_threads = num_threads if num_threads > 0 else os.cpu_count()
+    num_threads = min(num_threads, len(data))
+    if num_threads <= 1:
+        return tree.query(data, k=k, **kwargs)
+    blocks = np.array_split(data, num_threads)
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        results = list(pool.map(lambda block: tree.query(block, k=k, **kwargs), blocks))
+    return np.concatenate([dists for dists, _ in results]), np.concatenate([ids for _, ids in results])
+
+
+def _squared_distances(points, rows):
+    """Return the squared distances between points and rows, using matrix products
+
+    This is much faster than subtracting all the pairs, but loses some precision,
+    so it is only used to rank the candidates.
+    """
+    dist2 = (points**2).sum(axis=1)[:, np.newaxis] - 2. * points @ rows.T + (rows**2).sum(axis=1)
+    return np.maximum(dist2, 0., out=dist2)
+
+
+def _nearest_rows(points, rows, k, block_size=2**22):
+    """Return the indices of the k rows nearest to each point, nearest first, by brute force"""
+    nearest = np.empty((len(points), k), dtype=int)
+    step = max(1, block_size // len(rows))
+    for start in range(0, len(points), step):
+        dist2 = _squared_distances(points[start:start + step], rows)
+        part = np.argpartition(dist2, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(dist2, part, axis=1), axis=1, kind='stable')
+        nearest[start:start + step] = np.take_along_axis(part, order, axis=1)
+    return nearest
+
+
+class IVFIndex:
+    """Approximate nearest neighbour index, using a coarse quantisation of the space (an inverted file)
+
+    The points are clustered by k-means into `n_lists` cells.  A query only looks at
+    the points of the `n_probe` cells whose centroids are nearest to it, so `n_probe`
+    trades speed for recall, `n_probe=n_lists` giving the exact neighbours.
+
+    The index only holds numpy arrays, so it can be pickled, written as an array
+    model and shared between processes.  It has the same `query()` interface as
+    sklearn's `KDTree`.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The points, one per row
+    n_lists : int
+        The number of cells, 0 for the square root of the number of points
+    n_probe : int
+        The default number of cells searched by a query
+    seed : int
+        Random number seed for the k-means clustering
+    sample_size : int
+        The k-means is run on at most `sample_size` points per cell
+    """
+
+    def __init__(self, data, n_lists=0, n_probe=8, seed=0, sample_size=64):
+        data = np.asarray(data, dtype=float)
+        npoints = len(data)
+        if n_lists <= 0:
+            n_lists = int(np.sqrt(npoints))
+        n_lists = max(1, min(n_lists, npoints))
+        rng = np.random.default_rng(seed)
+        sample = data[rng.choice(npoints, min(npoints, sample_size * n_lists), replace=False)]
+        centroids, _ = scipy.cluster.vq.kmeans2(sample, n_lists, minit='points', seed=seed)
+        labels, _ = scipy.cluster.vq.vq(data, centroids)
+        order = np.argsort(labels, kind='stable')
+        self.centroids = centroids
+        self.data = data[order]
+        self.ids = order
+        self.offsets = np.searchsorted(labels[order], np.arange(n_lists + 1))
+        self.n_probe = n_probe
+
+    def query(self, data, k=1, n_probe=None):
+        """Return the distances to, and the indices of, the k approximate nearest neighbours of the rows of data
+
+        The neighbours are sorted by distance.  If the `n_probe` cells searched for a
+        point hold fewer than k points, all the cells are searched for that point.
+        If the index holds fewer than k points, all of them are returned.
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=float))
+        k = min(k, len(self.data))
+        n_probe = min(self.n_probe if n_probe is None else n_probe, len(self.centroids))
+        positions = self._search(data, k, n_probe)
+        # the unfilled slots are not necessarily the last ones
+        missing = (positions < 0).any(axis=1)
+        if missing.any() and n_probe < len(self.centroids):
+            positions[missing] = self._search(data[missing], k, len(self.centroids))
+        # exact distances, for the final neighbours only
+        dists = np.sqrt(((data[:, np.newaxis, :] - self.data[positions])**2).sum(axis=-1))
+        order = np.argsort(dists, axis=1, kind='stable')
+        return np.take_along_axis(dists, order, axis=1), self.ids[np.take_along_axis(positions, order, axis=1)]
+
+    def _search(self, data, k, n_probe, block_size=2**22):
+        """Return the positions in self.data of the k nearest points in the n_probe nearest cells, or -1"""
+        best_dist2 = np.full((len(data), k), np.inf)
+        best_positions = np.full((len(data), k), -1)
+        # visit each cell once, with all the points that probe it
+        probes = _nearest_rows(data, self.centroids, n_probe).ravel()
+        order = np.argsort(probes, kind='stable')
+        queries = np.repeat(np.arange(len(data)), n_probe)[order]
+        cells, bounds = np.unique(probes[order], return_index=True)
+        bounds = np.append(bounds, len(order))
+        for cell, lo, hi in zip(cells, bounds[:-1], bounds[1:]):
+            first, last = self.offsets[cell], self.offsets[cell + 1]
+            if first == last:
+                continue
+            cell_positions = np.arange(first, last)
+            step = max(1, block_size // (last - first))
+            for start in range(lo, hi, step):
+                rows = queries[start:min(start + step, hi)]
+                dist2 = _squared_distances(data[rows], self.data[first:last])
+                cand_dist2 = np.concatenate([best_dist2[rows], dist2], axis=1)
+                cand_positions = np.concatenate([best_positions[rows], np.broadcast_to(cell_positions, dist2.shape)],
+                                                axis=1)
+                keep = np.argpartition(cand_dist2, k - 1, axis=1)[:, :k]
+                best_dist2[rows] = np.take_along_axis(cand_dist2, keep, axis=1)
+                best_positions[rows] = np.take_along_axis(cand_positions, keep, axis=1)
+        return best_positions
+
+
+def _mixture_pdf(zgrid, means, stds, weights):
+    """Evaluate gaussian mixtures on a grid, the mixtures are the rows of means, stds and weights"""
+    scaled = (zgrid - means[:, :, np.newaxis]) / stds[:, :, np.newaxis]
+    components = np.exp(-0.5 * scaled**2) / (np.sqrt(2. * np.pi) * stds[:, :, np.newaxis])
+    return np.einsum('nk,nkz->nz', weights, components)
+
+
+def _cde_loss(dists, ids, szs, sigma, zgrid, ztrue, block_size=None):
+    """Return the CDE loss of the PDFs built by `_makepdf`, for the true redshifts ztrue
+
+    This gives the same value as `rail.evaluation.metrics.cdeloss.CDELoss`, with the
+    PDFs evaluated on zgrid, but works on blocks of rows with plain numpy rather than
+    on a `qp.Ensemble`, so the memory used does not grow with the number of rows.
+    """
+    nrows, nneigh = dists.shape
+    if block_size is None:
+        block_size = max(1, 2**22 // (nneigh * zgrid.size))
+    # z bin closest to ztrue
+    nns = np.searchsorted((zgrid[1:] + zgrid[:-1]) / 2., ztrue, side='left')
+    term1 = 0.
+    term2 = 0.
+    for start in range(0, nrows, block_size):
+        end = min(start + block_size, nrows)
+        weights = 1. / dists[start:end]
+        weights /= weights.sum(axis=1, keepdims=True)
+        pdfs = _mixture_pdf(zgrid, szs[ids[start:end]], np.full_like(weights, sigma), weights)
+        term1 += np.trapz(pdfs**2, x=zgrid).sum()
+        term2 += pdfs[np.arange(end - start), nns[start:end]].sum()
+    return (term1 - 2 * term2) / nrows
+
+
+# The neighbours of the validation sample, in the worker processes of the hyperparameter search
+_WORKER_NEIGHBOURS = None
+
+
+def _init_search_worker(dists, ids, szs, zgrid, ztrue):
+    """Keep the neighbours of the validation sample, once per worker process"""
+    global _WORKER_NEIGHBOURS  #pylint: disable=global-statement
+    _WORKER_NEIGHBOURS = (dists, ids, szs, zgrid, ztrue)
+
+
+def _search_loss(sigma, nneigh):
+    """Return the CDE loss for one point of the hyperparameter grid, in a worker process"""
+    dists, ids, szs, zgrid, ztrue = _WORKER_NEIGHBOURS
+    return _cde_loss(dists[:, :nneigh], ids[:, :nneigh], szs, sigma, zgrid, ztrue)
+
+
 class Inform_KNearNeighPDF(CatInformer):
     """Train a KNN-based estimator
     """
@@ -61,7 +289,15 @@ class Inform_KNearNeighPDF(CatInformer):
                           ngrid_sigma=Param(int, 10, msg="number of grid points in sigma check"),
                           leaf_size=Param(int, 15, msg="min leaf size for KDTree"),
                           nneigh_min=Param(int, 3, msg="int, min number of near neighbors to use for PDF fit"),
-                          nneigh_max=Param(int, 7, msg="int, max number of near neighbors to use ofr PDF fit"))
+                          nneigh_max=Param(int, 7, msg="int, max number of near neighbors to use ofr PDF fit"),
+                          num_workers=Param(int, 1, msg="Number of worker processes used to search the sigma and "
+                                            "number of neighbors grid, 0 to use all the available cores"),
+                          index_type=Param(str, 'kdtree', msg="Neighbour index, 'kdtree' for an exact sklearn "
+                                           "KDTree, 'ivf' for an approximate inverted file index"),
+                          ivf_nlists=Param(int, 0, msg="Number of cells of the 'ivf' index, 0 for the square "
+                                           "root of the number of training objects"),
+                          ivf_nprobe=Param(int, 8, msg="Number of cells searched by the 'ivf' index, "
+                                           "larger values give better recall but slower queries"))
 
     def __init__(self, args, comm=None):
         """ Constructor
@@ -72,12 +308,26 @@ class Inform_KNearNeighPDF(CatInformer):
         usecols.append(self.config.redshift_col)
         self.usecols = usecols
         self.zgrid = None
+        if self.config.index_type not in ['kdtree', 'ivf']:
+            raise ValueError(f"Unknown index_type {self.config.index_type}, expected 'kdtree' or 'ivf'")
+
+    def input_columns(self, tag):
+        if tag == 'input':
+            return self.usecols
+        return None  #pragma: no cover
+
+    def _build_index(self, data):
+        """Build the neighbour index selected by `config.index_type` on the rows of data"""
+        from sklearn.neighbors import KDTree
+        if self.config.index_type == 'ivf':
+            return IVFIndex(data, n_lists=self.config.ivf_nlists, n_probe=self.config.ivf_nprobe,
+                            seed=self.config.seed)
+        return KDTree(data, leaf_size=self.config.leaf_size)
 
     def run(self):
         """
-        train a KDTree on a fraction of the training data
+        train a neighbour index on a fraction of the training data
         """
-        from sklearn.neighbors import KDTree
         if self.config.hdf5_groupname:
             training_data = self.get_data('input')[self.config.hdf5_groupname]
         else:  # pragma: no cover
@@ -106,28 +356,38 @@ class Inform_KNearNeighPDF(CatInformer):
         train_sz = np.array(copy.deepcopy(xtrain_sz))
         val_sz = np.array(trainszs[perm[ntrain:]])
         print(f"split into {len(train_sz)} training and {len(val_sz)} validation samples")
-        tmpmodel = KDTree(train_data, leaf_size=self.config.leaf_size)
+        tmpmodel = self._build_index(train_data)
         # Find best sigma and n_neigh by minimizing CDE Loss
         bestloss = 1e20
         bestsig = self.config.sigma_grid_min
         bestnn = self.config.nneigh_min
         siggrid = np.linspace(self.config.sigma_grid_min, self.config.sigma_grid_max, self.config.ngrid_sigma)
         print("finding best fit sigma and NNeigh...")
-        for sig in siggrid:
-            for nn in range(self.config.nneigh_min, self.config.nneigh_max + 1):
-                dists, idxs = tmpmodel.query(val_data, k=nn)
-                ens = _makepdf(dists, idxs, train_sz, sig)
-                cdelossobj = CDELoss(ens, self.zgrid, val_sz)
-                cdeloss = cdelossobj.evaluate().statistic
-                if cdeloss < bestloss:
-                    bestsig = sig
-                    bestnn = nn
-                    bestloss = cdeloss
+        # the neighbours are sorted by distance, so the nn nearest are the first nn of the nneigh_max nearest
+        dists, idxs = tmpmodel.query(val_data, k=self.config.nneigh_max)
+        grid = [(sig, nn) for sig in siggrid for nn in range(self.config.nneigh_min, self.config.nneigh_max + 1)]
+        num_workers = self.config.num_workers if self.config.num_workers > 0 else os.cpu_count()
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(grid)),
+                                     mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_search_worker,
+                                     initargs=(dists, idxs, train_sz, self.zgrid, val_sz)) as pool:
+                losses = list(pool.map(_search_loss, *zip(*grid)))
+        else:
+            losses = [_cde_loss(dists[:, :nn], idxs[:, :nn], train_sz, sig, self.zgrid, val_sz)
+                      for sig, nn in grid]
+        for (sig, nn), cdeloss in zip(grid, losses):
+            if cdeloss < bestloss:
+                bestsig = sig
+                bestnn = nn
+                bestloss = cdeloss
         numneigh = bestnn
         sigma = bestsig
         print(f"\n\n\nbest fit values are sigma={sigma} and numneigh={numneigh}\n\n\n")
         # remake tree with full dataset!
-        kdtree = KDTree(colordata, leaf_size=self.config.leaf_size)
+        kdtree = self._build_index(colordata)
+        # the 'kdtree' entry holds whichever index was built, models written before the
+        # index choice was added hold a KDTree there
         self.model = dict(kdtree=kdtree, bestsig=sigma, nneigh=numneigh, truezs=trainszs)
         self.add_data('model', self.model)
 
@@ -144,7 +404,13 @@ class KNearNeighPDF(CatEstimator):
                           ref_band=SHARED_PARAMS,
                           nondetect_val=SHARED_PARAMS,
                           mag_limits=SHARED_PARAMS,
-                          redshift_col=SHARED_PARAMS)
+                          redshift_col=SHARED_PARAMS,
+                          num_threads=Param(int, 1, msg="Number of threads used for the neighbour queries, "
+                                            "0 to use all the available cores"),
+                          ivf_nprobe=Param(int, 0, msg="Number of cells searched by an 'ivf' index, "
+                                           "0 to use the value the index was built with"),
+                          zmode_tol=Param(float, 1e-4, msg="Accuracy, in redshift, of the zmode found "
+                                          "by refining the mixture peaks near the neighbour redshifts"))
 
     def __init__(self, args, comm=None):
         """ Constructor:
@@ -159,6 +425,23 @@ class KNearNeighPDF(CatEstimator):
         usecols.append(self.config.redshift_col)
         self.usecols = usecols
 
+    def input_columns(self, tag):
+        if tag == 'input':
+            return self.config.bands
+        return None  #pragma: no cover
+
+    def output_row_bytes(self):
+        if self.numneigh is None:  #pragma: no cover
+            return CatEstimator.output_row_bytes(self)
+        # mixture of numneigh gaussians, plus the mode
+        return 8 * (3 * self.numneigh + 1)
+
+    def working_set_factor(self):
+        # the mode is found by evaluating each of the mixture components at one point per component
+        if self.numneigh is None:  #pragma: no cover
+            return 1.
+        return max(self.numneigh / 3., 1.)
+
     def open_model(self, **kwargs):
         CatEstimator.open_model(self, **kwargs)
         if self.model is None:  #pragma: no cover
@@ -185,8 +468,15 @@ class KNearNeighPDF(CatEstimator):
                 knn_df.loc[np.isclose(knn_df[col], self.config.nondetect_val), col] = self.config.mag_limits[col]
 
         testcolordata = _computecolordata(knn_df, self.config.ref_band, self.config.bands)
-        dists, idxs = self.kdtree.query(testcolordata, k=self.numneigh)
+        query_kwargs = {}
+        if self.config.ivf_nprobe > 0 and isinstance(self.kdtree, IVFIndex):
+            query_kwargs['n_probe'] = self.config.ivf_nprobe
+        dists, idxs = _threaded_query(self.kdtree, testcolordata, self.numneigh, self.config.num_threads,
+                                      **query_kwargs)
         test_ens = _makepdf(dists, idxs, self.trainszs, self.sigma)
-        zmode = test_ens.mode(grid=self.zgrid)
+        zmode = _mixture_mode(test_ens.dist.means, test_ens.dist.stds, test_ens.dist.weights,
+                              tol=self.config.zmode_tol)
+        # same (npdf, 1) shape as returned by qp's Ensemble.mode()
+        zmode = np.clip(zmode, self.config.zmin, self.config.zmax)[:, np.newaxis]
         test_ens.set_ancil(dict(zmode=zmode))
         self._do_chunk_output(test_ens, start, end, first)
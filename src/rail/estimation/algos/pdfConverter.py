@@ -0,0 +1,104 @@
+"""
+A stage that converts the p(z) in a qp file to another, usually more compact, representation
+"""
+
+import numpy as np
+from ceci.config import StageParameter as Param
+from rail.estimation.estimator import CatEstimator
+from rail.core.common_params import SHARED_PARAMS
+from rail.core.data import QPHandle
+import qp
+from qp import sparse_rep
+
+REPRESENTATIONS = ['quant', 'hist', 'interp', 'sparse']
+
+
+class PDFConverter(CatEstimator):
+    """Convert the p(z) of a qp file to quantiles, histograms, a grid or a sparse basis
+
+    The input file is read, converted and written chunk by chunk, so that the
+    memory used does not depend on the number of PDFs.  As for the other
+    `CatEstimator`, the chunks can be spread over MPI ranks or, with
+    `parallel_backend='processes'`, over a pool of worker processes.
+
+    The ancil data of the input, e.g., point estimates, are passed through.
+
+    Notes
+    -----
+    The representations are:
+
+    - 'quant': `nquants` quantiles, evenly spaced in ]0, 1[
+    - 'hist': histograms with `nzbins` bins between `zmin` and `zmax`
+    - 'interp': values on a grid of `nzbins` points between `zmin` and `zmax`
+    - 'sparse': sparse combinations of Voigt profiles, fit to the values on the same grid
+    """
+
+    name = 'PDFConverter'
+    config_options = CatEstimator.config_options.copy()
+    config_options.update(hdf5_groupname='',
+                          zmin=SHARED_PARAMS,
+                          zmax=SHARED_PARAMS,
+                          nzbins=SHARED_PARAMS,
+                          representation=Param(str, 'quant', msg="Representation of the output PDFs, "
+                                               "'quant', 'hist', 'interp' or 'sparse'"),
+                          nquants=Param(int, 21, msg="Number of quantiles, for the 'quant' representation"))
+    inputs = [('input', QPHandle)]
+
+    def __init__(self, args, comm=None):
+        CatEstimator.__init__(self, args, comm=comm)
+        if self.config.representation not in REPRESENTATIONS:
+            raise ValueError(f"Unknown representation {self.config.representation}, "
+                             f"expected one of {REPRESENTATIONS}")
+
+    def output_row_bytes(self):
+        """Return an estimate of the size, in bytes, of the output for one input row"""
+        if self.config.representation == 'quant':
+            return 8 * (self.config.nquants + 2)
+        if self.config.representation == 'sparse':
+            return 8 * 20
+        return 8 * self.config.nzbins
+
+    def convert(self, input_data):
+        """Convert the PDFs, this is the same as `estimate()`
+
+        Parameters
+        ----------
+        input_data : `qp.Ensemble` or `QPHandle`
+            The PDFs to convert
+
+        Returns
+        -------
+        output: `QPHandle`
+            Handle providing access to the converted PDFs
+        """
+        return self.estimate(input_data)
+
+    def _convert_chunk(self, data):
+        """Return a chunk of PDFs in the output representation"""
+        representation = self.config.representation
+        if representation == 'quant':
+            quants = np.linspace(0., 1., self.config.nquants + 2)[1:-1]
+            return data.convert_to(qp.quant_gen, quants=quants)
+        if representation == 'hist':
+            bins = np.linspace(self.config.zmin, self.config.zmax, self.config.nzbins + 1)
+            return data.convert_to(qp.hist_gen, bins=bins)
+        zgrid = np.linspace(self.config.zmin, self.config.zmax, self.config.nzbins)
+        if representation == 'interp':
+            return data.convert_to(qp.interp_gen, xvals=zgrid)
+        # the basis only depends on the grid, so it is the same for all the chunks
+        sparse_indices, meta, _ = sparse_rep.build_sparse_representation(zgrid, data.pdf(zgrid), verbose=False)
+        return qp.Ensemble(qp.sparse, data=dict(xvals=zgrid, mu=meta['mu'], sig=meta['sig'], dims=meta['dims'],
+                                                sparse_indices=sparse_indices))
+
+    def _run_process_pool(self, iterator):
+        # the ensembles of some representations, e.g., the scipy distributions,
+        # can not be pickled, so the chunks are sent to the workers as tables
+        CatEstimator._run_process_pool(self, ((s, e, data.build_tables()) for s, e, data in iterator))
+
+    def _process_chunk(self, start, end, data, first):
+        if isinstance(data, dict):
+            data = qp.from_tables(data)
+        converted = self._convert_chunk(data)
+        if data.ancil is not None:
+            converted.set_ancil(data.ancil)
+        self._do_chunk_output(converted, start, end, first)
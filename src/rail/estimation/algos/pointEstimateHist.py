@@ -31,13 +31,14 @@ class PointEstimateHist(PZSummarizer):
 
     def run(self):
         rng = np.random.default_rng(seed=self.config.seed)
-        test_data = self.get_data('input')
-        npdf = test_data.npdf
-        zb = test_data.ancil['zmode']
+        # only the point estimates are needed, not the PDFs
+        ancil = self.get_ancil('input', columns=sorted({'zmode', self.config.point_estimate}))
+        zb = ancil['zmode']
+        npdf = len(zb)
         nsamp = self.config.nsamples
         self.zgrid = np.linspace(self.config.zmin, self.config.zmax, self.config.nzbins + 1)
         self.bincents = 0.5 * (self.zgrid[1:] + self.zgrid[:-1])
-        single_hist = np.histogram(test_data.ancil[self.config.point_estimate], bins=self.zgrid)[0]
+        single_hist = np.histogram(ancil[self.config.point_estimate], bins=self.zgrid)[0]
         qp_d = qp.Ensemble(qp.hist,
                            data=dict(bins=self.zgrid, pdfs=np.atleast_2d(single_hist)))
         hist_vals = np.empty((nsamp, self.config.nzbins))
@@ -191,6 +191,14 @@ class PZFlowPDF(CatEstimator):
         self.allcols = allcols
         self.zgrid = None
 
+    def working_set_factor(self):
+        # the posterior evaluates the flow, on all the columns, at every point of the z grid,
+        # and for every error sample if the magnitude errors are marginalized over
+        factor = len(self.allcols)
+        if self.config.include_mag_errors:  #pragma: no cover
+            factor *= self.config.n_error_samples
+        return factor
+
     def _process_chunk(self, start, end, data, first):
         """
         calculate and return PDFs for each galaxy using the trained flow
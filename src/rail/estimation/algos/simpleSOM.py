@@ -109,7 +109,7 @@ class Inform_SimpleSOMSummarizer(CatInformer):
                 mask = np.isnan(training_data[col])
             else:
                 mask = np.isclose(training_data[col], self.config.nondetect_val)
-            training_data[col][mask] = self.config.mag_limits[col]
+            training_data[col] = np.where(mask, self.config.mag_limits[col], training_data[col])
 
         colors = _computemagcolordata(training_data, self.config.ref_band,
                                       self.config.bands, self.config.column_usage)
@@ -260,7 +260,7 @@ class SimpleSOMSummarizer(SZPZSummarizer):
                     mask = np.isnan(dset[col])
                 else:
                     mask = np.isclose(dset[col], self.config.nondetect_val)
-                dset[col][mask] = self.config.mag_limits[col]
+                dset[col] = np.where(mask, self.config.mag_limits[col], dset[col])
 
         self.zgrid = np.linspace(self.config.zmin, self.config.zmax, self.config.nzbins + 1)
         # assign weight vecs if present, else set all to 1.0
@@ -214,7 +214,7 @@ class Inform_somocluSOMSummarizer(CatInformer):
                 mask = np.isnan(training_data[col])
             else:
                 mask = np.isclose(training_data[col], self.config.nondetect_val)
-            training_data[col][mask] = self.config.mag_limits[col]
+            training_data[col] = np.where(mask, self.config.mag_limits[col], training_data[col])
 
         colors = _computemagcolordata(training_data, self.config.ref_band,
                                       self.config.bands, self.config.column_usage)
@@ -339,7 +339,7 @@ class somocluSOMSummarizer(SZPZSummarizer):
                 mask = np.isnan(data[col])
             else:
                 mask = np.isclose(data[col], self.config.nondetect_val)
-            data[col][mask] = self.config.mag_limits[col]
+            data[col] = np.where(mask, self.config.mag_limits[col], data[col])
 
     def set_weight_column(self, data, weight_col):
         # assign weight vecs if present, else set all to 1.0
@@ -2,10 +2,43 @@
 Abstract base classes defining redshift estimations Informers and Estimators
 """
 
-from rail.core.data import TableHandle, QPHandle, ModelHandle
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from ceci.config import StageParameter as Param
+from rail.core.data import DATA_STORE, TableHandle, QPHandle, ModelHandle
 from rail.core.stage import RailStage
+from rail.core.background import ChunkWriter, close_iterator
 import gc
 
+# The estimator used by the current worker process of the 'processes' backend
+_WORKER_ESTIMATOR = None
+
+
+def _init_worker(stage_class, args):
+    """Build the estimator, and load its model, once per worker process"""
+    global _WORKER_ESTIMATOR  #pylint: disable=global-statement
+    # the spawned worker re-imports the main module of the parent, which may have put
+    # handles in the DataStore, e.g., a script reading its inputs at module level, and
+    # those would clash with the handles of the estimator built here
+    DATA_STORE().clear()
+    _WORKER_ESTIMATOR = stage_class(args)
+    _WORKER_ESTIMATOR._worker_output = []  #pylint: disable=protected-access
+
+
+def _process_chunk_in_worker(start, end, data):
+    """Run the estimator of this worker process on one chunk, and return its output"""
+    estimator = _WORKER_ESTIMATOR
+    print(f"Worker {os.getpid()} running estimator on chunk {start} - {end}")
+    estimator._process_chunk(start, end, data, False)  #pylint: disable=protected-access
+    output = estimator._worker_output  #pylint: disable=protected-access
+    estimator._worker_output = []  #pylint: disable=protected-access
+    gc.collect()
+    return output
+
+
 class CatEstimator(RailStage):
     """The base class for making photo-z posterior estimates from catalog-like inputs
     (i.e., tables with fluxes in photometric bands among the set of columns)
@@ -19,7 +52,19 @@ class CatEstimator(RailStage):
 
     name = 'CatEstimator'
     config_options = RailStage.config_options.copy()
-    config_options.update(chunk_size=10000, hdf5_groupname=str)
+    config_options.update(chunk_size=10000, hdf5_groupname=str,
+                          write_behind_depth=Param(int, 0, msg="Number of output chunks that can be queued "
+                                                   "for a background writer thread, 0 to write synchronously"),
+                          parallel_backend=Param(str, 'serial', msg="How the chunks are processed, 'serial' or "
+                                                 "'processes' to spread them over a pool of worker processes"),
+                          num_workers=Param(int, 0, msg="Number of worker processes used by the 'processes' "
+                                            "backend, 0 to use all the available cores"),
+                          shared_model=Param(bool, False, msg="With MPI, load the model on one rank per node, "
+                                             "and share its arrays with the other ranks through shared memory"),
+                          output_precision=Param(str, 'float64', msg="Floating point precision used to store "
+                                                 "the output PDFs, 'float64' or 'float32'"),
+                          output_compression=Param(str, '', msg="HDF5 compression filter applied to the "
+                                                   "output PDFs, e.g., 'gzip' or 'lzf', empty for none"))
     inputs = [('model', ModelHandle),
               ('input', TableHandle)]
     outputs = [('output', QPHandle)]
@@ -27,8 +72,14 @@ class CatEstimator(RailStage):
     def __init__(self, args, comm=None):
         """Initialize Estimator"""
         RailStage.__init__(self, args, comm=comm)
+        if self.config.output_precision not in ('float64', 'float32'):
+            raise ValueError(f"Unknown output_precision {self.config.output_precision}, "
+                             "expected 'float64' or 'float32'")
         self._output_handle = None
+        self._chunk_writer = None
+        self._worker_output = None
         self.model = None
+        self._model_window = None
         if not isinstance(args, dict):  #pragma: no cover
             args = vars(args)
         self.open_model(**args)
@@ -52,6 +103,9 @@ class CatEstimator(RailStage):
         if model is None or model == 'None':
             self.model = None
             return self.model
+        if self.config.shared_model:
+            self.model, self._model_window = self.open_shared_model(model)
+            return self.model
         if isinstance(model, str):
             self.model = self.set_data('model', data=None, path=model)
             self.config['model'] = model
@@ -62,6 +116,14 @@ class CatEstimator(RailStage):
         self.model = self.set_data('model', model)
         return self.model
 
+    def output_row_bytes(self):
+        """Return an estimate of the size, in bytes, of the output for one input row
+
+        By default this assumes a p(z) tabulated on `config.nzbins` points, plus a point estimate.
+        """
+        nzbins = self.config['nzbins'] if 'nzbins' in self.config else 0
+        return 8 * (nzbins + 1)
+
     def estimate(self, input_data):
         """The main interface method for the photo-z estimation
 
@@ -92,34 +154,107 @@ class CatEstimator(RailStage):
         return self.get_handle('output')
 
     def run(self):
+        if self.config.parallel_backend not in ('serial', 'processes'):
+            raise ValueError(f"Unknown parallel_backend {self.config.parallel_backend}, "
+                             "expected 'serial' or 'processes'")
         iterator = self.input_iterator('input')
         first = True
         self._initialize_run()
         self._output_handle = None
-        for s, e, test_data in iterator:
-            print(f"Process {self.rank} running estimator on chunk {s} - {e}")
-            self._process_chunk(s, e, test_data, first)
-            first = False
-            # Running garbage collection manually seems to be needed
-            # to avoid memory growth for some estimators
-            gc.collect()
+        try:
+            if self.config.parallel_backend == 'processes':
+                self._run_process_pool(iterator)
+            else:
+                for s, e, test_data in iterator:
+                    print(f"Process {self.rank} running estimator on chunk {s} - {e}")
+                    with self.metrics.measure('compute', s, e):
+                        self._process_chunk(s, e, test_data, first)
+                    first = False
+                    # Running garbage collection manually seems to be needed
+                    # to avoid memory growth for some estimators
+                    gc.collect()
+        finally:
+            # stop the prefetching thread, if any, when a chunk fails
+            close_iterator(iterator)
         self._finalize_run()
 
+    def _run_process_pool(self, iterator):
+        """Process the chunks on a pool of worker processes
+
+        Each worker builds its own copy of this estimator, with the same configuration
+        and model, when it starts.  The chunks are then sent to the workers, and their
+        outputs are written by this process, in the order in which the chunks were read,
+        so the output is identical to the one of the serial backend.  At most two chunks
+        per worker are in flight at any time.
+        """
+        num_workers = self.config.num_workers if self.config.num_workers > 0 else os.cpu_count()
+        args = self.config.to_dict()
+        args.update(model=self.model, parallel_backend='serial', prefetch_depth=0)
+        pending = deque()
+        first = True
+        # spawn, rather than fork, so that the workers do not inherit the reader threads
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(type(self), args)) as pool:
+            for s, e, test_data in iterator:
+                print(f"Process {self.rank} sending chunk {s} - {e} to the worker pool")
+                if isinstance(test_data, dict):
+                    # some readers re-use the same dict for every chunk
+                    test_data = test_data.copy()
+                pending.append(pool.submit(_process_chunk_in_worker, s, e, test_data))
+                if len(pending) >= 2 * num_workers:
+                    first = self._write_worker_output(pending.popleft(), first)
+            while pending:
+                first = self._write_worker_output(pending.popleft(), first)
+
+    def _write_worker_output(self, future, first):
+        """Write the output of one chunk processed by a worker, returns the updated `first` flag"""
+        # the time spent waiting for the workers is counted as compute time
+        with self.metrics.measure('compute') as event:
+            output = future.result()
+            if output:
+                event.update(start=output[0][1], end=output[-1][2], rows=output[-1][2] - output[0][1])
+        for qp_dstn, start, end in output:
+            self._do_chunk_output(qp_dstn, start, end, first)
+            first = False
+        return first
+
     def _initialize_run(self):
         self._output_handle = None
 
     def _finalize_run(self):
-        self._output_handle.finalize_write()
+        if self._chunk_writer is not None:
+            # make sure all the queued chunks are on disk before writing the metadata
+            with self.metrics.measure('write'):
+                self._chunk_writer.close()
+            self._chunk_writer = None
+        with self.metrics.measure('finalize'):
+            self._output_handle.finalize_write()
 
     def _process_chunk(self, start, end, data, first):
         raise NotImplementedError(f"{self.name}._process_chunk is not implemented")  #pragma: no cover
 
     def _do_chunk_output(self, qp_dstn, start, end, first):
+        if self._worker_output is not None:
+            # in a worker process, the output is sent back to the parent process
+            self._worker_output.append((qp_dstn, start, end))
+            return
         if first:
             self._output_handle = self.add_handle('output', data = qp_dstn)
-            self._output_handle.initialize_write(self._input_length, communicator = self.comm)
+            precision = self.config.output_precision if self.config.output_precision != 'float64' else None
+            self._output_handle.initialize_write(self._input_length, communicator = self.comm,
+                                                 precision=precision,
+                                                 compression=self.config.output_compression or None)
+            if self.config.write_behind_depth > 0:
+                self._chunk_writer = ChunkWriter(depth=self.config.write_behind_depth)
         self._output_handle.set_data(qp_dstn, partial=True)
-        self._output_handle.write_chunk(start, end)
+        # with write-behind, this measures the time spent waiting for room in the queue
+        with self.metrics.measure('write', start, end, data=qp_dstn):
+            if self._chunk_writer is None:
+                self._output_handle.write_chunk(start, end)
+            else:
+                self._chunk_writer.submit(self._output_handle.write_chunk, start, end, data=qp_dstn)
 
 
 
@@ -1,6 +1,7 @@
 """
 Abstract base classes defining redshift estimations Informers and Estimators
 """
+from ceci.config import StageParameter as Param
 from rail.core.data import QPHandle, TableHandle, ModelHandle
 from rail.core.stage import RailStage
 
@@ -111,7 +112,9 @@ class SZPZSummarizer(RailStage):
     """
     name = 'SZPZtoNZSummarizer'
     config_options = RailStage.config_options.copy()
-    config_options.update(chunk_size=10000)
+    config_options.update(chunk_size=10000,
+                          shared_model=Param(bool, False, msg="With MPI, load the model on one rank per node, "
+                                             "and share its arrays with the other ranks through shared memory"))
     inputs = [('input', TableHandle),
               ('spec_input', TableHandle),
               ('model', ModelHandle)]
@@ -121,6 +124,7 @@ class SZPZSummarizer(RailStage):
         """Initialize Estimator that can sample galaxy data."""
         RailStage.__init__(self, args, comm=comm)
         self.model = None
+        self._model_window = None
         if not isinstance(args, dict):  #pragma: no cover
             args = vars(args)
         self.open_model(**args)
@@ -145,6 +149,9 @@ class SZPZSummarizer(RailStage):
         if model is None or model == 'None':  # pragma: no cover
             self.model = None
             return self.model
+        if self.config.shared_model:
+            self.model, self._model_window = self.open_shared_model(model)
+            return self.model
         if isinstance(model, str):
             self.model = self.set_data('model', data=None, path=model)
             self.config['model'] = model
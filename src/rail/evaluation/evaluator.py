@@ -26,7 +26,9 @@ class Evaluator(RailStage):
                           nzbins=Param(int, 301, msg="# of bins in zgrid"),
                           pit_metrics=Param(str, 'all', msg='PIT-based metrics to include'),
                           point_metrics=Param(str, 'all', msg='Point-estimate metrics to include'),
-                          do_cde=Param(bool, True, msg='Evaluate CDE Metric'))
+                          do_cde=Param(bool, True, msg='Evaluate CDE Metric'),
+                          point_estimate=Param(str, '', msg="Ancil column used as point estimate, "
+                                               "if empty the mode is computed on the z grid"))
     inputs = [('input', QPHandle),
               ('truth', Hdf5Handle)]
     outputs = [('output', Hdf5Handle)]
@@ -76,29 +78,37 @@ class Evaluator(RailStage):
         Get the input data from the data store under this stages 'input' tag
         Get the truth data from the data store under this stages 'truth' tag
         Puts the data into the data store under this stages 'output' tag
-        """
-
-        pz_data = self.get_data('input')
-        z_true = self.get_data('truth')['redshift']
-        zgrid = np.linspace(self.config.zmin, self.config.zmax, self.config.nzbins+1)
-
-        # Create an instance of the PIT class
-        pitobj = PIT(pz_data, z_true)
 
-        # Build reference dictionary of the PIT meta-metrics from this PIT instance
-        PIT_METRICS = dict(
-            AD=getattr(pitobj, 'evaluate_PIT_anderson_ksamp'),
-            CvM=getattr(pitobj, 'evaluate_PIT_CvM'),
-            KS=getattr(pitobj, 'evaluate_PIT_KS'),
-            OutRate=getattr(pitobj, 'evaluate_PIT_outlier_rate'),
-        )
+        If `config.point_estimate` is set, and neither the PIT metrics nor the
+        CDE loss are requested, only that ancil column is read from the input,
+        and not the PDFs.
+        """
 
         # Parse the input configuration to determine which meta-metrics should be calculated
         if self.config.pit_metrics == 'all':
-            pit_metrics = list(PIT_METRICS.keys())
-        else:  #pragma: no cover
+            pit_metrics = ['AD', 'CvM', 'KS', 'OutRate']
+        else:
             pit_metrics = self.config.pit_metrics.split()
 
+        z_true = self.get_data('truth')['redshift']
+        zgrid = np.linspace(self.config.zmin, self.config.zmax, self.config.nzbins+1)
+        if pit_metrics or self.config.do_cde or not self.config.point_estimate:
+            pz_data = self.get_data('input')
+        else:
+            pz_data = None
+
+        if pit_metrics:
+            # Create an instance of the PIT class
+            pitobj = PIT(pz_data, z_true)
+
+            # Build reference dictionary of the PIT meta-metrics from this PIT instance
+            PIT_METRICS = dict(
+                AD=getattr(pitobj, 'evaluate_PIT_anderson_ksamp'),
+                CvM=getattr(pitobj, 'evaluate_PIT_CvM'),
+                KS=getattr(pitobj, 'evaluate_PIT_KS'),
+                OutRate=getattr(pitobj, 'evaluate_PIT_outlier_rate'),
+            )
+
         # Evaluate each of the requested meta-metrics, and store the result in `out_table`
         out_table = {}
         for pit_metric in pit_metrics:
@@ -124,7 +134,9 @@ class Evaluator(RailStage):
 
         z_mode = None
         for point_metric in point_metrics:
-            if z_mode is None:
+            if z_mode is None and self.config.point_estimate:
+                z_mode = self.get_ancil('input', columns=[self.config.point_estimate])[self.config.point_estimate]
+            elif z_mode is None:
                 z_mode = np.squeeze(pz_data.mode(grid=zgrid))
             value = POINT_METRICS[point_metric](z_mode, z_true).evaluate()
             out_table[f'POINT_{point_metric}'] = [value]
@@ -1,10 +1,18 @@
+import json
+import os
+import tracemalloc
+
 import numpy as np
 import pytest
+import qp
 import scipy.special
 
-from rail.core.algo_utils import one_algo
+from rail.core import array_model, cache
+from rail.core.background import PrefetchIterator
+from rail.core.algo_utils import one_algo, traindata, validdata
+from rail.core.data import QPHandle, TableHandle
 from rail.core.stage import RailStage
-from rail.estimation.algos import knnpz, pzflow, randomPZ, sklearn_nn, trainZ
+from rail.estimation.algos import knnpz, pdfConverter, pzflow, randomPZ, sklearn_nn, trainZ
 
 sci_ver_str = scipy.__version__.split(".")
 
@@ -133,11 +141,265 @@ def test_train_pz():
     assert np.isclose(results.ancil["zmode"], rerun_results.ancil["zmode"]).all()
 
 
+@pytest.fixture
+def train_z_model(tmp_path):
+    """Inform trainZ on the training data, writing the model under tmp_path
+
+    Returns the model handle and the validation data handle
+    """
+    DS.clear()
+    training_data = DS.read_file("training_data", TableHandle, traindata)
+    validation_data = DS.read_file("validation_data", TableHandle, validdata)
+    train_pz = trainZ.Inform_trainZ.make_stage(hdf5_groupname="photometry", model=str(tmp_path / "model_train_z.pkl"))
+    train_pz.inform(training_data)
+    return train_pz.get_handle("model"), validation_data
+
+
+def test_train_pz_write_behind(train_z_model, tmp_path):
+    model, validation_data = train_z_model
+
+    outputs = []
+    for depth in [0, 2]:
+        pz = trainZ.TrainZ.make_stage(
+            name=f"TrainZ_wb{depth}",
+            hdf5_groupname="photometry",
+            model=model,
+            chunk_size=3,
+            write_behind_depth=depth,
+            output=str(tmp_path / f"output_wb{depth}.hdf5"),
+        )
+        pz.estimate(validation_data)
+        output_file = pz.get_output(pz.get_aliased_tag("output"), final_name=True)
+        outputs.append(qp.read(output_file))
+
+    assert outputs[1].npdf == 10
+    assert np.isclose(outputs[1].ancil["zmode"], np.repeat(0.1445183, 10)).all()
+    assert np.array_equal(outputs[0].objdata()["yvals"], outputs[1].objdata()["yvals"])
+
+
+def test_train_pz_metrics(train_z_model, tmp_path):
+    model, validation_data = train_z_model
+
+    metrics_file = str(tmp_path / "metrics.jsonl")
+    was_tracing = tracemalloc.is_tracing()
+    pz = trainZ.TrainZ.make_stage(
+        name="TrainZ_metrics",
+        hdf5_groupname="photometry",
+        model=model,
+        chunk_size=3,
+        metrics_file=metrics_file,
+        metrics_prom_file=str(tmp_path / "{name}.prom"),
+        trace_memory=True,
+        output=str(tmp_path / "output_metrics.hdf5"),
+    )
+    pz.estimate(validation_data)
+    # the memory tracing is only left on if it was already on before the stage ran
+    assert tracemalloc.is_tracing() == was_tracing
+
+    with open(metrics_file) as fin:
+        events = [json.loads(line) for line in fin]
+    for phase in ["read", "compute", "write"]:
+        phase_events = [event for event in events if event["phase"] == phase]
+        assert [(event["start"], event["end"]) for event in phase_events] == [(0, 3), (3, 6), (6, 9), (9, 10)]
+        assert all(event["seconds"] >= 0 for event in phase_events)
+    assert all(event["nbytes"] > 0 for event in events if event["phase"] in ["read", "write"])
+    assert len([event for event in events if event["phase"] == "finalize"]) == 2
+    stage_event = events[-1]
+    assert stage_event["phase"] == "stage"
+    assert stage_event["rows"] == 10
+    assert stage_event["peak_rss"] > 0
+    assert stage_event["peak_traced"] > 0
+
+    with open(tmp_path / "TrainZ_metrics.prom") as fin:
+        prom = fin.read()
+    assert 'rail_stage_rows{stage="TrainZ_metrics",rank="0",phase="compute"} 10' in prom
+    assert "# TYPE rail_stage_peak_rss_bytes gauge" in prom
+
+
+def test_train_pz_cache(train_z_model, tmp_path, monkeypatch):
+    model, validation_data = train_z_model
+
+    cache_dir = str(tmp_path / "cache")
+    config = dict(hdf5_groupname="photometry", model=model, cache_dir=cache_dir)
+    pz = trainZ.TrainZ.make_stage(name="TrainZ_cache_miss", output=str(tmp_path / "output_miss.hdf5"), **config)
+    first = pz.estimate(validation_data).data
+    entries = cache.StageCache(cache_dir).entries()
+    assert len(entries) == 1
+    assert entries[0]["stage"] == "TrainZ"
+
+    # a hit does not process any data, but attaches the cached output
+    def fail(*args, **kwargs):
+        raise AssertionError("TrainZ was run despite a cache hit")
+
+    monkeypatch.setattr(trainZ.TrainZ, "_process_chunk", fail)
+    pz_hit = trainZ.TrainZ.make_stage(name="TrainZ_cache_hit", output=str(tmp_path / "output_hit.hdf5"), **config)
+    second = pz_hit.estimate(validation_data).data
+    assert np.allclose(first.pdf(np.linspace(0, 3, 31)), second.pdf(np.linspace(0, 3, 31)))
+    assert os.path.exists(pz_hit.get_output(pz_hit.get_aliased_tag("output"), final_name=True))
+    # the options that only change how the stage runs do not change the cache key
+    pz_runtime = trainZ.TrainZ.make_stage(
+        name="TrainZ_cache_runtime",
+        output=str(tmp_path / "output_runtime.hdf5"),
+        memory_budget=1.0,
+        prefetch_depth=2,
+        write_behind_depth=2,
+        **config,
+    )
+    pz_runtime.estimate(validation_data)
+    monkeypatch.undo()
+
+    pz_other = trainZ.TrainZ.make_stage(
+        name="TrainZ_cache_other", zmax=2.5, output=str(tmp_path / "output_other.hdf5"), **config
+    )
+    pz_other.estimate(validation_data)
+    assert len(cache.StageCache(cache_dir).entries()) == 2
+
+    assert cache.main(["list", cache_dir]) == 0
+    assert cache.main(["prune", cache_dir, "--max-size", "0"]) == 0
+    assert not cache.StageCache(cache_dir).entries()
+
+
+def test_train_pz_failed_chunk(train_z_model, tmp_path, monkeypatch):
+    model, _ = train_z_model
+
+    pz = trainZ.TrainZ.make_stage(
+        name="TrainZ_failed",
+        hdf5_groupname="photometry",
+        model=model,
+        input=validdata,
+        chunk_size=3,
+        prefetch_depth=2,
+        metrics_file=str(tmp_path / "metrics.jsonl"),
+        output=str(tmp_path / "output_failed.hdf5"),
+    )
+    prefetchers = []
+
+    class RecordingPrefetchIterator(PrefetchIterator):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            prefetchers.append(self)
+
+    def failing_chunk(*args, **kwargs):
+        raise RuntimeError("bad chunk")
+
+    monkeypatch.setattr("rail.core.stage.PrefetchIterator", RecordingPrefetchIterator)
+    monkeypatch.setattr(pz, "_process_chunk", failing_chunk)
+    with pytest.raises(RuntimeError):
+        pz.run()
+    # run() closed the metrics generator, which closed the prefetching iterator
+    assert len(prefetchers) == 1
+    assert not prefetchers[0]._thread.is_alive()
+
+
+def test_bad_output_precision():
+    with pytest.raises(ValueError):
+        trainZ.TrainZ.make_stage(name="TrainZ_bad_precision", hdf5_groupname="photometry", output_precision="float23")
+
+
+def test_train_pz_process_pool(train_z_model, tmp_path):
+    model, validation_data = train_z_model
+
+    outputs = []
+    for backend in ["serial", "processes"]:
+        pz = trainZ.TrainZ.make_stage(
+            name=f"TrainZ_{backend}",
+            hdf5_groupname="photometry",
+            model=model,
+            chunk_size=3,
+            parallel_backend=backend,
+            num_workers=2,
+            output=str(tmp_path / f"output_{backend}.hdf5"),
+        )
+        pz.estimate(validation_data)
+        output_file = pz.get_output(pz.get_aliased_tag("output"), final_name=True)
+        outputs.append(qp.read(output_file))
+
+    assert outputs[1].npdf == 10
+    assert np.array_equal(outputs[0].objdata()["yvals"], outputs[1].objdata()["yvals"])
+    assert np.array_equal(outputs[0].ancil["zmode"], outputs[1].ancil["zmode"])
+
+    pz = trainZ.TrainZ.make_stage(
+        name="TrainZ_bad_backend",
+        hdf5_groupname="photometry",
+        model=model,
+        parallel_backend="threads",
+    )
+    with pytest.raises(ValueError):
+        pz.estimate(validation_data)
+
+
+@pytest.mark.parametrize(
+    "representation, data_key, width",
+    [("quant", "locs", 9), ("hist", "pdfs", 31), ("interp", "yvals", 31), ("sparse", "sparse_indices", 20)],
+)
+def test_pdf_converter(tmp_path, representation, data_key, width):
+    DS.clear()
+    rng = np.random.default_rng(87)
+    loc = rng.uniform(0.5, 2.5, size=(25, 1))
+    pdfs = qp.Ensemble(qp.stats.norm, data=dict(loc=loc, scale=np.full((25, 1), 0.2)))
+    pdfs.set_ancil(dict(zmode=loc[:, 0]))
+    input_file = str(tmp_path / "pdfs_to_convert.hdf5")
+    pdfs.write_to(input_file)
+
+    converter = pdfConverter.PDFConverter.make_stage(
+        name=f"PDFConverter_{representation}", representation=representation, nquants=7, nzbins=31, chunk_size=10
+    )
+    converter.convert(DS.read_file("pdfs_to_convert", QPHandle, input_file))
+    output_file = converter.get_output(converter.get_aliased_tag("output"), final_name=True)
+    converted = qp.read(output_file)
+    os.remove(output_file)
+
+    assert converted.npdf == 25
+    assert converted.objdata()[data_key].shape[1] == width
+    assert np.array_equal(converted.ancil["zmode"], loc[:, 0])
+    zgrid = np.linspace(0.0, 3.0, 31)
+    assert np.allclose(converted.cdf(zgrid), pdfs.cdf(zgrid), atol=0.1)
+
+    if representation == "quant":
+        converter = pdfConverter.PDFConverter.make_stage(
+            name="PDFConverter_processes", nquants=7, chunk_size=10, parallel_backend="processes", num_workers=2
+        )
+        converter.convert(DS["pdfs_to_convert"])
+        output_file = converter.get_output(converter.get_aliased_tag("output"), final_name=True)
+        assert np.array_equal(qp.read(output_file).objdata()["locs"], converted.objdata()["locs"])
+        os.remove(output_file)
+
+    with pytest.raises(ValueError):
+        pdfConverter.PDFConverter.make_stage(name="PDFConverter_bad", representation="fourier")
+
+
+def test_pdf_converter_memory_budget(tmp_path):
+    DS.clear()
+    loc = np.linspace(0.5, 2.5, 25)[:, np.newaxis]
+    pdfs = qp.Ensemble(qp.stats.norm, data=dict(loc=loc, scale=np.full((25, 1), 0.2)))
+    pdfs.set_ancil(dict(zmode=loc[:, 0]))
+    input_file = str(tmp_path / "pdfs_budget.hdf5")
+    pdfs.write_to(input_file)
+    # loc, scale and zmode
+    assert QPHandle("pdfs_budget", path=input_file).row_bytes() == 24
+
+    # a budget of 10 rows, with 7 quantiles and the two end points in the output
+    converter = pdfConverter.PDFConverter.make_stage(
+        name="PDFConverter_budget",
+        input=input_file,
+        nquants=7,
+        memory_budget=10 * (24 + 8 * 9) / 1024**2,
+        output=str(tmp_path / "converted_budget.hdf5"),
+    )
+    chunks = list(converter.input_iterator("input"))
+    assert converter.config.chunk_size == 10
+    assert [(s, e) for s, e, _ in chunks] == [(0, 10), (10, 20), (20, 25)]
+
+
 @pytest.mark.skipif(
     int(sci_ver_str[0]) < 2 and int(sci_ver_str[1]) < 8,
     reason="mixmod parameterization known to break for scipy<1.8 due to array broadcast change",
 )
-def test_KNearNeigh():
+@pytest.mark.parametrize(
+    "model_file, index_type",
+    [("KNearNeighPDF.pkl", "kdtree"), ("KNearNeighPDF.npmodel", "kdtree"), ("KNearNeighPDF_ivf.pkl", "ivf")],
+)
+def test_KNearNeigh(model_file, index_type):
     def_bands = ["u", "g", "r", "i", "z", "y"]
     refcols = [f"mag_{band}_lsst" for band in def_bands]
     def_maglims = dict(
@@ -165,9 +427,10 @@ def test_KNearNeigh():
         nneigh_max=3,
         redshift_column_name="redshift",
         hdf5_groupname="photometry",
-        model="KNearNeighPDF.pkl",
+        model=model_file,
+        index_type=index_type,
     )
-    estim_config_dict = dict(hdf5_groupname="photometry", model="KNearNeighPDF.pkl")
+    estim_config_dict = dict(hdf5_groupname="photometry", model=model_file)
 
     # zb_expected = np.array([0.13, 0.14, 0.13, 0.13, 0.11, 0.15, 0.13, 0.14,
     #                         0.11, 0.12])
@@ -177,9 +440,114 @@ def test_KNearNeigh():
         "KNN", train_algo, pz_algo, train_config_dict, estim_config_dict
     )
     # assert np.isclose(results.ancil['zmode'], zb_expected).all()
+    assert results.ancil["zmode"].shape == (results.npdf, 1)
     assert np.isclose(results.ancil["zmode"], rerun_results.ancil["zmode"]).all()
 
 
+def test_KNearNeigh_search():
+    from rail.evaluation.metrics.cdeloss import CDELoss
+
+    rng = np.random.default_rng(87)
+    dists = np.sort(rng.uniform(0.01, 1.0, size=(200, 5)), axis=1)
+    ids = rng.integers(0, 100, size=(200, 5))
+    szs = rng.uniform(0.0, 3.0, size=100)
+    ztrue = rng.uniform(0.0, 3.0, size=200)
+    zgrid = np.linspace(0.0, 3.0, 301)
+    for sigma, nneigh in [(0.02, 3), (0.05, 5)]:
+        ens = knnpz._makepdf(dists[:, :nneigh], ids[:, :nneigh], szs, sigma)
+        expected = CDELoss(ens, zgrid, ztrue).evaluate().statistic
+        loss = knnpz._cde_loss(dists[:, :nneigh], ids[:, :nneigh], szs, sigma, zgrid, ztrue, block_size=37)
+        assert np.isclose(loss, expected)
+
+    DS.clear()
+    training_data = DS.read_file("training_data", TableHandle, traindata)
+    models = []
+    for num_workers in [1, 2]:
+        informer = knnpz.Inform_KNearNeighPDF.make_stage(
+            name=f"Inform_KNN_search_{num_workers}",
+            hdf5_groupname="photometry",
+            model=f"model_knn_search_{num_workers}.tmp",
+            ngrid_sigma=3,
+            num_workers=num_workers,
+        )
+        informer.inform(training_data)
+        models.append(informer.model)
+        os.remove(f"model_knn_search_{num_workers}.tmp")
+    assert models[0]["bestsig"] == models[1]["bestsig"]
+    assert models[0]["nneigh"] == models[1]["nneigh"]
+
+
+def test_KNearNeigh_mode():
+    rng = np.random.default_rng(87)
+    dists = np.sort(rng.uniform(0.01, 1.0, size=(200, 4)), axis=1)
+    ids = rng.integers(0, 100, size=(200, 4))
+    szs = rng.uniform(0.0, 3.0, size=100)
+    ens = knnpz._makepdf(dists, ids, szs, 0.03)
+    modes = knnpz._mixture_mode(ens.dist.means, ens.dist.stds, ens.dist.weights, tol=1e-6)
+    fine_grid = np.linspace(-0.5, 3.5, 40001)
+    grid_modes = np.array([fine_grid[np.argmax(ens[i].pdf(fine_grid))] for i in range(10)])
+    assert np.allclose(modes[:10], grid_modes, atol=2e-4)
+    assert np.all(np.diag(ens[:10].pdf(modes[:10])) >= np.diag(ens[:10].pdf(grid_modes)) - 1e-6)
+    coarse_modes = knnpz._mixture_mode(ens.dist.means, ens.dist.stds, ens.dist.weights, tol=1e-2)
+    assert np.allclose(coarse_modes, modes, atol=0.05)
+
+
+def test_KNearNeigh_threaded_query():
+    from sklearn.neighbors import KDTree
+
+    rng = np.random.default_rng(87)
+    tree = KDTree(rng.normal(size=(500, 3)), leaf_size=5)
+    data = rng.normal(size=(101, 3))
+    expected_dists, expected_ids = tree.query(data, k=4)
+    for num_threads in [1, 4, 0]:
+        dists, ids = knnpz._threaded_query(tree, data, 4, num_threads)
+        assert np.array_equal(dists, expected_dists)
+        assert np.array_equal(ids, expected_ids)
+
+
+def test_KNearNeigh_ivf_index(tmp_path):
+    from sklearn.neighbors import KDTree
+
+    rng = np.random.default_rng(87)
+    points = rng.normal(size=(2000, 4))
+    queries = rng.normal(size=(50, 4))
+    exact_dists, exact_ids = KDTree(points).query(queries, k=5)
+    index = knnpz.IVFIndex(points, n_lists=20, n_probe=3, seed=1)
+    dists, ids = index.query(queries, k=5)
+    assert np.all(np.diff(dists, axis=1) >= 0)
+    assert np.mean([np.intersect1d(row, exact).size / 5 for row, exact in zip(ids, exact_ids)]) > 0.7
+    dists, ids = index.query(queries, k=5, n_probe=20)
+    assert np.array_equal(ids, exact_ids)
+    assert np.allclose(dists, exact_dists)
+
+    model_path = str(tmp_path / "ivf.npmodel")
+    array_model.write_array_model(dict(kdtree=index), model_path)
+    mapped = array_model.read_array_model(model_path)["kdtree"]
+    assert np.array_equal(mapped.query(queries, k=5)[1], index.query(queries, k=5)[1])
+
+    with pytest.raises(ValueError):
+        knnpz.Inform_KNearNeighPDF.make_stage(name="Inform_KNN_bad_index", index_type="balltree")
+
+
+def test_KNearNeigh_ivf_index_small():
+    from sklearn.neighbors import KDTree
+
+    rng = np.random.default_rng(87)
+    points = rng.normal(size=(20, 3))
+    queries = rng.normal(size=(15, 3))
+    index = knnpz.IVFIndex(points, n_lists=5, n_probe=1, seed=1)
+    # a single cell holds fewer than k points, so all the cells are searched
+    for k in [7, 12, 20]:
+        dists, ids = index.query(queries, k=k)
+        exact_dists, exact_ids = KDTree(points).query(queries, k=k)
+        assert np.array_equal(ids, exact_ids)
+        assert np.allclose(dists, exact_dists)
+    # k is clamped to the number of points
+    dists, ids = index.query(queries, k=25)
+    assert ids.shape == (15, 20)
+    assert np.array_equal(np.sort(ids, axis=1), np.tile(np.arange(20), (15, 1)))
+
+
 def test_catch_bad_bands():
     params = dict(bands="u,g,r,i,z,y")
     with pytest.raises(ValueError):
@@ -0,0 +1,75 @@
+import copy
+import json
+
+import numpy as np
+
+from rail.core.benchmark import compare_results, main, make_synthetic_catalog, run_benchmarks
+from rail.core.stage import RailStage
+
+
+def test_synthetic_catalog():
+    catalog = make_synthetic_catalog(1000, seed=1)
+    assert len(catalog["id"]) == 1000
+    assert np.all((catalog["redshift"] > 0) & (catalog["redshift"] < 3))
+    for band in "ugrizy":
+        mags = catalog[f"mag_{band}_lsst"]
+        assert np.all((mags < 35) | (mags == 99.0))
+    assert np.array_equal(catalog["mag_i_lsst"], make_synthetic_catalog(1000, seed=1)["mag_i_lsst"])
+
+
+def test_run_and_compare_benchmarks(tmp_path):
+    allow_overwrite = RailStage.data_store.__class__.allow_overwrite
+    results = run_benchmarks(
+        [500],
+        str(tmp_path / "bench"),
+        only=[
+            "TrainZ",
+            "TrainZ_float32",
+            "IVFIndex_nprobe8",
+            "PDFConverter",
+            "PointEstimateHist",
+            "LineConfusion",
+            "Evaluator",
+        ],
+        ntrain=200,
+        isolate=False,
+    )
+    assert [result["case"] for result in results["results"]] == [
+        "TrainZ",
+        "TrainZ_float32",
+        "IVFIndex_nprobe8",
+        "PDFConverter",
+        "PointEstimateHist",
+        "LineConfusion",
+        "Evaluator",
+    ]
+    for result in results["results"]:
+        assert result["status"] == "ok", result["error"]
+        assert result["nrows"] == 500
+        assert result["run_seconds"] > 0
+    assert results["results"][0]["inform_seconds"] is not None
+    assert 0 < results["results"][1]["output_bytes"] < results["results"][0]["output_bytes"]
+    assert 0.5 < results["results"][2]["recall_at_k"] <= 1.0
+    assert results["results"][3]["output_bytes"] > 0
+    # the DataStore overwrite protection is restored after each case
+    assert RailStage.data_store.__class__.allow_overwrite == allow_overwrite
+
+    assert not compare_results(results, results)
+
+    slower = copy.deepcopy(results)
+    slower["results"][0]["run_seconds"] += 10.0
+    slower["results"][4]["status"] = "error"
+    regressions = compare_results(results, slower)
+    assert [(reg["case"], reg["metric"]) for reg in regressions] == [
+        ("TrainZ", "run_seconds"),
+        ("PointEstimateHist", "status"),
+    ]
+
+    baseline_file = str(tmp_path / "baseline.json")
+    current_file = str(tmp_path / "current.json")
+    with open(baseline_file, "w") as fout:
+        json.dump(results, fout)
+    with open(current_file, "w") as fout:
+        json.dump(slower, fout)
+    assert main(["compare", baseline_file, baseline_file]) == 0
+    assert main(["compare", baseline_file, current_file]) == 1
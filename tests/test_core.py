@@ -2,9 +2,11 @@ import os
 import pickle
 from types import GeneratorType
 
+import h5py
 import numpy as np
 import pandas as pd
 import pytest
+import qp
 import tempfile
 
 import rail
@@ -15,12 +17,18 @@ from rail.core.data import (
     FitsHandle,
     FlowHandle,
     Hdf5Handle,
+    ModelDict,
     ModelHandle,
     PqHandle,
     QPHandle,
     TableHandle,
+    iterate_data,
 )
+from rail.core import array_model
+from rail.core.background import ChunkWriter, PrefetchIterator
+from rail.core.instrumentation import StageMetrics
 from rail.core.stage import RailStage
+from rail.estimation.summarizer import PZSummarizer
 from rail.core.utilPhotometry import HyperbolicMagnitudes, HyperbolicSmoothing, PhotormetryManipulator
 from rail.core.utils import RAILDIR
 from rail.core.utilStages import (
@@ -203,6 +211,46 @@ def test_fits_handle():
     assert handle.fileObj is None
 
 
+@pytest.mark.parametrize(
+    "handle_class,suffix,write_kwargs",
+    [(PqHandle, "pq", {}), (PqHandle, "pq", dict(row_group_size=2500)), (FitsHandle, "fits", {})],
+)
+def test_table_handle_write_chunks(tmp_path, handle_class, suffix, write_kwargs):
+    datapath = os.path.join(RAILDIR, "rail", "examples_data", "testdata", "test_dc2_training_9816.pq")
+    data = PqHandle("data", path=datapath).read()[["id", "redshift", "mag_i_lsst"]]
+    num_rows = len(data)
+    chunk_size = 1000
+
+    outpath = str(tmp_path / f"chunked.{suffix}")
+    handle = handle_class("chunked", path=outpath)
+    for start in range(0, num_rows, chunk_size):
+        end = min(start + chunk_size, num_rows)
+        handle.set_data(data.iloc[start:end], partial=True)
+        if start == 0:
+            handle.initialize_write(num_rows, **write_kwargs)
+        handle.write_chunk(start, end)
+    handle.finalize_write()
+
+    data_check = handle_class("check", path=outpath).read()
+    for col in data.columns:
+        assert np.allclose(data[col], data_check[col])
+
+    if handle_class is PqHandle:
+        assert handle.size() == num_rows
+        x = handle.iterator(chunk_size=chunk_size)
+        for s, e, chunk in x:
+            assert np.allclose(chunk["id"], data["id"][s:e])
+
+    # chunks have to be written in order, and fill the file
+    handle = handle_class("bad", path=str(tmp_path / f"bad.{suffix}"))
+    handle.set_data(data.iloc[0:chunk_size], partial=True)
+    handle.initialize_write(num_rows)
+    with pytest.raises(ValueError):
+        handle.write_chunk(chunk_size, 2 * chunk_size)
+    with pytest.raises(ValueError):
+        handle.finalize_write()
+
+
 def test_model_handle():
     DS = RailStage.data_store
     DS.clear()
@@ -227,6 +275,106 @@ def test_model_handle():
     os.remove(model_path_copy)
 
 
+def test_array_model(tmp_path):
+    from sklearn.neighbors import KDTree
+
+    rng = np.random.default_rng(0)
+    train = rng.random((200, 4))
+    model = dict(kdtree=KDTree(train, leaf_size=5), bestsig=0.02, nneigh=3,
+                 truezs=rng.random(200), usecols=["a", "b"], shape=(4, 5))
+    path = str(tmp_path / "model.npmodel")
+    ModelHandle("array_model", path=path, data=model).write()
+    assert array_model.is_array_model(path)
+
+    read_back = ModelDict().read(path)
+    assert read_back["usecols"] == ["a", "b"]
+    assert read_back["shape"] == (4, 5)
+    assert isinstance(read_back["truezs"], np.memmap)
+    assert not read_back["truezs"].flags.writeable
+    assert np.array_equal(read_back["truezs"], model["truezs"])
+    query = rng.random((10, 4))
+    assert np.array_equal(read_back["kdtree"].query(query, k=3)[1], model["kdtree"].query(query, k=3)[1])
+
+    # the blocks can also be copied into any buffer, e.g., shared memory
+    description, nbytes, blocks = array_model.pack_model(model)
+    buffer = np.zeros(nbytes, dtype=np.uint8)
+    array_model.copy_blocks(blocks, buffer)
+    unpacked = array_model.unpack_model(description, buffer)
+    assert np.shares_memory(unpacked["truezs"], buffer)
+    assert np.array_equal(unpacked["kdtree"].query(query, k=3)[0], model["kdtree"].query(query, k=3)[0])
+
+    # other files are still read with pickle
+    assert not array_model.is_array_model(str(tmp_path / "missing.pkl"))
+    with pytest.raises(ValueError):
+        array_model.read_array_model(os.path.join(RAILDIR, "rail", "examples_data", "estimation_data", "data",
+                                                  "CWW_HDFN_prior.pkl"))
+
+
+def test_array_model_objects(tmp_path):
+    from minisom import MiniSom
+    from rail.estimation.algos.knnpz import IVFIndex
+
+    rng = np.random.default_rng(0)
+    som = MiniSom(4, 4, 3, random_seed=1)
+    som.train(rng.random((100, 3)), 50)
+    index = IVFIndex(rng.random((200, 3)), n_lists=4)
+    path = str(tmp_path / "objects.npmodel")
+    array_model.write_array_model(dict(som=som, index=index), path)
+
+    read_back = array_model.read_array_model(path)
+    # the arrays of plain python objects are mapped, not pickled
+    for array in [read_back["som"]._weights, read_back["index"].data]:
+        assert isinstance(array, np.memmap)
+        assert not array.flags.writeable
+    assert np.array_equal(read_back["som"]._weights, som._weights)
+    # the bound methods stored by the som point to the rebuilt object
+    assert read_back["som"]._activation_distance.__self__ is read_back["som"]
+    query = rng.random((10, 3))
+    assert read_back["som"].win_map(query).keys() == som.win_map(query).keys()
+    assert np.array_equal(read_back["index"].query(query, k=3)[1], index.query(query, k=3)[1])
+
+
+def test_model_dict_limits(tmp_path):
+    models = ModelDict(max_entries=2)
+    paths = [str(tmp_path / f"model_{i}.pkl") for i in range(3)]
+    for i, path in enumerate(paths):
+        models.write(dict(value=i), path)
+    assert list(models.keys()) == paths[1:]
+    assert models.stats()["evictions"] == 1
+
+    # hits move the entry to the end, misses read the file again
+    assert models.read(paths[1]) is models[paths[1]]
+    assert models.read(paths[0]) == dict(value=0)
+    assert list(models.keys()) == [paths[1], paths[0]]
+
+    # rewriting the file makes the entry stale
+    with open(paths[1], "wb") as fout:
+        pickle.dump(dict(value=10, padding=np.zeros(1000)), fout)
+    assert models.read(paths[1])["value"] == 10
+    stats = models.stats()
+    assert (stats["hits"], stats["misses"], stats["stale"], stats["evictions"]) == (1, 2, 1, 2)
+
+    # the size limit evicts the oldest entries, but never the one being added
+    models.set_limits(max_size=100 / 1024**2)
+    assert not models
+    models.read(paths[0])
+    models.read(paths[1])
+    assert list(models.keys()) == [paths[1]]
+    assert models.nbytes() > 100
+
+
+def test_model_dict_deleted_file(tmp_path):
+    models = ModelDict()
+    path = str(tmp_path / "model.pkl")
+    model = dict(value=1)
+    models.write(model, path)
+    os.remove(path)
+    assert not models.is_fresh(path)
+    models.write(model, path)
+    assert os.path.exists(path)
+    assert models.read(path) is model
+
+
 def test_flow_handle():
     DS = RailStage.data_store
     DS.clear()
@@ -281,6 +429,334 @@ def test_data_hdf5_iter():
         assert xx[1] - xx[0] <= 1000
 
 
+def test_data_memory_budget_iter():
+    DS = RailStage.data_store
+    DS.clear()
+
+    datapath = os.path.join(RAILDIR, "rail", "examples_data", "testdata", "test_dc2_training_9816.hdf5")
+    th = Hdf5Handle("data", path=datapath)
+    row_bytes = th.row_bytes(groupname="photometry")
+    assert row_bytes == 64
+    assert th.row_bytes(columns=["redshift", "id"], groupname="photometry") == 16
+
+    # a budget of 1000 rows
+    cm = ColumnMapper.make_stage(
+        name="col_map_budget",
+        input=datapath,
+        chunk_size=10,
+        hdf5_groupname="photometry",
+        memory_budget=1000 * row_bytes / 1024**2,
+        columns=dict(id="bob"),
+    )
+    x = cm.input_iterator("input")
+    assert cm.config.chunk_size == 1000
+    for i, (s, e, _) in enumerate(x):
+        assert s == i * 1000
+        assert e - s <= 1000
+
+
+def test_data_in_memory_iter():
+    DS = RailStage.data_store
+    DS.clear()
+
+    data = dict(id=np.arange(25), mag=np.linspace(20.0, 25.0, 25))
+    cm = ColumnMapper.make_stage(name="col_map_in_memory", chunk_size=10, columns=dict(id="bob"))
+    cm.set_data("input", data)
+    chunks = list(cm.input_iterator("input"))
+    assert [(s, e) for s, e, _ in chunks] == [(0, 10), (10, 20), (20, 25)]
+    assert np.shares_memory(chunks[1][2]["mag"], data["mag"])
+    assert np.array_equal(chunks[2][2]["id"], np.arange(20, 25))
+
+    df = pd.DataFrame(data)
+    assert [(s, e) for s, e, _ in iterate_data(df, chunk_size=10, rank=1, parallel_size=2)] == [(10, 20)]
+    ens = qp.Ensemble(qp.interp, data=dict(xvals=np.linspace(0, 1, 11), yvals=np.ones((25, 11))),
+                      ancil=dict(zmode=np.arange(25.0)))
+    ens_chunks = list(iterate_data(ens, chunk_size=10))
+    assert [chunk.npdf for _, _, chunk in ens_chunks] == [10, 10, 5]
+    assert np.array_equal(ens_chunks[2][2].ancil["zmode"], np.arange(20.0, 25.0))
+
+
+def test_qp_handle_rows(tmp_path):
+    DS = RailStage.data_store
+    DS.clear()
+
+    ens = qp.Ensemble(qp.interp, data=dict(xvals=np.linspace(0, 1, 11), yvals=np.random.uniform(size=(25, 11))),
+                      ancil=dict(zmode=np.arange(25.0)))
+    path = str(tmp_path / "ens.hdf5")
+    ens.write_to(path)
+
+    handle = QPHandle("ens", path=path)
+    assert handle.size() == 25
+    chunks = list(handle.iterator(chunk_size=10))
+    assert [(s, e) for s, e, _ in chunks] == [(0, 10), (10, 20), (20, 25)]
+    assert [chunk.npdf for _, _, chunk in chunks] == [10, 10, 5]
+    assert np.allclose(chunks[1][2].objdata()["yvals"], ens.objdata()["yvals"][10:20])
+    assert np.array_equal(chunks[2][2].ancil["zmode"], np.arange(20.0, 25.0))
+    assert [(s, e) for s, e, _ in handle.iterator(chunk_size=10, rank=1, parallel_size=2)] == [(10, 20)]
+
+    rows = handle.read(start=5, end=8)
+    assert rows.npdf == 3
+    assert handle.partial
+    assert np.array_equal(rows.ancil["zmode"], [5.0, 6.0, 7.0])
+    assert handle().npdf == 25
+    assert not handle.partial
+
+    summarizer = PZSummarizer.make_stage(name="summarize_qp_rows", chunk_size=10)
+    summarizer.set_data("input", DS.read_file("ens_rows", QPHandle, path))
+    assert [(s, e) for s, e, _ in summarizer.input_iterator("input")] == [(0, 10), (10, 20), (20, 25)]
+
+
+def test_qp_handle_precision(tmp_path):
+    ens = qp.Ensemble(qp.interp, data=dict(xvals=np.linspace(0, 1, 11), yvals=np.random.uniform(size=(20, 11))),
+                      ancil=dict(zmode=np.linspace(0.0, 1.0, 20)))
+    path = str(tmp_path / "ens_float32.hdf5")
+    handle = QPHandle("ens_float32", data=ens[0:10], path=path)
+    handle.initialize_write(20, precision="float32", compression="gzip")
+    handle.write_chunk(0, 10)
+    handle.set_data(ens[10:20], partial=True)
+    handle.write_chunk(10, 20)
+    handle.finalize_write()
+
+    with h5py.File(path, "r") as hdf5_file:
+        assert hdf5_file["data/yvals"].dtype == np.float32
+        assert hdf5_file["data/yvals"].compression == "gzip"
+        assert hdf5_file["ancil/zmode"].dtype == np.float64
+    read_back = QPHandle("ens_float32_read", path=path).read()
+    assert read_back.objdata()["yvals"].dtype == np.float64
+    assert np.allclose(read_back.objdata()["yvals"], ens.objdata()["yvals"], rtol=1e-6)
+    assert np.array_equal(read_back.ancil["zmode"], ens.ancil["zmode"])
+
+
+def test_qp_handle_ancil(tmp_path):
+    ens = qp.Ensemble(qp.interp, data=dict(xvals=np.linspace(0, 1, 11), yvals=np.ones((5, 11))),
+                      ancil=dict(zmode=np.arange(5.0), zmean=np.ones(5)))
+    path = str(tmp_path / "ens_ancil.hdf5")
+    ens.write_to(path)
+
+    handle = QPHandle("ens_ancil", path=path)
+    assert sorted(handle.read_ancil()) == ["zmean", "zmode"]
+    ancil = handle.read_ancil(["zmode"])
+    assert list(ancil) == ["zmode"]
+    assert np.array_equal(ancil["zmode"], np.arange(5.0))
+    assert not handle.has_data
+    with pytest.raises(KeyError):
+        handle.read_ancil(["zmedian"])
+
+    handle.read()
+    assert handle.read_ancil(["zmean"])["zmean"] is handle.data.ancil["zmean"]
+    with pytest.raises(ValueError):
+        QPHandle("no_path").read_ancil()
+
+
+def test_data_pq_iter():
+    DS = RailStage.data_store
+    DS.clear()
+
+    datapath = os.path.join(RAILDIR, "rail", "examples_data", "testdata", "test_dc2_training_9816.pq")
+    full_data = PqHandle("full", path=datapath).read()
+
+    th = PqHandle("data", path=datapath)
+    assert th.size() == len(full_data)
+
+    x = th.iterator(chunk_size=1000, columns=["redshift", "not_a_column"])
+    assert isinstance(x, GeneratorType)
+    nrow = 0
+    for i, (s, e, chunk) in enumerate(x):
+        assert s == i * 1000
+        assert len(chunk) == e - s
+        assert list(chunk.columns) == ["redshift"]
+        assert np.allclose(chunk["redshift"], full_data["redshift"][s:e])
+        nrow += e - s
+    assert nrow == len(full_data)
+
+    x = th.iterator(chunk_size=1000, rank=1, parallel_size=2)
+    for i, (s, e, chunk) in enumerate(x):
+        assert s == (2 * i + 1) * 1000
+        assert np.allclose(chunk["mag_i_lsst"], full_data["mag_i_lsst"][s:e])
+
+    cm = ColumnMapper.make_stage(
+        name="col_map_pq", input=datapath, chunk_size=1000, hdf5_groupname="", columns=dict(id="bob")
+    )
+    x = cm.input_iterator("input")
+    assert isinstance(x, GeneratorType)
+    for i, (s, e, chunk) in enumerate(x):
+        assert s == i * 1000
+        assert e - s <= 1000
+
+
+def test_data_pq_iter_in_memory(tmp_path):
+    DS = RailStage.data_store
+    DS.clear()
+
+    datapath = os.path.join(RAILDIR, "rail", "examples_data", "testdata", "test_dc2_training_9816.pq")
+    data = PqHandle("full", path=datapath).read()
+    # the handle has a parquet path, but its file has not been written yet
+    unwritten = DS.add_data("pq_unwritten", data, PqHandle, path=str(tmp_path / "unwritten.pq"))
+    assert not unwritten.is_written
+
+    cm = ColumnMapper.make_stage(name="col_map_pq_memory", chunk_size=1000, hdf5_groupname="", columns=dict(id="bob"))
+    cm.set_data("input", unwritten)
+    nrow = 0
+    for s, e, chunk in cm.input_iterator("input"):
+        assert np.allclose(chunk["redshift"], data["redshift"][s:e])
+        nrow += e - s
+    assert nrow == len(data)
+
+
+def test_data_hdf5_prefetch_iter():
+    DS = RailStage.data_store
+    DS.clear()
+
+    datapath = os.path.join(RAILDIR, "rail", "examples_data", "testdata", "test_dc2_training_9816.hdf5")
+
+    th = Hdf5Handle("data", path=datapath)
+    expected = [(s, e, data.copy()) for s, e, data in th.iterator(groupname="photometry", chunk_size=1000)]
+
+    cm = ColumnMapper.make_stage(
+        name="col_map_prefetch",
+        input=datapath,
+        chunk_size=1000,
+        hdf5_groupname="photometry",
+        prefetch_depth=2,
+        columns=dict(id="bob"),
+    )
+    x = cm.input_iterator("input")
+    assert isinstance(x, PrefetchIterator)
+
+    nchunk = 0
+    for (s, e, data), (s_exp, e_exp, data_exp) in zip(x, expected):
+        assert s == s_exp
+        assert e == e_exp
+        assert np.allclose(data["id"], data_exp["id"])
+        nchunk += 1
+    assert nchunk == len(expected)
+    with pytest.raises(StopIteration):
+        next(x)
+
+    # stopping early releases the reader thread
+    x = cm.input_iterator("input")
+    next(x)
+    x.close()
+
+    def bad_iterator():
+        yield 0, 1, {}
+        raise RuntimeError("bad chunk")
+
+    x = PrefetchIterator(bad_iterator(), depth=1)
+    assert next(x)[0] == 0
+    with pytest.raises(RuntimeError):
+        next(x)
+
+
+def test_prefetch_iter_stops():
+    def chunks():
+        for i in range(100):
+            yield i, i + 1, {"x": np.zeros(1)}
+
+    with PrefetchIterator(chunks(), depth=1) as x:
+        next(x)
+        thread = x._thread
+    assert not thread.is_alive()
+
+    # dropping an unfinished iterator stops the reader thread
+    x = PrefetchIterator(chunks(), depth=1)
+    next(x)
+    thread = x._thread
+    del x
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+    # as does closing the generator recording the metrics around it
+    metrics = StageMetrics("prefetch", enabled=True)
+    inner = PrefetchIterator(chunks(), depth=1)
+    x = metrics.iterate(inner)
+    next(x)
+    x.close()
+    assert not inner._thread.is_alive()
+
+
+def test_table_handle_columns():
+    DS = RailStage.data_store
+    DS.clear()
+
+    columns = ["mag_i_lsst", "redshift", "not_a_column"]
+    datapath_hdf5 = os.path.join(RAILDIR, "rail", "examples_data", "testdata", "test_dc2_training_9816.hdf5")
+    datapath_pq = os.path.join(RAILDIR, "rail", "examples_data", "testdata", "test_dc2_training_9816.pq")
+
+    full_data = TableHandle("full", path=datapath_hdf5).read()["photometry"]
+    th = TableHandle("data", path=datapath_hdf5)
+    data = th.read(columns=columns)["photometry"]
+    assert list(data.keys()) == columns[:2]
+    assert np.allclose(data["redshift"], full_data["redshift"])
+    assert th.partial
+    assert "mag_u_lsst" in th()["photometry"]
+    assert not th.partial
+
+    pq_data = TableHandle("pq_data", path=datapath_pq).read(columns=columns)
+    assert list(pq_data.columns) == columns[:2]
+
+    x = th.iterator(groupname="photometry", chunk_size=1000, columns=columns)
+    for i, (s, e, chunk) in enumerate(x):
+        assert s == i * 1000
+        assert list(chunk.keys()) == columns[:2]
+        assert np.allclose(chunk["mag_i_lsst"], full_data["mag_i_lsst"][s:e])
+
+    from rail.estimation.algos.knnpz import Inform_KNearNeighPDF
+
+    informer = Inform_KNearNeighPDF.make_stage(name="inform_knn_columns", input=datapath_hdf5)
+    data = informer.get_data("input")["photometry"]
+    assert set(data.keys()) == set(informer.usecols)
+
+
+def test_hdf5_handle_memmap(tmp_path):
+    import h5py
+
+    datapath = str(tmp_path / "memmap_test.hdf5")
+    contiguous = np.arange(100, dtype=float)
+    compressed = np.arange(100, dtype=np.int32)
+    with h5py.File(datapath, "w") as fout:
+        group = fout.create_group("photometry")
+        group.create_dataset("contiguous", data=contiguous)
+        group.create_dataset("compressed", data=compressed, compression="gzip")
+
+    handle = Hdf5Handle("memmap", path=datapath)
+    data = handle.read(memmap=True)["photometry"]
+    assert isinstance(data["contiguous"], np.memmap)
+    assert not data["contiguous"].flags.writeable
+    assert not isinstance(data["compressed"], np.memmap)
+    assert np.array_equal(data["contiguous"], contiguous)
+    assert np.array_equal(data["compressed"], compressed)
+    assert not handle.partial
+
+    from rail.estimation.algos.NZDir import Inform_NZDir
+
+    DS = RailStage.data_store
+    DS.clear()
+    datapath = os.path.join(RAILDIR, "rail", "examples_data", "testdata", "test_dc2_training_9816.hdf5")
+    informer = Inform_NZDir.make_stage(name="inform_nzdir_memmap", input=datapath, memmap_inputs=True)
+    data = informer.get_data("input")["photometry"]
+    assert isinstance(data["redshift"], np.memmap)
+    assert "id" not in data
+
+
+def test_chunk_writer():
+    written = []
+    writer = ChunkWriter(depth=2)
+    for i in range(10):
+        writer.submit(written.append, i)
+    writer.flush()
+    assert written == list(range(10))
+    writer.close()
+
+    def bad_write(_):
+        raise OSError("disk full")
+
+    writer = ChunkWriter(depth=1)
+    writer.submit(bad_write, 0)
+    with pytest.raises(OSError):
+        writer.close()
+
+
 def test_data_store():
     DS = RailStage.data_store
     DS.clear()
@@ -336,6 +812,66 @@ def test_data_store():
     os.remove(datapath_pq_copy)
 
 
+def test_data_store_memory_budget(tmp_path):
+    datapath_hdf5 = os.path.join(RAILDIR, "rail", "examples_data", "testdata", "test_dc2_training_9816.hdf5")
+    store = DataStore()
+    hdf5 = store.read_file("hdf5", Hdf5Handle, datapath_hdf5)
+    in_memory = store.add_data("in_memory", {"x": np.arange(100_000, dtype=float)}, Hdf5Handle)
+    nbytes = store.memory_usage()
+    assert nbytes["in_memory"] == 800_000
+    assert nbytes["hdf5"] > 0
+
+    # only room for one of them, "hdf5" is the least recently used
+    store.set_memory_budget(1.0, spill_dir=str(tmp_path))
+    assert not hdf5.has_data
+    assert in_memory.has_data
+
+    # accessing "hdf5" evicts "in_memory", which is written first
+    data = store.read("hdf5")
+    assert hdf5.has_data
+    assert not in_memory.has_data
+    assert in_memory.path == str(tmp_path / "in_memory.hdf5")
+    assert store.n_evicted == 2
+
+    assert np.array_equal(store.read("in_memory")["x"], np.arange(100_000, dtype=float))
+    assert not hdf5.has_data
+    assert np.array_equal(hdf5()["photometry"]["redshift"], data["photometry"]["redshift"])
+
+    store.set_memory_budget(None)
+    assert not store.enforce_budget()
+
+
+def test_data_store_evict_modified(tmp_path):
+    path = str(tmp_path / "modified.hdf5")
+    store = DataStore()
+    stale = store.add_data("stale", {"x": np.zeros(10)}, Hdf5Handle, path=path)
+    stale.write()
+    assert not stale.dirty
+
+    # the file at the path now holds old data
+    stale.set_data({"x": np.arange(100_000, dtype=float)})
+    assert stale.dirty and stale.is_written
+    store.set_memory_budget(0.1, spill_dir=str(tmp_path))
+    assert not stale.has_data
+    assert not stale.dirty
+    assert np.array_equal(store.read("stale")["x"], np.arange(100_000, dtype=float))
+    store.set_memory_budget(None)
+
+
+def test_data_store_budget_keeps_models(tmp_path):
+    path = str(tmp_path / "budget.npmodel")
+    ModelHandle("model", path=path, data={"weights": np.zeros((400, 500))}).write()
+    store = DataStore()
+    model = store.read_file("budget_model", ModelHandle, path)
+    table = store.add_data("budget_table", {"x": np.zeros(10)}, TableHandle)
+    store.set_memory_budget(0.5, spill_dir=str(tmp_path))
+    assert "budget_model" not in store.memory_usage()
+    assert not store.enforce_budget()
+    assert model.has_data and table.has_data
+    assert model.data["weights"].shape == (400, 500)
+    store.set_memory_budget(None)
+
+
 @pytest.fixture
 def hyperbolic_configuration():
     """get the code configuration for the example data"""
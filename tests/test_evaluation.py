@@ -96,3 +96,18 @@ def test_evaluation_stage():
     evaluator.evaluate(pdf, truth)
 
     os.remove(evaluator.get_output(evaluator.get_aliased_tag("output"), final_name=True))
+
+
+def test_evaluation_stage_point_estimate():
+    DS = RailStage.data_store
+    DS.clear()
+    zgrid, zspec, pdf_ens, true_ez = construct_test_ensemble()
+    pdf_ens.set_ancil(dict(zmode=np.squeeze(pdf_ens.mode(grid=zgrid))))
+    pdf = DS.add_data("pdf_point", pdf_ens, QPHandle)
+    truth = DS.add_data("truth_point", dict(redshift=zspec), TableHandle)
+    evaluator = Evaluator.make_stage(name="Eval_point", pit_metrics="", do_cde=False, point_estimate="zmode")
+    output = evaluator.evaluate(pdf, truth)()
+    assert not [key for key in output if not key.startswith("POINT_")]
+    assert np.isclose(output["POINT_SimgaIQR"][0], pe.PointSigmaIQR(pdf_ens.ancil["zmode"], zspec).evaluate())
+
+    os.remove(evaluator.get_output(evaluator.get_aliased_tag("output"), final_name=True))
@@ -1,5 +1,6 @@
 import os
 
+import numpy as np
 import pytest
 
 from rail.core.data import TableHandle
@@ -42,3 +43,45 @@ def test_NZDir_bad_weight():
     estimator_class = NZDir.NZDir
     with pytest.raises(KeyError):
         _ = one_algo("NZDir", inform_class, estimator_class, summary_config_dict)
+
+
+@pytest.mark.parametrize(
+    "option",
+    [dict(parallel_backend="processes"), dict(write_behind_depth=2), dict(output_precision="float32"),
+     dict(output_compression="gzip")],
+)
+def test_NZDir_unsupported_options(tmp_path, option):
+    DS.clear()
+    spec_data = DS.read_file("spec_data", TableHandle, testszdata)
+    informer = NZDir.Inform_NZDir.make_stage(name="inform_NZDir_unsupported", model=str(tmp_path / "model.pkl"))
+    informer.inform(spec_data)
+    with pytest.raises(ValueError, match="NZDir does not support"):
+        NZDir.NZDir.make_stage(name="NZDir_unsupported", model=informer.get_handle("model"), **option)
+
+
+def test_NZDir_threads():
+    inform_class = NZDir.Inform_NZDir
+    estimator_class = NZDir.NZDir
+    summaries = []
+    for num_threads in [1, 4]:
+        DS.clear()
+        summary = one_algo(f"NZDir_threads_{num_threads}", inform_class, estimator_class, {"num_threads": num_threads})
+        summaries.append(summary())
+        os.remove(f"single_NZ_NZDir_threads_{num_threads}.hdf5")
+    assert np.array_equal(summaries[0].objdata()["pdfs"], summaries[1].objdata()["pdfs"])
+
+
+def test_NZDir_ball_index():
+    import scipy.spatial
+
+    rng = np.random.default_rng(87)
+    centres = rng.normal(size=(500, 3))
+    radii = np.exp(rng.normal(-0.5, 0.6, size=500))
+    radii[:3] = [5.0, 10.0, 20.0]
+    points = rng.normal(size=(2000, 3))
+    point_weights = rng.uniform(size=2000)
+    index = NZDir._BallIndex(centres, radii, leafsize=8)
+    assert index.brute_force.size > 0
+    expected = [point_weights[ids].sum() for ids in scipy.spatial.KDTree(points).query_ball_point(centres, radii)]
+    for num_threads in [1, 2]:
+        assert np.allclose(index.weights(points, point_weights, num_threads), expected)
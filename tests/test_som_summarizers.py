@@ -76,3 +76,34 @@ def test_SimpeSOM_with_mag_and_colors():
     inform_class = simpleSOM.Inform_SimpleSOMSummarizer
     summarizerclass = simpleSOM.SimpleSOMSummarizer
     _ = one_algo("SimpleSOM_wmag", inform_class, summarizerclass, summary_config_dict)
+
+
+def test_SimpleSOM_shared_model(tmp_path):
+    DS.clear()
+    spec_data = DS.read_file("spec_data", TableHandle, testszdata)
+    phot_data = DS.read_file("phot_data", TableHandle, testphotdata)
+    model_path = str(tmp_path / "som.npmodel")
+    informer = simpleSOM.Inform_SimpleSOMSummarizer.make_stage(
+        name="inform_SimpleSOM_shared", model=model_path, m_dim=11, n_dim=11, som_iterations=500
+    )
+    informer.inform(spec_data)
+
+    single_nzs = []
+    for shared_model in [False, True]:
+        name = f"SimpleSOM_shared_{shared_model}"
+        summarizer = simpleSOM.SimpleSOMSummarizer.make_stage(
+            name=name,
+            model=model_path,
+            shared_model=shared_model,
+            output=str(tmp_path / f"{name}.hdf5"),
+            single_NZ=str(tmp_path / f"single_NZ_{name}.hdf5"),
+            cellid_output=str(tmp_path / f"cellid_{name}.hdf5"),
+            uncovered_cell_file=str(tmp_path / f"uncovered_{name}.hdf5"),
+        )
+        summarizer.summarize(phot_data, spec_data)
+        single_nzs.append(qp.read(summarizer.get_output(summarizer.get_aliased_tag("single_NZ"), final_name=True)))
+    # without MPI, the shared model is read from the array model file, with read-only mapped arrays
+    weights = summarizer.model["som"]._weights
+    assert isinstance(weights, np.memmap)
+    assert not weights.flags.writeable
+    assert np.array_equal(single_nzs[0].objdata()["pdfs"], single_nzs[1].objdata()["pdfs"])